@@ -30,9 +30,23 @@ class ClientConfig:
     BBOX_UNSELECT = "#ebcf1a"
 
     DATA_DIR = os.path.join(ROOT_DIR, 'client', 'data')
+    # Local copies of downloaded images and annotations, revalidated with their ETags
+    DOWNLOAD_CACHE_DIR = os.path.join(ROOT_DIR, 'client', 'cache')
 
     CLIENT_POOL_LIMIT = 50
 
+    # Seconds between status checks while waiting for a background job on the server
+    JOB_POLL_INTERVAL = 1.0
+
+    # How masks are sent to and fetched from the server, either "packed-v1" or "raw" for older servers
+    MASK_ENCODING = "packed-v1"
+
+    # The number of image metas fetched per request when listing the images of a project
+    IMAGE_PAGE_SIZE = 500
+
+    # Seconds between renewals of the leases on open images, which must be shorter than the server's lease
+    LEASE_RENEW_INTERVAL = 60
+
     EDITOR_MAX_DIM = None
     TILE_MAX_DIM = 150
 
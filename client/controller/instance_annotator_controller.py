@@ -11,6 +11,8 @@ from client.utils import ApiException, ClientConfig
 class InstanceAnnotatorController:
     def __init__(self, model):
         self.model = model
+        # The ids of the images this client holds a lease on
+        self._leased = set()
 
     def fetch_image_metas(self, project_id, filter_details):
         """
@@ -19,31 +21,31 @@ class InstanceAnnotatorController:
         :param filter_details: A dict of filter params used to order the images
         :return:
         """
-        resp = utils.get_project_images(project_id, filter_details)
-
-        if resp.status_code != 200:
-            raise ApiException(
-                "Failed to retrieve project image ids.",
-                resp.status_code)
-
-        result = resp.json()
+        cursor = None
+        while True:
+            resp = utils.get_project_images(project_id, filter_details,
+                                            fields=["id", "name", "is_locked"],
+                                            limit=ClientConfig.IMAGE_PAGE_SIZE,
+                                            after=cursor)
+            if resp.status_code != 200:
+                raise ApiException(
+                    "Failed to retrieve project image meta information.",
+                    resp.status_code)
 
-        resp = utils.get_images_by_ids(result["ids"])
-        if resp.status_code != 200:
-            raise ApiException(
-                "Failed to retrieve image meta information.",
-                resp.status_code)
+            result = resp.json()
+            for row in result["images"]:
+                if self.model.images.is_open(row["id"]):
+                    continue
 
-        result = resp.json()
-        for row in result["images"]:
-            if self.model.images.is_open(row["id"]):
-                continue
+                state = ImageState(id=row["id"],
+                                   name=row["name"],
+                                   is_locked=row["is_locked"],
+                                   is_open=False)
+                self.model.images.add(row["id"], state)
 
-            state = ImageState(id=row["id"],
-                               name=row["name"],
-                               is_locked=row["is_locked"],
-                               is_open=False)
-            self.model.images.add(row["id"], state)
+            cursor = result.get("next", None)
+            if cursor is None:
+                break
 
     def fetch_image(self, image_id):
         """
@@ -56,11 +58,13 @@ class InstanceAnnotatorController:
             if not image_model:
                 image_model = ImageState()
 
-            resp = utils.update_image_meta_by_id(image_id, lock=True)
+            resp = utils.renew_image_lease(image_id, image_model.lease_token)
             if resp.status_code != 200:
                 raise ApiException(
                     "Failed to lock image with id %d" %
                     image_id, resp.status_code)
+            image_model.lease_token = resp.json()["token"]
+            self._leased.add(image_id)
 
             resp = utils.get_image_by_id(image_id)
             if resp.status_code == 404:
@@ -111,12 +115,77 @@ class InstanceAnnotatorController:
                         annotation_name=annotation_name,
                         class_name=class_name,
                         mat=mat,
-                        bbox=bbox)
+                        bbox=bbox,
+                        dirty=False)
 
                     i += 1
             image_model.annotations = annotations
             self.model.images.add(image_id, image_model)
 
+    def claim_next_image(self, project_id):
+        """
+        Claim the next unlabeled image in this project which is not locked by another client.
+        :param project_id: The ID for this project
+        :return: The ID of the claimed image, or None if every unlabeled image is locked
+        """
+        resp = utils.claim_next_image(project_id)
+        if resp.status_code == 404:
+            return None
+        elif resp.status_code != 200:
+            raise ApiException(
+                "Failed to claim an image in the project with id %d." %
+                project_id, resp.status_code)
+
+        result = resp.json()
+        with self.model.images.get(result["id"]) as image_model:
+            if not image_model:
+                image_model = ImageState(id=result["id"], name=result["name"])
+            image_model.is_locked = True
+            image_model.lease_token = result["token"]
+            self.model.images.add(result["id"], image_model)
+            self._leased.add(result["id"])
+        return result["id"]
+
+    def renew_leases(self):
+        """
+        Renew the leases on every image locked by this client, so they aren't claimed by other clients.
+        Images whose lease has been lost are marked as unlocked.
+        """
+        for iid in list(self._leased):
+            with self.model.images.get(iid) as image:
+                if image is None or image.lease_token is None:
+                    self._leased.discard(iid)
+                    continue
+                resp = utils.renew_image_lease(iid, image.lease_token)
+                if resp.status_code == 409:
+                    print("Controller: Lost the lease on image %d" % iid)
+                    self._leased.discard(iid)
+                    image.lease_token = None
+                    image.is_locked = False
+                    self.model.images.add(iid, image)
+                elif resp.status_code != 200:
+                    raise ApiException(
+                        "Failed to renew the lease on the image with id %d." %
+                        iid, resp.status_code)
+
+    def release_lease(self, image_model):
+        """
+        Release the lease on an image, unlocking it. A lease which has been lost to another client is
+        left alone, so its new holder keeps the image locked.
+        :param image_model: The ImageState of the image, which is marked as unlocked
+        """
+        iid = image_model.id
+        if image_model.lease_token is not None:
+            resp = utils.release_image_lease(iid, image_model.lease_token)
+            if resp.status_code == 409:
+                print("Controller: Lost the lease on image %d" % iid)
+            elif resp.status_code != 200:
+                msg = "Failed to unlock the image with id %d." % iid
+                raise ApiException(message=msg, code=resp.status_code)
+        self._leased.discard(iid)
+        image_model.lease_token = None
+        image_model.is_locked = False
+
     def fetch_class_labels(self, project_id):
         """
         Fetch the class labels for this project.
@@ -172,39 +241,56 @@ class InstanceAnnotatorController:
                     "Image Canvas points to image id %d, which is not valid." %
                     iid)
 
-            # Build annotations
+            # Build annotations, keeping the saved state of layers which haven't changed
             annotations = {}
-            i = 0
             pw = image_canvas.painter.paint_window
+            painted = pw.take_dirty_layers()
             for name in pw.get_all_names():
                 if not name:
                     continue
                 box = pw.get_bound(name)
-                mat = pw.get_mask(name).copy()
                 color = pw.get_color(name)
                 class_name = self.model.labels.get_class_name(color)
                 if class_name is None:
                     class_name = self.model.labels.get_default_name()
+
+                saved = image_model.annotations.get(name, None)
+                if saved is not None and not saved.dirty and name not in painted \
+                        and saved.class_name == class_name and np.array_equal(saved.bbox, box):
+                    annotations[name] = saved
+                    continue
+
                 annotation = AnnotationState(annotation_name=name,
                                              class_name=class_name,
-                                             mat=mat,
+                                             mat=pw.get_mask(name).copy(),
                                              bbox=box)
                 annotations[name] = annotation
                 print("CLIENT: outgoing bbox")
                 print("\t%s" % str(box))
 
-            image_model.annotations = annotations
+            changed = [a for a in annotations.values() if a.dirty]
+            deleted = [name for name in image_model.annotations if name not in annotations]
+            if changed or deleted:
+                try:
+                    resp = utils.patch_annotations(iid, changed, deleted)
+                except BaseException:
+                    pw.mark_dirty(painted)
+                    raise
+                if resp.status_code != 200:
+                    pw.mark_dirty(painted)
+                    msg = "Failed to save annotations to the image with id %d." % iid
+                    raise ApiException(message=msg, code=resp.status_code)
 
-            resp = utils.upload_annotations(iid, image_model.annotations)
-            if resp.status_code != 201:
-                msg = "Failed to save annotations to the image with id %d." % iid
-                raise ApiException(message=msg, code=resp.status_code)
+            for annotation in changed:
+                annotation.dirty = False
+            image_model.annotations = annotations
 
-            resp = utils.update_image_meta_by_id(iid, lock=False, labeled=image_model.is_labeled)
+            resp = utils.update_image_meta_by_id(iid, labeled=image_model.is_labeled)
             if resp.status_code != 200:
-                msg = "Failed to unlock the image with id %d." % iid
+                msg = "Failed to update the image with id %d." % iid
                 raise ApiException(message=msg, code=resp.status_code)
 
+            self.release_lease(image_model)
             self.model.images.add(iid, image_model)
             self.update_image_meta(iid, unsaved=False, is_locked=False)
 
@@ -267,12 +353,15 @@ class InstanceAnnotatorController:
 
             if bbox is not None:
                 annotation.bbox = bbox
+                annotation.dirty = True
 
             if texture is not None:
                 annotation.mat = utils.texture2mat(texture)
+                annotation.dirty = True
 
             if label_name is not None:
                 annotation.class_name = label_name
+                annotation.dirty = True
 
             if mask_enabled is not None:
                 annotation.mask_enabled = bool(mask_enabled)
@@ -303,6 +392,9 @@ class InstanceAnnotatorController:
             if is_locked is not None:
                 diff = diff or image.is_locked is not is_locked
                 image.is_locked = is_locked
+                if not is_locked:
+                    image.lease_token = None
+                    self._leased.discard(iid)
 
             if is_labeled is not None:
                 diff = diff or image.is_labeled is not is_labeled
@@ -183,13 +183,16 @@ class ImageState:
                  is_labeled=False,
                  unsaved=False,
                  image=None,
-                 annotations=None):
+                 annotations=None,
+                 lease_token=None):
         self.id = id
         self.name = name
         self.unsaved = unsaved
         self.is_open = is_open
         self.is_locked = is_locked
         self.is_labeled = is_labeled
+        # The token of the lease on the image while it is locked by this client
+        self.lease_token = lease_token
 
         # State for opened images, should be none if unopened
         self.image = image
@@ -220,13 +223,15 @@ class AnnotationState:
             mat,
             bbox,
             mask_enabled=True,
-            bbox_enabled=True):
+            bbox_enabled=True,
+            dirty=True):
         self.annotation_name = annotation_name
         self.class_name = class_name
         self.mat = mat  # A RGB mat with 1,1,1 at labeled locations and 0,0,0 otherwise
         self.bbox = bbox  # (x1, y1, w, h)
         self.mask_enabled = mask_enabled
         self.bbox_enabled = bbox_enabled
+        self.dirty = dirty  # Whether the annotation has changed since it was last saved to the server
 
     def collision(self, pos):
         """
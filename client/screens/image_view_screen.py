@@ -47,22 +47,14 @@ class ImageViewScreen(Screen):
                 resp.status_code)
 
         result = resp.json()
-        resp = utils.get_images_by_ids(result["ids"], image_data=True, max_dim=ClientConfig.TILE_MAX_DIM)
-        result = resp.json()
-
-        for iid in result["ids"]:
-            resp = utils.download_image(iid)
-            if resp.status_code != 200:
-                raise ApiException(
-                    "Failed to load image with id %d from server." % iid,
-                    resp.status_code)
-
-            img = utils.decode_image(row["image_data"])
-            self.add_thumbnail(img)
+        for meta, img in utils.stream_images_by_ids(result["ids"], max_dim=ClientConfig.TILE_MAX_DIM):
+            if not img:
+                continue
+            self.add_thumbnail(img, meta["ext"].lstrip("."))
 
     @mainthread
-    def add_thumbnail(self, image):
-        img = utils.bytes2texture(image, "jpg")
+    def add_thumbnail(self, image, ext):
+        img = utils.bytes2texture(image, ext)
         thumbnail = Thumbnail()
         thumbnail.cust_texture = img
         self.tile_view.add_widget(thumbnail)
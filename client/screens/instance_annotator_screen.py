@@ -3,7 +3,7 @@ from threading import Lock
 
 import kivy.utils
 from kivy.app import App
-from kivy.clock import mainthread
+from kivy.clock import Clock, mainthread
 from kivy.properties import BooleanProperty
 from kivy.uix.relativelayout import RelativeLayout
 from kivy.uix.screenmanager import Screen
@@ -133,30 +133,34 @@ class InstanceAnnotatorScreen(Screen):
     def on_enter(self, *args):
         self.fetch_image_metas()
         self.fetch_class_labels()
+        self._lease_event = Clock.schedule_interval(self.renew_leases, ClientConfig.LEASE_RENEW_INTERVAL)
+
+    def on_leave(self, *args):
+        self._lease_event.cancel()
 
     @mainthread
     def export(self):
-        utils.export_dataset(self.app.current_project_id)
+        path = utils.ask_export_path()
+        if path:
+            self.export_to(path)
+
+    @background
+    def export_to(self, path):
+        utils.export_dataset(self.app.current_project_id, path)
 
     @background
     def load_next(self):
-        image_ids = self.model.images.keys()
-        current_id = self.model.tool.get_current_image_id()
-        idx = 0
-        if current_id > 0:
-            idx = image_ids.index(current_id)
-            idx += 1
-
-        while True:
-            with self.model.images.get(image_ids[idx]) as image:
-                if not image.is_locked:
-                    break
-                else:
-                    idx += 1
-        next_id = image_ids[idx]
+        next_id = self.controller.claim_next_image(self.app.current_project_id)
+        if next_id is None:
+            print("No unlocked images left to annotate")
+            return
         self.controller.open_image(next_id)
         self.queue_update()
 
+    @background
+    def renew_leases(self, *args):
+        self.controller.renew_leases()
+
     @background
     def load_image(self, id):
         self.controller.open_image(id)
@@ -638,6 +642,7 @@ class ImageCanvas(BoxLayout):
                     new_box = utils.fit_box(a.mat)
                     if not np.all(np.equal(new_box, a.bbox)):
                         a.bbox = new_box
+                        a.dirty = True
                         update_required = True
                 boxes.append(a.bbox)
                 box_vis.append(a.bbox_enabled)
@@ -79,6 +79,9 @@ class PaintWindow(Widget):
         self.inverter = PaintWindow.Inverter(image)
 
         self._bg_buffer = np.zeros(shape=image.shape, dtype=np.uint8)
+        # The layers painted on since they were last saved
+        self._dirty_layers = set()
+        self._dirty_lock = Lock()
         self._layer_manager = LayerManager(image)
         self._action_manager = ActionManager(self._layer_manager)
         self._box_manager = BoxManager(
@@ -114,16 +117,32 @@ class PaintWindow(Widget):
 
     def undo(self):
         self._action_manager.undo()
+        self.mark_dirty([self._layer_manager.get_selected()])
         self.queue_refresh()
 
     def redo(self):
         self._action_manager.redo()
+        self.mark_dirty([self._layer_manager.get_selected()])
         self.queue_refresh()
 
+    def mark_dirty(self, names):
+        with self._dirty_lock:
+            self._dirty_layers.update(name for name in names if name)
+
+    def take_dirty_layers(self):
+        """
+        Gets the names of the layers painted on since this was last called.
+        """
+        with self._dirty_lock:
+            names = self._dirty_layers
+            self._dirty_layers = set()
+        return names
+
     def draw_line(self, point, pen_size, color=None):
         point = self.inverter.invert(point)
         if self._layer_manager.get_selected() is None:
             return
+        self.mark_dirty([self._layer_manager.get_selected()])
         self._action_manager.draw_line(point, pen_size, color)
         self._box_manager.update_box(
             self._layer_manager.get_selected(), point, pen_size)
@@ -132,6 +151,7 @@ class PaintWindow(Widget):
         point = self.inverter.invert(point)
         if self._layer_manager.get_selected() is None:
             return
+        self.mark_dirty([self._layer_manager.get_selected()])
         self._action_manager.fill(point, color)
 
     def detect_collision(self, point):
@@ -38,7 +38,7 @@ class ProjectToolScreen(Screen):
 
     @background
     def _upload_images(self, pid, image_paths):
-        resp = utils.add_project_images(pid, image_paths)
+        resp = utils.upload_project_images(pid, image_paths)
         if resp.status_code == 200:
             result = resp.json()
             msg = []
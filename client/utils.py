@@ -5,7 +5,11 @@ import base64
 import io
 import json
 import os
+import struct
+import time
+import uuid
 import zipfile
+import zlib
 from tkinter import filedialog
 from urllib.request import urlretrieve
 import cv2
@@ -20,6 +24,18 @@ from numba import njit, vectorize, uint8, prange
 from client.client_config import ClientConfig
 from definitions import ROOT_DIR
 
+FRAME_STREAM_MIMETYPE = "application/x-fastannotation-frames"
+FRAME_PREFIX = struct.Struct(">II")
+
+# The mask wire encodings understood by the server, see server.utils.pack_mask for the packed format
+MASK_ENCODING_HEADER = "X-Mask-Encoding"
+MASK_ENCODING_RAW = "raw"
+MASK_ENCODING_PACKED = "packed-v1"
+COMPACT_MASK_EXT = ".mask"
+COMPACT_MASK_MAGIC = b"FAMK"
+COMPACT_MASK_VERSION = 1
+COMPACT_MASK_HEADER = struct.Struct(">4sBIIIIII")
+
 
 class DynamicTable:
     def __init__(self, initial_capacity=10, growth_amount=10):
@@ -173,7 +189,42 @@ def add_project_images(project_id, image_paths):
     return requests.post(url, headers=headers, data=payload)
 
 
-def get_project_images(project_id, filter_details=None):
+def upload_project_images(project_id, image_paths, chunk_size=1024 * 1024):
+    """
+    Uploads images to a project as a streamed multipart/form-data request, so only a small part of
+    one image is held in memory at a time.
+    """
+    if not isinstance(image_paths, list):
+        image_paths = [image_paths]
+
+    boundary = uuid.uuid4().hex
+
+    def body():
+        for path in image_paths:
+            filename = os.path.basename(path).replace('"', '')
+            yield ("--%s\r\n" % boundary).encode('utf-8')
+            yield ('Content-Disposition: form-data; name="images"; filename="%s"\r\n' % filename).encode('utf-8')
+            yield b"Content-Type: application/octet-stream\r\n\r\n"
+            with open(path, "rb") as f:
+                chunk = f.read(chunk_size)
+                while chunk:
+                    yield chunk
+                    chunk = f.read(chunk_size)
+            yield b"\r\n"
+        yield ("--%s--\r\n" % boundary).encode('utf-8')
+
+    url = ClientConfig.SERVER_URL + "projects/" + str(project_id) + "/images/multipart"
+    headers = {"Accept": "application/json",
+               "Content-Type": "multipart/form-data; boundary=%s" % boundary}
+    return requests.post(url, headers=headers, data=body())
+
+
+def get_project_images(project_id, filter_details=None, fields=None, limit=None, after=None):
+    """
+    Gets the images of a project, all at once or a page at a time when a limit or cursor is given.
+    :param fields: An optional list of image fields to return along with the ids, e.g. ["id", "name"]
+    :param after: The cursor given as "next" by the previous page
+    """
     if not filter_details:
         filter_details = {}
 
@@ -182,8 +233,15 @@ def get_project_images(project_id, filter_details=None):
         str(project_id) + "/images"
     headers = {"Accept": "application/json",
                "Content-Type": "application/json"}
+    params = {}
+    if fields:
+        params["fields"] = ",".join(fields)
+    if limit is not None:
+        params["limit"] = limit
+    if after is not None:
+        params["after"] = after
 
-    return requests.get(url, headers=headers, data=payload)
+    return requests.get(url, headers=headers, data=payload, params=params)
 
 
 def get_project_labels(project_id):
@@ -210,6 +268,33 @@ def update_image_meta_by_id(image_id, name=None, lock=None, labeled=None):
     return requests.put(url, headers=headers, data=payload)
 
 
+def claim_next_image(project_id):
+    """
+    Claims the next unlabeled image of a project which no other client holds, under a lease which must be
+    renewed with renew_image_lease before it expires.
+    """
+    url = ClientConfig.SERVER_URL + "projects/" + str(project_id) + "/images/claim"
+    headers = {"Accept": "application/json"}
+    return requests.post(url, headers=headers)
+
+
+def renew_image_lease(image_id, token=None):
+    """
+    Renews the lease on an image held by token, or locks the image under a new lease if token is None.
+    """
+    url = ClientConfig.SERVER_URL + "images/" + str(image_id) + "/lease"
+    headers = {"Accept": "application/json",
+               "Content-Type": "application/json"}
+    return requests.put(url, headers=headers, data=json.dumps({"token": token}))
+
+
+def release_image_lease(image_id, token):
+    url = ClientConfig.SERVER_URL + "images/" + str(image_id) + "/lease"
+    headers = {"Accept": "application/json",
+               "Content-Type": "application/json"}
+    return requests.delete(url, headers=headers, data=json.dumps({"token": token}))
+
+
 def get_image_by_id(image_id):
     url = ClientConfig.SERVER_URL + "images/" + str(image_id)
     headers = {"Accept": "application/json"}
@@ -220,24 +305,57 @@ def get_image_by_id(image_id):
 def download_image(image_id):
     url = ClientConfig.SERVER_URL + "files/image/" + str(image_id)
 
+    status_code, content = conditional_get(url, "image_%d" % image_id)
+    if status_code == 404:
+        raise ApiException(
+            "Image does not exist with id %d." %
+            image_id, status_code)
+    elif status_code != 200:
+        raise ApiException(
+            "Failed to retrieve image with id %d." %
+            image_id, status_code)
+
+    nparr = np.frombuffer(content, np.uint8)
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+
+def get_image_tile_info(image_id):
+    url = ClientConfig.SERVER_URL + "files/image/" + str(image_id) + "/tile"
+    headers = {"Accept": "application/json"}
+    return requests.get(url, headers=headers)
+
+
+def download_image_tile(image_id, level, x, y):
+    """
+    Downloads a single tile of an image's tile pyramid, where level 0 is full resolution.
+    :return: The tile as a mat, using the same channel order as download_image
+    """
+    url = ClientConfig.SERVER_URL + "files/image/%d/tile/%d/%d/%d" % (image_id, level, x, y)
+
     resp = requests.get(url)
     if resp.status_code == 404:
         raise ApiException(
-            "Image does not exist with id %d." %
-            image_id, resp.status_code)
+            "Tile (%d, %d) of level %d does not exist for image with id %d." %
+            (x, y, level, image_id), resp.status_code)
     elif resp.status_code != 200:
         raise ApiException(
-            "Failed to retrieve image with id %d." %
+            "Failed to retrieve tile for image with id %d." %
             image_id, resp.status_code)
 
     nparr = np.frombuffer(resp.content, np.uint8)
-    mat = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    mat = cv2.cvtColor(mat, cv2.COLOR_BGR2RGB)
-    return mat
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
 
-def download_annotations(image_id):
-    url = ClientConfig.SERVER_URL + "files/image/" + str(image_id) + "/annotations"
+def download_image_crop(image_id, bbox, max_dim=None):
+    """
+    Downloads a region of an image.
+    :param bbox: The region in full resolution pixels as (x0, y0, x1, y1), with x1 and y1 exclusive
+    :param max_dim: An optional maximum dimension for the returned region
+    :return: The region as a mat, using the same channel order as download_image
+    """
+    url = ClientConfig.SERVER_URL + "files/image/%d/crop?bbox=%s" % (image_id, ",".join(str(int(v)) for v in bbox))
+    if isinstance(max_dim, int):
+        url += "&max-dim=%d" % max_dim
 
     resp = requests.get(url)
     if resp.status_code == 404:
@@ -246,17 +364,38 @@ def download_annotations(image_id):
             image_id, resp.status_code)
     elif resp.status_code != 200:
         raise ApiException(
-            "Failed to retrieve image with id %d." %
+            "Failed to retrieve region of image with id %d." %
             image_id, resp.status_code)
 
-    z = zipfile.ZipFile(io.BytesIO(resp.content))
+    nparr = np.frombuffer(resp.content, np.uint8)
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+
+def download_annotations(image_id):
+    url = ClientConfig.SERVER_URL + "files/image/" + str(image_id) + "/annotations"
+
+    headers = {MASK_ENCODING_HEADER: ClientConfig.MASK_ENCODING}
+    status_code, content = conditional_get(url, "annotations_%d" % image_id, headers)
+    if status_code == 404:
+        raise ApiException(
+            "Image does not exist with id %d." %
+            image_id, status_code)
+    elif status_code != 200:
+        raise ApiException(
+            "Failed to retrieve image with id %d." %
+            image_id, status_code)
+
+    z = zipfile.ZipFile(io.BytesIO(content))
 
     output = {}
     for filename in z.namelist():
-        annotation_id, _ = os.path.splitext(filename)
-        nparr = np.frombuffer(z.read(filename), np.uint8)
-        mat = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        mat = cv2.cvtColor(mat, cv2.COLOR_BGR2RGB)
+        annotation_id, ext = os.path.splitext(filename)
+        if ext == COMPACT_MASK_EXT:
+            mat = mask2mat(unpack_mask(z.read(filename)))
+        else:
+            nparr = np.frombuffer(z.read(filename), np.uint8)
+            mat = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            mat = cv2.cvtColor(mat, cv2.COLOR_BGR2RGB)
         output[int(annotation_id)] = mat
     return output
 
@@ -279,8 +418,10 @@ def download_annotation(annotation_id):
     return mat
 
 
-def get_images_by_ids(image_ids):
-    url = ClientConfig.SERVER_URL + "images"
+def get_images_by_ids(image_ids, image_data=False, max_dim=None):
+    url = ClientConfig.SERVER_URL + "images?image-data=%s" % str(bool(image_data)).lower()
+    if isinstance(max_dim, int):
+        url += "&max-dim=%d" % max_dim
     headers = {"Accept": "application/json",
                "Content-Type": "application/json"}
     body = {"ids": image_ids}
@@ -290,15 +431,46 @@ def get_images_by_ids(image_ids):
     return requests.get(url, headers=headers, data=payload)
 
 
+def stream_images_by_ids(image_ids, max_dim=None):
+    """
+    Streams images by id, yielding each image as soon as it has been received.
+    :param image_ids: A list of image ids
+    :param max_dim: An optional maximum dimension for the returned images
+    :return: A generator of (meta, image_bytes) tuples, where meta is a dict of image meta information
+    """
+    url = ClientConfig.SERVER_URL + "images/stream"
+    if isinstance(max_dim, int):
+        url += "?max-dim=%d" % max_dim
+    headers = {"Accept": FRAME_STREAM_MIMETYPE,
+               "Content-Type": "application/json"}
+    payload = json.dumps({"ids": image_ids})
+
+    with requests.get(url, headers=headers, data=payload, stream=True) as resp:
+        if resp.status_code != 200:
+            raise ApiException(
+                "Failed to stream images from server.",
+                resp.status_code)
+
+        stream = resp.raw
+        while True:
+            prefix = _read_exactly(stream, FRAME_PREFIX.size)
+            if not prefix:
+                break
+            header_length, data_length = FRAME_PREFIX.unpack(prefix)
+            meta = json.loads(_read_exactly(stream, header_length).decode('utf-8'))
+            yield meta, _read_exactly(stream, data_length)
+
+
 def add_image_annotation(image_id, annotations):
     url = ClientConfig.SERVER_URL + "images/" + str(image_id) + "/annotation"
     headers = {"Accept": "application/json",
                "Content-Type": "application/json"}
+    headers[MASK_ENCODING_HEADER] = ClientConfig.MASK_ENCODING
     payload = {"image_id": image_id, "annotations": []}
     for annotation in annotations.values():
         body = {
             'name': annotation.annotation_name,
-            'mask_data': encode_mask(mat2mask(annotation.mat)),
+            'mask_data': encode_mask(mat2mask(annotation.mat), ClientConfig.MASK_ENCODING),
             'bbox': np.array(annotation.bbox).tolist(),
             'class_name': annotation.class_name,
             'shape': annotation.mat.shape}
@@ -312,25 +484,44 @@ def add_image_annotation(image_id, annotations):
 import zipfile
 def upload_annotations(image_id, annotations, ext='.png'):
     url = ClientConfig.SERVER_URL + "files/image/" + str(image_id) + "/annotations"
+    headers = {MASK_ENCODING_HEADER: ClientConfig.MASK_ENCODING}
+    data, payload = _build_annotation_upload(image_id, annotations.values(), ext)
+    return requests.post(url, headers=headers, files={'file': data, 'info': json.dumps(payload).encode('utf-8')})
+
+
+def patch_annotations(image_id, changed, deleted, ext='.png'):
+    """
+    Uploads only the annotations of an image which have changed since it was last saved.
+    :param changed: An iterable of the AnnotationStates created or modified
+    :param deleted: An iterable of the names of the annotations deleted
+    """
+    url = ClientConfig.SERVER_URL + "files/image/" + str(image_id) + "/annotations"
+    headers = {MASK_ENCODING_HEADER: ClientConfig.MASK_ENCODING}
+    data, payload = _build_annotation_upload(image_id, changed, ext)
+    payload["deleted"] = list(deleted)
+    return requests.patch(url, headers=headers, files={'file': data, 'info': json.dumps(payload).encode('utf-8')})
+
+
+def _build_annotation_upload(image_id, annotations, ext):
+    annotations = list(annotations)
     data = io.BytesIO()
     with zipfile.ZipFile(data, mode='w') as z:
-        for annotation in annotations.values():
-            img_bytes = mat2bytes(annotation.mat, ext)
-            z.writestr(annotation.annotation_name + ext, img_bytes)
+        for annotation in annotations:
+            if ClientConfig.MASK_ENCODING == MASK_ENCODING_PACKED:
+                z.writestr(annotation.annotation_name + COMPACT_MASK_EXT, pack_mask(mat2mask(annotation.mat)))
+            else:
+                z.writestr(annotation.annotation_name + ext, mat2bytes(annotation.mat, ext))
     data.seek(0)
 
     payload = {"image_id": image_id, "annotations": []}
-    for annotation in annotations.values():
+    for annotation in annotations:
         body = {
             'name': annotation.annotation_name,
             'bbox': np.array(annotation.bbox).tolist(),
             'class_name': annotation.class_name,
             'shape': annotation.mat.shape}
         payload["annotations"].append(body)
-
-    payload = json.dumps(payload).encode('utf-8')
-
-    return requests.post(url, files={'file': data, 'info': payload})
+    return data, payload
 
 
 def delete_image_annotation(image_id, on_success=None, on_fail=None):
@@ -346,20 +537,135 @@ def get_image_annotation(image_id, max_dim=None, on_success=None, on_fail=None):
     return requests.get(url, headers=headers)
 
 
-def export_dataset(project_id):
-    url = ClientConfig.SERVER_URL + "projects/" + str(project_id) + "/dataset"
-    directory = filedialog.asksaveasfilename(title="Export dataset as zip",
-                                             initialdir=ROOT_DIR,
-                                             filetypes=[("ZIP Files", "*.zip")],
-                                             defaultextension=".zip")
-    if directory is None:
-        return
-    return urlretrieve(url, directory)
+def submit_job(job_type, project_id=None, params=None):
+    url = ClientConfig.SERVER_URL + "jobs"
+    headers = {"Accept": "application/json", "Content-Type": "application/json"}
+    payload = {"type": job_type, "params": params or {}}
+    if project_id is not None:
+        payload["project_id"] = project_id
+    return requests.post(url, headers=headers, data=json.dumps(payload))
+
+
+def get_job(job_id):
+    url = ClientConfig.SERVER_URL + "jobs/" + str(job_id)
+    headers = {"Accept": "application/json"}
+    return requests.get(url, headers=headers)
+
+
+def cancel_job(job_id):
+    url = ClientConfig.SERVER_URL + "jobs/" + str(job_id)
+    return requests.delete(url)
+
+
+def wait_for_job(job_id, on_progress=None):
+    """
+    Polls a job until it finishes.
+    :param on_progress: An optional callable taking the fraction of the job which is complete
+    :return: The finished job
+    """
+    while True:
+        resp = get_job(job_id)
+        if resp.status_code != 200:
+            raise ApiException("Failed to get the status of job %d." % job_id, resp.status_code)
+        job = resp.json()
+        if on_progress is not None:
+            on_progress(job.get("progress", 0))
+        if job["status"] in ("succeeded", "failed", "cancelled"):
+            return job
+        time.sleep(ClientConfig.JOB_POLL_INTERVAL)
+
+
+def download_job_result(job_id, path):
+    url = ClientConfig.SERVER_URL + "jobs/" + str(job_id) + "/result"
+    return urlretrieve(url, path)
+
+
+def get_job_shards(job_id):
+    url = ClientConfig.SERVER_URL + "jobs/" + str(job_id) + "/shards"
+    headers = {"Accept": "application/json"}
+    return requests.get(url, headers=headers)
+
+
+def download_job_shard(job_id, shard, path):
+    url = ClientConfig.SERVER_URL + "jobs/%d/shards/%d" % (job_id, shard)
+    return urlretrieve(url, path)
+
+
+def ask_export_path():
+    return filedialog.asksaveasfilename(title="Export dataset as zip",
+                                        initialdir=ROOT_DIR,
+                                        filetypes=[("ZIP Files", "*.zip")],
+                                        defaultextension=".zip")
+
+
+def export_dataset(project_id, path, on_progress=None, since=None):
+    """
+    Exports a project with a background job on the server, downloading the zip to path once it is ready.
+    The server only updates what changed since its last export of the project.
+    :param since: An optional export id, limiting the zip to the changes made after that export
+    """
+    params = {"incremental": True}
+    if since is not None:
+        params["since"] = since
+    resp = submit_job("export_dataset", project_id, params)
+    if resp.status_code != 202:
+        raise ApiException("Failed to start exporting project %d." % project_id, resp.status_code)
+    job_id = resp.json()["id"]
+
+    job = wait_for_job(job_id, on_progress)
+    if job["status"] != "succeeded":
+        raise ApiException(
+            "Exporting project %d %s: %s" % (project_id, job["status"], job.get("error", "")), 200)
+    result = download_job_result(job_id, path)
+    cancel_job(job_id)
+    return result
 
 # ======================
 # === Helper methods ===
 # ======================
 
+def conditional_get(url, cache_name, headers=None):
+    """
+    Performs a GET request, reusing a previously downloaded copy if the server reports it is unchanged.
+    :param url: The url of the resource
+    :param cache_name: A unique file name for the local copy of the resource
+    :param headers: Any additional request headers
+    :return: A tuple of (status_code, content)
+    """
+    data_path = os.path.join(ClientConfig.DOWNLOAD_CACHE_DIR, cache_name)
+    etag_path = data_path + ".etag"
+
+    headers = dict(headers or {})
+    if os.path.isfile(data_path) and os.path.isfile(etag_path):
+        with open(etag_path, 'r') as f:
+            headers["If-None-Match"] = f.read()
+
+    resp = requests.get(url, headers=headers)
+    if resp.status_code == 304:
+        with open(data_path, 'rb') as f:
+            return 200, f.read()
+
+    if resp.status_code == 200 and "ETag" in resp.headers:
+        os.makedirs(ClientConfig.DOWNLOAD_CACHE_DIR, exist_ok=True)
+        with open(data_path, 'wb') as f:
+            f.write(resp.content)
+        with open(etag_path, 'w') as f:
+            f.write(resp.headers["ETag"])
+    return resp.status_code, resp.content
+
+
+def _read_exactly(stream, n):
+    buf = b""
+    while len(buf) < n:
+        chunk = stream.read(n - len(buf))
+        if not chunk:
+            if buf:
+                raise ApiException("Image stream ended unexpectedly.", 200)
+            break
+        buf += chunk
+    return buf
+
+
 def encode_image(img_path):
     with open(img_path, "rb") as img_file:
         encoded_image = base64.b64encode(img_file.read())
@@ -372,18 +678,53 @@ def decode_image(b64_str):
 
 
 # Takes Boolean mask -> bytes
-def encode_mask(mask):
-    encoded_mask = base64.b64encode(mask.tobytes(order='C'))
+def encode_mask(mask, encoding=MASK_ENCODING_RAW):
+    if encoding == MASK_ENCODING_PACKED:
+        mask_bytes = pack_mask(mask)
+    else:
+        mask_bytes = mask.tobytes(order='C')
+    encoded_mask = base64.b64encode(mask_bytes)
     return encoded_mask.decode('utf-8')
 
 
 # Takes bytes -> Boolean Mask
-def decode_mask(b64_str, shape):
+def decode_mask(b64_str, shape, encoding=MASK_ENCODING_RAW):
     mask_bytes = base64.b64decode(b64_str.encode("utf-8"))
+    if encoding == MASK_ENCODING_PACKED:
+        return unpack_mask(mask_bytes)
     flat = np.fromstring(mask_bytes, bool)
     return np.reshape(flat, newshape=shape[:2], order='C')
 
 
+def pack_mask(mask):
+    """
+    Encodes a boolean mask as its bounding box, bit packed and deflated, behind a header giving the
+    full shape and the box.
+    """
+    height, width = mask.shape[:2]
+    cols = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+    if cols.size == 0:
+        x = y = w = h = 0
+        bits = b""
+    else:
+        x, y = int(cols[0]), int(rows[0])
+        w, h = int(cols[-1]) - x + 1, int(rows[-1]) - y + 1
+        bits = np.packbits(mask[y:y + h, x:x + w]).tobytes()
+    header = COMPACT_MASK_HEADER.pack(COMPACT_MASK_MAGIC, COMPACT_MASK_VERSION, height, width, x, y, w, h)
+    return header + zlib.compress(bits, 1)
+
+
+def unpack_mask(data):
+    magic, version, height, width, x, y, w, h = COMPACT_MASK_HEADER.unpack_from(data)
+    if magic != COMPACT_MASK_MAGIC or version != COMPACT_MASK_VERSION:
+        raise ValueError("Unsupported mask format.")
+    bits = np.frombuffer(zlib.decompress(data[COMPACT_MASK_HEADER.size:]), np.uint8)
+    mask = np.zeros((height, width), dtype=bool)
+    mask[y:y + h, x:x + w] = np.unpackbits(bits, count=w * h).reshape((h, w)).astype(bool)
+    return mask
+
+
 def mask2mat(mask):
     mat = mask.astype(np.uint8) * 255
     return cv2.cvtColor(mat, cv2.COLOR_GRAY2RGB)
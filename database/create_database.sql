@@ -30,13 +30,39 @@ CREATE TABLE `image` (
   `image_ext` varchar(10) NOT NULL,
   `is_locked` bit(1) NOT NULL DEFAULT b'0',
   `is_labeled` bit(1) NOT NULL DEFAULT b'0',
+  `lease_token` char(32) DEFAULT NULL,
+  `lease_expires` datetime DEFAULT NULL,
+  `revision` int NOT NULL DEFAULT '1',
+  `width` int DEFAULT NULL,
+  `height` int DEFAULT NULL,
+  `depth` int DEFAULT NULL,
+  `is_swapped` bit(1) NOT NULL DEFAULT b'0',
+  `blob_hash` char(64) DEFAULT NULL,
   PRIMARY KEY (`image_id`),
   UNIQUE KEY `image_id_UNIQUE` (`image_id`),
-  UNIQUE KEY `image_path_UNIQUE` (`image_path`),
+  UNIQUE KEY `image_name_UNIQUE` (`project_fid`, `image_name`, `image_ext`),
   KEY `project_id_idx` (`project_fid`),
+  KEY `project_name_idx` (`project_fid`, `image_name`),
+  KEY `project_state_idx` (`project_fid`, `is_labeled`, `is_locked`),
+  KEY `project_state_name_idx` (`project_fid`, `is_labeled`, `is_locked`, `image_name`),
+  KEY `blob_hash_idx` (`blob_hash`),
   CONSTRAINT `project_id` FOREIGN KEY (`project_fid`) REFERENCES `project` (`project_id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=428 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
+--
+-- Table structure for table `image_blob`
+--
+
+DROP TABLE IF EXISTS `image_blob`;
+CREATE TABLE `image_blob` (
+  `blob_hash` char(64) NOT NULL,
+  `blob_path` varchar(260) NOT NULL,
+  `blob_ext` varchar(10) NOT NULL,
+  `blob_size` bigint NOT NULL,
+  `ref_count` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`blob_hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
 --
 -- Table structure for table `instance_seg_meta`
 --
@@ -47,13 +73,19 @@ CREATE TABLE `instance_seg_meta` (
   `image_id` int NOT NULL,
   `annotation_name` varchar(45) NOT NULL,
   `mask_path` varchar(260) NOT NULL,
-  `info_path` varchar(260) NOT NULL,
+  `info_path` varchar(260) DEFAULT NULL,
   `class_name` varchar(45) NOT NULL,
+  `source_height` int DEFAULT NULL,
+  `source_width` int DEFAULT NULL,
+  `source_depth` int DEFAULT NULL,
+  `bbox_x` int DEFAULT NULL,
+  `bbox_y` int DEFAULT NULL,
+  `bbox_w` int DEFAULT NULL,
+  `bbox_h` int DEFAULT NULL,
+  `revision` int NOT NULL DEFAULT '1',
   PRIMARY KEY (`annotation_id`),
-  UNIQUE KEY `mask_path_UNIQUE` (`mask_path`),
-  UNIQUE KEY `info_path_UNIQUE` (`info_path`),
-  UNIQUE KEY `annotation_id_UNIQUE` (`annotation_id`),
-  KEY `image_fid_idx` (`image_id`),
+  UNIQUE KEY `annotation_name_UNIQUE` (`image_id`, `annotation_name`),
+  KEY `image_class_idx` (`image_id`, `class_name`),
   CONSTRAINT `image_fid` FOREIGN KEY (`image_id`) REFERENCES `image` (`image_id`)
 ) ENGINE=InnoDB AUTO_INCREMENT=137 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
@@ -74,4 +106,28 @@ CREATE TABLE `instance_seg_labels` (
   UNIQUE KEY `label_id_UNIQUE` (`label_id`),
   KEY `project_fid_idx` (`project_fid`),
   CONSTRAINT `project_label_FKEY` FOREIGN KEY (`project_fid`) REFERENCES `project` (`project_id`)
-) ENGINE=InnoDB AUTO_INCREMENT=8 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
\ No newline at end of file
+) ENGINE=InnoDB AUTO_INCREMENT=8 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+--
+-- Table structure for table `job`
+--
+
+DROP TABLE IF EXISTS `job`;
+CREATE TABLE `job` (
+  `job_id` int NOT NULL AUTO_INCREMENT,
+  `job_type` varchar(45) NOT NULL,
+  `project_fid` int DEFAULT NULL,
+  `job_params` text,
+  `job_status` enum('queued','running','succeeded','failed','cancelled') NOT NULL DEFAULT 'queued',
+  `progress` float NOT NULL DEFAULT '0',
+  `result_path` varchar(260) DEFAULT NULL,
+  `error_message` text,
+  `is_cancel_requested` bit(1) NOT NULL DEFAULT b'0',
+  `worker_id` varchar(80) DEFAULT NULL,
+  `heartbeat` datetime DEFAULT NULL,
+  `created` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `started` datetime DEFAULT NULL,
+  `finished` datetime DEFAULT NULL,
+  PRIMARY KEY (`job_id`),
+  KEY `job_status_idx` (`job_status`, `job_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
\ No newline at end of file
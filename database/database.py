@@ -1,6 +1,10 @@
 import mysql.connector
-from mysql.connector import pooling
+import threading
+from collections import deque
+from contextlib import contextmanager
+from mysql.connector.errors import Error
 from mysql.connector.errors import InterfaceError
+from mysql.connector.errors import OperationalError
 from mysql.connector.errors import PoolError
 
 import time
@@ -18,27 +22,70 @@ class Database:
             'time_zone': self.config.DATABASE_TIMEZONE
         }
 
-        self.db_pool = mysql.connector.pooling.MySQLConnectionPool(
-            pool_name="db_pool", pool_size=self.config.DATABASE_POOL_SIZE, **self.db_config)
+        self.db_pool = ConnectionPool(
+            self.config.DATABASE_POOL_SIZE, self.config.DATABASE_VALIDATE_AFTER, **self.db_config)
+
+    @contextmanager
+    def connection(self, timeout=3):
+        """
+        Borrows a connection from the pool for the duration of the block.
+        Connections which fail while in use are closed rather than returned to the pool.
+        """
+        connection = self.db_pool.acquire(timeout)
+        discard = False
+        try:
+            yield connection
+        except (InterfaceError, OperationalError):
+            discard = True
+            raise
+        finally:
+            self.db_pool.release(connection, discard)
 
     def query(self, query_string, params=None, timeout=3):
-        t0 = time.time()
-        t1 = t0
+        with self.connection(timeout) as connection:
+            return Transaction(connection).query(query_string, params)
+
+    def executemany(self, query_string, seq_params, timeout=3):
+        """
+        Runs a statement once for each set of params. Inserts are sent as a single multi row statement.
+        :return: A tuple of (rowcount, lastrowid)
+        """
+        with self.connection(timeout) as connection:
+            return Transaction(connection).executemany(query_string, seq_params)
+
+    @contextmanager
+    def transaction(self, timeout=3):
+        """
+        Runs statements on a single connection as one transaction, which is committed when the block
+        exits and rolled back if it raises.
 
-        connection = None
-        while (t1 - t0) < timeout:
-            t1 = time.time()
+            with db.transaction() as t:
+                t.query(...)
+                t.executemany(...)
+        """
+        with self.connection(timeout) as connection:
             try:
-                connection = self.db_pool.get_connection()
-            except PoolError:
-                print("Retrying Connection..")
-                time.sleep(1)
-                continue
-            else:
-                break
-        print("Connection Made")
-
-        cursor = connection.cursor(dictionary=True)
+                connection.start_transaction()
+                yield Transaction(connection)
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+
+    def get_stats(self):
+        return self.db_pool.get_stats()
+
+
+class Transaction:
+    """
+    Runs statements on a connection held by Database.transaction.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def query(self, query_string, params=None):
+        cursor = self.connection.cursor(dictionary=True)
         try:
             cursor.execute(query_string, params)
             try:
@@ -48,5 +95,146 @@ class Database:
             id = cursor.lastrowid
         finally:
             cursor.close()
-            connection.close()
         return result, id
+
+    def executemany(self, query_string, seq_params):
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany(query_string, seq_params)
+            return cursor.rowcount, cursor.lastrowid
+        finally:
+            cursor.close()
+
+
+class ConnectionPool:
+    """
+    A fixed size pool of MySQL connections, opened as they are first needed.
+
+    Threads wanting a connection while every one is in use wait on a condition until one is returned
+    or their timeout expires. Connections which have been idle for validate_after seconds are pinged
+    before being handed out, and reconnected if the server has dropped them.
+    """
+
+    # The upper bounds in seconds of the buckets of the wait time histogram
+    WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, size, validate_after=30.0, **db_config):
+        self.size = max(1, int(size))
+        self.validate_after = validate_after
+        self.db_config = db_config
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._opened = 0
+        self._in_use = 0
+        self._waiters = 0
+
+        self._acquired = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._wait_total = 0.0
+        self._wait_counts = [0] * (len(self.WAIT_BUCKETS) + 1)
+
+    def acquire(self, timeout):
+        """
+        Takes a connection from the pool, opening a new one if the pool isn't full yet.
+        :raises PoolError: If no connection became available within timeout seconds
+        """
+        t0 = time.monotonic()
+        deadline = t0 + timeout
+        with self._cond:
+            self._waiters += 1
+            try:
+                while not self._idle and self._opened >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolError("No database connection became available within %s seconds." % timeout)
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                else:
+                    connection, last_used = None, None
+                    self._opened += 1
+                self._in_use += 1
+            finally:
+                self._waiters -= 1
+            self._record_wait(time.monotonic() - t0)
+
+        try:
+            if connection is None:
+                connection = mysql.connector.connect(**self.db_config)
+            elif time.monotonic() - last_used > self.validate_after:
+                self._validate(connection)
+        except BaseException:
+            self._forget()
+            raise
+        return connection
+
+    def release(self, connection, discard=False):
+        """
+        Returns a connection to the pool. Discarded connections are closed and replaced on demand.
+        """
+        if not discard:
+            try:
+                if connection.in_transaction:
+                    connection.rollback()
+            except Error:
+                discard = True
+
+        if discard:
+            try:
+                connection.close()
+            except Error:
+                pass
+            self._forget()
+            return
+
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._in_use -= 1
+            self._cond.notify()
+
+    def get_stats(self):
+        with self._cond:
+            cumulative = 0
+            histogram = {}
+            for bound, count in zip(self.WAIT_BUCKETS + ("+Inf",), self._wait_counts):
+                cumulative += count
+                histogram[str(bound)] = cumulative
+            return {
+                "size": self.size,
+                "open": self._opened,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiters": self._waiters,
+                "acquired": self._acquired,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+                "wait_seconds_total": self._wait_total,
+                "wait_seconds_histogram": histogram
+            }
+
+    def _validate(self, connection):
+        try:
+            connection.ping(reconnect=False)
+        except Error:
+            with self._cond:
+                self._reconnects += 1
+            connection.reconnect(attempts=1)
+
+    def _forget(self):
+        with self._cond:
+            self._opened -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _record_wait(self, seconds):
+        self._acquired += 1
+        self._wait_total += seconds
+        for i, bound in enumerate(self.WAIT_BUCKETS):
+            if seconds <= bound:
+                self._wait_counts[i] += 1
+                return
+        self._wait_counts[-1] += 1
@@ -0,0 +1,9 @@
+-- Adds the revision counters used to build ETags for image and annotation downloads.
+-- Run against an existing database created by an older create_database.sql
+USE `fadb`;
+
+ALTER TABLE `image`
+  ADD COLUMN `revision` int NOT NULL DEFAULT '1';
+
+ALTER TABLE `instance_seg_meta`
+  ADD COLUMN `revision` int NOT NULL DEFAULT '1';
@@ -0,0 +1,11 @@
+-- Records the dimensions of stored images, and flags images written by older servers which stored
+-- them with their red and blue channels swapped. Revisions are bumped so cached copies are refreshed.
+USE `fadb`;
+
+ALTER TABLE `image`
+  ADD COLUMN `width` int DEFAULT NULL,
+  ADD COLUMN `height` int DEFAULT NULL,
+  ADD COLUMN `depth` int DEFAULT NULL,
+  ADD COLUMN `is_swapped` bit(1) NOT NULL DEFAULT b'0';
+
+UPDATE `image` SET `is_swapped` = b'1', `revision` = `revision` + 1;
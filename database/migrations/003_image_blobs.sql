@@ -0,0 +1,18 @@
+-- Adds the content addressed image store. Existing images keep their current files and have no blob.
+-- Image paths may now be shared, so uniqueness moves to the image name within a project.
+USE `fadb`;
+
+CREATE TABLE `image_blob` (
+  `blob_hash` char(64) NOT NULL,
+  `blob_path` varchar(260) NOT NULL,
+  `blob_ext` varchar(10) NOT NULL,
+  `blob_size` bigint NOT NULL,
+  `ref_count` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`blob_hash`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+ALTER TABLE `image`
+  ADD COLUMN `blob_hash` char(64) DEFAULT NULL,
+  ADD KEY `blob_hash_idx` (`blob_hash`),
+  ADD UNIQUE KEY `image_name_UNIQUE` (`project_fid`, `image_name`, `image_ext`),
+  DROP INDEX `image_path_UNIQUE`;
@@ -0,0 +1,21 @@
+-- Adds the table backing the background job queue.
+USE `fadb`;
+
+CREATE TABLE `job` (
+  `job_id` int NOT NULL AUTO_INCREMENT,
+  `job_type` varchar(45) NOT NULL,
+  `project_fid` int DEFAULT NULL,
+  `job_params` text,
+  `job_status` enum('queued','running','succeeded','failed','cancelled') NOT NULL DEFAULT 'queued',
+  `progress` float NOT NULL DEFAULT '0',
+  `result_path` varchar(260) DEFAULT NULL,
+  `error_message` text,
+  `is_cancel_requested` bit(1) NOT NULL DEFAULT b'0',
+  `worker_id` varchar(80) DEFAULT NULL,
+  `heartbeat` datetime DEFAULT NULL,
+  `created` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `started` datetime DEFAULT NULL,
+  `finished` datetime DEFAULT NULL,
+  PRIMARY KEY (`job_id`),
+  KEY `job_status_idx` (`job_status`, `job_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
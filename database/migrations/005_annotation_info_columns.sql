@@ -0,0 +1,20 @@
+-- Moves the size and bounding box of annotations from xml files into the database.
+-- Annotations saved before this keep their info_path and are copied into the new columns the first
+-- time they are read, after which the xml file is deleted.
+-- Annotation names are unique within an image, which replaces the unique indexes on the file paths.
+USE `fadb`;
+
+ALTER TABLE `instance_seg_meta`
+  MODIFY COLUMN `info_path` varchar(260) DEFAULT NULL,
+  ADD COLUMN `source_height` int DEFAULT NULL AFTER `class_name`,
+  ADD COLUMN `source_width` int DEFAULT NULL AFTER `source_height`,
+  ADD COLUMN `source_depth` int DEFAULT NULL AFTER `source_width`,
+  ADD COLUMN `bbox_x` int DEFAULT NULL AFTER `source_depth`,
+  ADD COLUMN `bbox_y` int DEFAULT NULL AFTER `bbox_x`,
+  ADD COLUMN `bbox_w` int DEFAULT NULL AFTER `bbox_y`,
+  ADD COLUMN `bbox_h` int DEFAULT NULL AFTER `bbox_w`,
+  ADD UNIQUE KEY `annotation_name_UNIQUE` (`image_id`, `annotation_name`),
+  DROP INDEX `mask_path_UNIQUE`,
+  DROP INDEX `info_path_UNIQUE`,
+  DROP INDEX `annotation_id_UNIQUE`,
+  DROP INDEX `image_fid_idx`;
@@ -0,0 +1,15 @@
+-- Indexes the state of images and the classes of annotations, so the statistics of a project are read
+-- from the indexes alone. The state index replaces project_id_idx, which is a prefix of it.
+-- The image counts of each project are recounted, as older servers let them drift.
+USE `fadb`;
+
+ALTER TABLE `image`
+  ADD KEY `project_state_idx` (`project_fid`, `is_labeled`, `is_locked`),
+  DROP INDEX `project_id_idx`;
+
+ALTER TABLE `instance_seg_meta`
+  ADD KEY `image_class_idx` (`image_id`, `class_name`);
+
+UPDATE `project` p SET
+  p.`labeled_count` = (SELECT COUNT(*) FROM `image` i WHERE i.`project_fid` = p.`project_id` AND i.`is_labeled` = 1),
+  p.`unlabeled_count` = (SELECT COUNT(*) FROM `image` i WHERE i.`project_fid` = p.`project_id` AND i.`is_labeled` = 0);
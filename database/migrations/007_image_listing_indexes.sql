@@ -0,0 +1,13 @@
+-- Indexes the orders images are listed in, so a page of a listing is read from an index in order rather
+-- than by sorting every image of the project. InnoDB appends image_id to each index, which breaks ties.
+--   project_id_idx          unfiltered, by id (restored, as project_state_idx sorts by state first)
+--   project_name_idx        unfiltered, by name
+--   project_state_idx       by labeled and locked state, by id
+--   project_state_name_idx  by labeled and locked state, by name
+-- Run server/perf_image_listing.py against the database to check the plans use them.
+USE `fadb`;
+
+ALTER TABLE `image`
+  ADD KEY `project_id_idx` (`project_fid`),
+  ADD KEY `project_name_idx` (`project_fid`, `image_name`),
+  ADD KEY `project_state_name_idx` (`project_fid`, `is_labeled`, `is_locked`, `image_name`);
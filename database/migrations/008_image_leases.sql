@@ -0,0 +1,10 @@
+-- Locks on images are held under leases which expire unless renewed, so images locked by clients which
+-- crashed are claimed again. Images locked before this are given a fresh lease, after which they expire
+-- like any other.
+USE `fadb`;
+
+ALTER TABLE `image`
+  ADD COLUMN `lease_token` char(32) DEFAULT NULL AFTER `is_labeled`,
+  ADD COLUMN `lease_expires` datetime DEFAULT NULL AFTER `lease_token`;
+
+UPDATE `image` SET `lease_expires` = NOW() + INTERVAL 300 SECOND WHERE `is_locked` = 1;
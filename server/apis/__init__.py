@@ -3,6 +3,8 @@ from flask_restplus import Api
 from .project import api as project_api
 from .image import api as image_api
 from .files import api as files_api
+from .job import api as job_api
+from .stats import api as stats_api
 
 api = Api(
     title='FastAnnotation API',
@@ -12,4 +14,6 @@ api = Api(
 
 api.add_namespace(project_api)
 api.add_namespace(image_api)
-api.add_namespace(files_api)
\ No newline at end of file
+api.add_namespace(files_api)
+api.add_namespace(job_api)
+api.add_namespace(stats_api)
\ No newline at end of file
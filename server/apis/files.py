@@ -1,14 +1,20 @@
+import hashlib
 import io
+import mimetypes
 import os
 import zipfile
 
-from flask import send_file
+from flask import send_file, Response
 from flask_restplus import Namespace, Resource
 from flask import request
 
 from mysql.connector.errors import DatabaseError
 
+import server.core.annotation_store as annotation_store
 from server.core.common_dtos import common_store
+from server.core.image_cache import DecodedImageCacheInstance
+from server.core.tile_pyramid import TilePyramidStoreInstance
+from server.core.worker_pool import WorkerPoolInstance
 from server.server_config import DatabaseInstance
 from server.server_config import ServerConfig
 
@@ -23,6 +29,8 @@ from pathlib import Path
 api = Namespace('files', description='File serving')
 
 db = DatabaseInstance()
+tile_store = TilePyramidStoreInstance()
+image_cache = DecodedImageCacheInstance()
 
 api.models.update(common_store.get_dtos())
 
@@ -37,6 +45,27 @@ file_upload.add_argument('File Upload',
                          help='File Upload')
 
 
+def not_modified(etag):
+    """
+    Builds a 304 response if the request already holds the representation identified by etag.
+    :return: A 304 Response, or None if the full representation must be sent
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def get_image_etag(iid, revision):
+    return "image-%d-%d" % (iid, revision)
+
+
+def get_annotations_etag(iid, rows, encoding=utils.MASK_ENCODING_RAW):
+    revisions = ",".join("%d:%d" % (row["annotation_id"], row["revision"]) for row in rows)
+    return "annotations-%d-%s-%s" % (iid, encoding, hashlib.sha1(revisions.encode('utf-8')).hexdigest())
+
+
 @api.route("/image/<int:iid>")
 class ImageDownload(Resource):
     @api.response(200, "OK")
@@ -48,7 +77,7 @@ class ImageDownload(Resource):
         A file serving operation for retrieving images by id.
         """
 
-        query = "SELECT image_path FROM image WHERE image_id  = %s"
+        query = "SELECT image_path, image_ext, revision, is_swapped FROM image WHERE image_id  = %s"
         try:
             result, _ = db.query(query, (iid,))
         except DatabaseError as e:
@@ -80,25 +109,85 @@ class ImageDownload(Resource):
                 }
                 return response, 404
 
-            path = result[0]["image_path"]
-            return send_file(path)
+            etag = get_image_etag(iid, result[0]["revision"])
+            response = not_modified(etag)
+            if response is not None:
+                return response
 
+            row = result[0]
+            if row["is_swapped"]:
+                # Images stored by older servers have their channels swapped and must be corrected
+                data = utils.render_image(row["image_path"], row["image_ext"], is_swapped=True)
+                response = send_file(
+                    io.BytesIO(data),
+                    mimetype=mimetypes.guess_type("image" + row["image_ext"])[0],
+                    add_etags=False)
+            else:
+                response = send_file(row["image_path"], add_etags=False)
+            response.set_etag(etag)
+            return response
 
-@api.route("/image/<int:iid>/annotations")
-class AnnotationDownload(Resource):
+
+@api.route("/image/<int:iid>/tile")
+class ImageTileInfo(Resource):
     @api.response(200, "OK")
     @api.response(400, "Database Failure", api.models["generic_response"])
     @api.response(404, "Image not found", api.models["generic_response"])
     @api.response(500, "Unexpected Failure", api.models["generic_response"])
     def get(self, iid):
         """
-        A file serving operation for retrieving all annotations associated with an image.
+        Gets the layout of the tile pyramid of an image. Level 0 is full resolution and each following
+        level halves the resolution, until the last level fits in a single tile.
         """
-
-        query = "SELECT annotation_id, mask_path, info_path FROM instance_seg_meta WHERE image_id  = %s"
+        query = "SELECT image_path, revision, is_swapped FROM image WHERE image_id = %s"
         try:
             result, _ = db.query(query, (iid,))
+            if not result:
+                response = {
+                    "action": "failed",
+                    "error": {
+                        "code": 404,
+                        "message": "Image with id %s, does not exist." % iid
+                    }
+                }
+                return response, 404
+            info = tile_store.get_info(
+                iid, result[0]["image_path"], result[0]["revision"], bool(result[0]["is_swapped"]))
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": e.msg
+                }
+            }
+            return response, 400
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            return response, 500
+        return info, 200
 
+
+@api.route("/image/<int:iid>/tile/<int:level>/<int:x>/<int:y>")
+class ImageTile(Resource):
+    @api.response(200, "OK")
+    @api.response(304, "Not Modified")
+    @api.response(400, "Database Failure", api.models["generic_response"])
+    @api.response(404, "Tile not found", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    def get(self, iid, level, x, y):
+        """
+        A file serving operation for retrieving a single tile of an image's tile pyramid.
+        """
+        query = "SELECT image_path, revision, is_swapped FROM image WHERE image_id = %s"
+        try:
+            result, _ = db.query(query, (iid,))
             if not result:
                 response = {
                     "action": "failed",
@@ -109,19 +198,22 @@ class AnnotationDownload(Resource):
                 }
                 return response, 404
 
-            data = io.BytesIO()
-            with zipfile.ZipFile(data, mode='w') as z:
-                for row in result:
-                    _, ext = os.path.splitext(os.path.basename(row['mask_path']))
-                    z.write(row['mask_path'], str(row["annotation_id"]) + ext)
-            data.seek(0)
+            etag = "tile-%d-%d-%d-%d-%d" % (iid, result[0]["revision"], level, x, y)
+            response = not_modified(etag)
+            if response is not None:
+                return response
 
-            return send_file(
-                data,
-                mimetype='application/zip',
-                as_attachment=True,
-                attachment_filename='data.zip'
-            )
+            data = tile_store.get_tile(
+                iid, result[0]["image_path"], result[0]["revision"], level, x, y, bool(result[0]["is_swapped"]))
+            if data is None:
+                response = {
+                    "action": "failed",
+                    "error": {
+                        "code": 404,
+                        "message": "Tile (%d, %d) of level %d does not exist." % (x, y, level)
+                    }
+                }
+                return response, 404
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -141,51 +233,103 @@ class AnnotationDownload(Resource):
             }
             return response, 500
 
-    @api.marshal_with(api.models["generic_response"], skip_none=True)
-    @api.expect(file_upload)
-    def post(self, iid):
-        file_bytes = request.files['file'].read()
-        info_bytes = request.files['info'].read()
-        info = json.loads(info_bytes.decode('utf-8'))
-        zf = zipfile.ZipFile(io.BytesIO(file_bytes), "r")
-
-        code = 201
-        new_rows = []
-        for row in info["annotations"]:
-            mask_path = os.path.join(
-                ServerConfig.DATA_ROOT_DIR,
-                "annotation",
-                str(iid),
-                "trimaps",
-                "%s.png" % row["name"])
-            info_path = os.path.join(
-                ServerConfig.DATA_ROOT_DIR,
-                "annotation",
-                str(iid),
-                "xmls",
-                "%s.xml" % row["name"])
-
-            new_rows.append((row['name'], iid, mask_path, info_path, row["class_name"]))
-
-            folder = os.path.dirname(mask_path)
-            Path(folder).mkdir(parents=True, exist_ok=True)
-            cv2.imwrite(mask_path, utils.bytes2mat(zf.read(row['name'] + ServerConfig.DEFAULT_MASK_EXT)))
-
-            utils.save_info(
-                shape=row["shape"],
-                bbox=row["bbox"],
-                class_name=row["class_name"],
-                filepath=info_path)
-
-        q_delete_old = "DELETE FROM instance_seg_meta WHERE image_id = %s"
-        q_replace = "REPLACE INTO instance_seg_meta (annotation_name, image_id, mask_path, info_path, class_name)"
+        response = send_file(
+            io.BytesIO(data),
+            mimetype=mimetypes.guess_type("tile" + ServerConfig.TILE_EXT)[0],
+            add_etags=False)
+        response.set_etag(etag)
+        return response
+
+
+def parse_bbox(value):
+    """
+    Parses a bounding box of the form "x0,y0,x1,y1".
+    :return: A tuple of 4 ints, or None if the value is not a valid bounding box
+    """
+    try:
+        bbox = tuple(int(v) for v in value.split(","))
+    except (AttributeError, ValueError):
+        return None
+    if len(bbox) != 4 or min(bbox) < 0 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        return None
+    return bbox
+
+
+@api.route("/image/<int:iid>/crop")
+class ImageCrop(Resource):
+    @api.response(200, "OK")
+    @api.response(304, "Not Modified")
+    @api.response(400, "Invalid Request", api.models["generic_response"])
+    @api.response(404, "Image not found", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.param(
+        'bbox',
+        description='The region to crop in full resolution pixels, as x0,y0,x1,y1 with x1 and y1 exclusive.',
+        type='string',
+        required=True)
+    @api.param(
+        'max-dim',
+        description='A value indicating the maximum dimension acceptable for the returned region.',
+        type='integer')
+    def get(self, iid):
+        """
+        A file serving operation for retrieving a region of an image.
+        """
+        bbox = parse_bbox(request.args.get('bbox'))
+        if bbox is None:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": "A bbox of the form x0,y0,x1,y1 with x0 < x1 and y0 < y1 is required."
+                }
+            }
+            return response, 400
+
+        try:
+            max_dim = int(request.args.get('max-dim'))
+        except (ValueError, TypeError):
+            max_dim = None
+
+        query = "SELECT image_path, image_ext, revision, is_swapped FROM image WHERE image_id = %s"
         try:
-            db.query(q_delete_old, (iid,))
-            if new_rows:
-                q_replace += "\nVALUES "
-                q_replace += ",".join(["(%s,%s,%s,%s,%s)"] * len(new_rows))
-                params = tuple(sum(new_rows, ()))
-                _, ids = db.query(q_replace, params)
+            result, _ = db.query(query, (iid,))
+            if not result:
+                response = {
+                    "action": "failed",
+                    "error": {
+                        "code": 404,
+                        "message": "Image with id %s, does not exist." % iid
+                    }
+                }
+                return response, 404
+
+            row = result[0]
+            etag = "crop-%d-%d-%s-%s" % (iid, row["revision"], "_".join(str(v) for v in bbox), max_dim)
+            response = not_modified(etag)
+            if response is not None:
+                return response
+
+            x0, y0, x1, y1 = bbox
+            reduction = 1
+            if max_dim is not None:
+                reduction = image_cache.get_reduction(max(x1 - x0, y1 - y0), max_dim)
+            mat, reduction = image_cache.get(
+                iid, row["revision"], row["image_path"], reduction, bool(row["is_swapped"]))
+
+            region = mat[y0 // reduction:-(-y1 // reduction), x0 // reduction:-(-x1 // reduction)]
+            if region.size == 0:
+                response = {
+                    "action": "failed",
+                    "error": {
+                        "code": 400,
+                        "message": "The bbox %s lies outside of the image." % str(bbox)
+                    }
+                }
+                return response, 400
+            if max_dim is not None:
+                region = utils.downscale_mat(region, max_dim)
+            data = utils.mat2bytes(region, row["image_ext"])
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -194,7 +338,7 @@ class AnnotationDownload(Resource):
                     "message": e.msg
                 }
             }
-            code = 400
+            return response, 400
         except BaseException as e:
             response = {
                 "action": "failed",
@@ -203,10 +347,178 @@ class AnnotationDownload(Resource):
                     "message": str(e)
                 }
             }
-            code = 500
-        else:
+            return response, 500
+
+        response = send_file(
+            io.BytesIO(data),
+            mimetype=mimetypes.guess_type("crop" + row["image_ext"])[0],
+            add_etags=False)
+        response.set_etag(etag)
+        return response
+
+
+@api.route("/image/<int:iid>/annotations")
+class AnnotationDownload(Resource):
+    @api.response(200, "OK")
+    @api.response(400, "Database Failure", api.models["generic_response"])
+    @api.response(404, "Image not found", api.models["generic_response"])
+    @api.response(415, "Unsupported mask encoding", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    def get(self, iid):
+        """
+        A file serving operation for retrieving all annotations associated with an image.
+        """
+
+        try:
+            encoding = utils.get_mask_encoding(request.headers)
+        except ValueError as e:
             response = {
-                "action": "created"
+                "action": "failed",
+                "error": {
+                    "code": 415,
+                    "message": str(e)
+                }
             }
-        return response, code
+            return response, 415
+
+        query = "SELECT annotation_id, mask_path, revision FROM instance_seg_meta WHERE image_id  = %s"
+        query += " ORDER BY annotation_id"
+        try:
+            result, _ = db.query(query, (iid,))
+
+            if not result:
+                response = {
+                    "action": "failed",
+                    "error": {
+                        "code": 404,
+                        "message": "Image with id %s, does not exist." % iid
+                    }
+                }
+                return response, 404
+
+            etag = get_annotations_etag(iid, result, encoding)
+            response = not_modified(etag)
+            if response is not None:
+                return response
 
+            data = io.BytesIO()
+            with zipfile.ZipFile(data, mode='w') as z:
+                for row in result:
+                    if encoding == utils.MASK_ENCODING_PACKED:
+                        z.writestr(
+                            str(row["annotation_id"]) + utils.COMPACT_MASK_EXT,
+                            utils.load_mask_packed(row['mask_path']))
+                    else:
+                        z.writestr(
+                            str(row["annotation_id"]) + ServerConfig.DEFAULT_MASK_EXT,
+                            utils.load_mask_bytes(row['mask_path']))
+            data.seek(0)
+
+            response = send_file(
+                data,
+                mimetype='application/zip',
+                as_attachment=True,
+                attachment_filename='data.zip',
+                add_etags=False
+            )
+            response.set_etag(etag)
+            response.headers[utils.MASK_ENCODING_HEADER] = encoding
+            response.vary.add(utils.MASK_ENCODING_HEADER)
+            return response
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": e.msg
+                }
+            }
+            return response, 400
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            return response, 500
+
+    @api.marshal_with(api.models["generic_response"], skip_none=True)
+    @api.expect(file_upload)
+    def post(self, iid):
+        """
+        Replaces all the annotations of an image with those uploaded.
+        """
+        return save_uploaded_annotations(iid, replace=True)
+
+    @api.response(200, "OK", api.models["generic_response"])
+    @api.response(415, "Unsupported mask encoding", api.models["generic_response"])
+    @api.marshal_with(api.models["generic_response"], skip_none=True)
+    @api.expect(file_upload)
+    def patch(self, iid):
+        """
+        Applies a changeset to the annotations of an image. The uploaded annotations are created or
+        updated, those named in the "deleted" list of the info are deleted, and the rest are left as is.
+        """
+        return save_uploaded_annotations(iid, replace=False)
+
+
+def save_uploaded_annotations(iid, replace):
+    """
+    Saves the annotations uploaded as a zip of masks in 'file' and their details as json in 'info'.
+    """
+    file_bytes = request.files['file'].read()
+    info_bytes = request.files['info'].read()
+    info = json.loads(info_bytes.decode('utf-8'))
+    zf = zipfile.ZipFile(io.BytesIO(file_bytes), "r")
+    try:
+        encoding = utils.get_mask_encoding(request.headers)
+    except ValueError as e:
+        response = {
+            "action": "failed",
+            "error": {
+                "code": 415,
+                "message": str(e)
+            }
+        }
+        return response, 415
+
+    def read_mask(row):
+        if encoding == utils.MASK_ENCODING_PACKED:
+            return utils.unpack_mask(zf.read(row['name'] + utils.COMPACT_MASK_EXT))
+        return utils.mat2mask(utils.bytes2mat(zf.read(row['name'] + ServerConfig.DEFAULT_MASK_EXT)))
+
+    code = 201 if replace else 200
+    try:
+        masks = WorkerPoolInstance().imap(read_mask, info["annotations"])
+        annotations = [{
+            "name": row["name"],
+            "class_name": row["class_name"],
+            "mask": mask,
+            "info": annotation_store.get_info(row["shape"], row["bbox"])
+        } for row, mask in zip(info["annotations"], masks)]
+        annotation_store.save_annotations(iid, annotations, info.get("deleted", []), replace=replace)
+    except DatabaseError as e:
+        response = {
+            "action": "failed",
+            "error": {
+                "code": 400,
+                "message": e.msg
+            }
+        }
+        code = 400
+    except BaseException as e:
+        response = {
+            "action": "failed",
+            "error": {
+                "code": 500,
+                "message": str(e)
+            }
+        }
+        code = 500
+    else:
+        response = {
+            "action": "created" if replace else "updated"
+        }
+    return response, code
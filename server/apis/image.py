@@ -3,18 +3,29 @@ import os
 import cv2
 import numpy as np
 
-from flask import request
+from flask import request, Response, stream_with_context
 from flask_restplus import Namespace, Resource, fields, marshal
 from mysql.connector.errors import DatabaseError
 
 import server.utils as utils
+import server.core.annotation_store as annotation_store
+import server.core.image_leases as image_leases
+import server.core.image_listing as image_listing
+import server.core.image_store as image_store
+import server.core.project_stats as project_stats
 from server.core.common_dtos import common_store
+from server.core.query_cache import QueryCacheInstance
+from server.core.rendition_cache import RenditionCacheInstance
+from server.core.worker_pool import WorkerPoolInstance
 from server.server_config import DatabaseInstance
 from server.server_config import ServerConfig
 
 api = Namespace('images', description='Image related operations')
 
 db = DatabaseInstance()
+query_cache = QueryCacheInstance()
+rendition_cache = RenditionCacheInstance()
+worker_pool = WorkerPoolInstance()
 
 api.models.update(common_store.get_dtos())
 
@@ -62,7 +73,7 @@ annotation = api.model('annotation', {
         example="Layer 1"),
     'mask_data': fields.String(
         required=True,
-        description="The encoded mask data"),
+        description="The base64 encoded mask, in the encoding given by the X-Mask-Encoding header"),
     'bbox': fields.List(
         fields.Integer,
         required=True,
@@ -90,6 +101,29 @@ bulk_annotations = api.model('bulk_annotations', {
 })
 
 
+def render_row(row, max_dim=None):
+    """
+    Renders the image referenced by an image row, returning None for unsupported formats.
+    """
+    if not utils.is_native_ext(row["image_ext"]):
+        return None
+    is_swapped = bool(row["is_swapped"])
+    if max_dim is not None:
+        return rendition_cache.get_or_render(
+            row["image_id"], row["image_path"], max_dim, row["image_ext"], is_swapped)
+    if not is_swapped:
+        with open(row["image_path"], 'rb') as f:
+            return f.read()
+    return utils.render_image(row["image_path"], row["image_ext"], is_swapped=is_swapped)
+
+
+def parse_max_dim():
+    try:
+        return int(request.args.get('max-dim'))
+    except (ValueError, TypeError):
+        return None
+
+
 @api.route("")
 class ImageList(Resource):
     @api.response(200, "OK", bulk_images)
@@ -104,6 +138,7 @@ class ImageList(Resource):
         'max-dim',
         description='A value indicating the maximum dimension acceptable for a returned image.',
         type='integer')
+    @api.param('fields', description='A comma separated list of image fields to return, e.g. id,name,is_locked')
     def get(self):
         """
         A bulk operation for retrieving images by id.
@@ -116,17 +151,25 @@ class ImageList(Resource):
         else:
             image_data_flag = image_data_flag.lower() == "true"
 
-        try:
-            max_dim = int(request.args.get('max-dim'))
-        except (ValueError, TypeError):
-            max_dim = None
+        max_dim = parse_max_dim()
 
-        query = "SELECT image_id, image_path, image_name, image_ext, is_locked, is_labeled FROM image "
-        query += "WHERE image_id IN "
-        query += "(%s)" % ",".join(str(x) for x in content["ids"])
+        query = "SELECT image_id, image_path, image_name, image_ext, is_locked, is_labeled, is_swapped FROM image "
+        query += "WHERE image_id IN (%s)"
 
         try:
-            result = db.query(query)[0]
+            selected = image_listing.parse_fields(request.args.get('fields'))
+            ids = [int(x) for x in content["ids"]]
+            query = query % ",".join(["%s"] * len(ids))
+            result = db.query(query, tuple(ids))[0] if ids else []
+        except ValueError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": str(e)
+                }
+            }
+            code = 400
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -147,15 +190,14 @@ class ImageList(Resource):
             code = 500
         else:
             images = []
-            for row in result:
-                if not image_data_flag:
-                    pass
-                elif row["image_ext"].lower() in (".jpg", ".jpeg", ".png"):
-                    img = cv2.imread(row["image_path"])
-                    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                    if max_dim is not None:
-                        img = utils.downscale_mat(img, max_dim)
-                    img_bytes = utils.mat2bytes(img, row["image_ext"])
+            if image_data_flag:
+                rendered = worker_pool.imap(lambda row: render_row(row, max_dim), result)
+            else:
+                rendered = (None for _ in result)
+            for row, img_bytes in zip(result, rendered):
+                if selected is not None:
+                    row = image_listing.select_fields(row, selected)
+                if img_bytes is not None:
                     encoded_image = base64.b64encode(img_bytes)
                     row["image_data"] = encoded_image.decode('utf-8')
                 images.append(row)
@@ -163,11 +205,76 @@ class ImageList(Resource):
             code = 200
 
         if code == 200:
-            return marshal(response, bulk_images), code
+            return marshal(response, bulk_images, skip_none=selected is not None), code
         else:
             return marshal(response, api.models["generic_response"]), code
 
 
+@api.route("/stream")
+class ImageStream(Resource):
+    @api.response(200, "OK")
+    @api.response(400, "Invalid Payload", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.expect(api.models["bulk_id_request"])
+    @api.param(
+        'max-dim',
+        description='A value indicating the maximum dimension acceptable for a returned image.',
+        type='integer')
+    def get(self):
+        """
+        A bulk operation for streaming images by id as length prefixed binary frames.
+
+        Each frame is a pair of big-endian uint32 lengths (header, data), followed by a JSON header
+        holding the image meta data and then the raw image bytes. Frames are sent as each image is rendered.
+        """
+        content = request.json
+        max_dim = parse_max_dim()
+
+        query = "SELECT image_id, image_path, image_name, image_ext, is_locked, is_labeled, is_swapped FROM image "
+        query += "WHERE image_id IN "
+        query += "(%s)" % ",".join(str(int(x)) for x in content["ids"])
+
+        try:
+            result = db.query(query)[0]
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": e.msg
+                }
+            }
+            return marshal(response, api.models["generic_response"]), 400
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            return marshal(response, api.models["generic_response"]), 500
+
+        def safe_render_row(row):
+            try:
+                return render_row(row, max_dim)
+            except BaseException as e:
+                print("Failed to render image %d: %s" % (row["image_id"], str(e)))
+                return None
+
+        def generate():
+            for row, img_bytes in zip(result, worker_pool.imap(safe_render_row, result)):
+                header = marshal(row, image, skip_none=True)
+                if img_bytes is None:
+                    img_bytes = b""
+                yield utils.encode_frame_header(header, len(img_bytes))
+                yield img_bytes
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype=utils.FRAME_STREAM_MIMETYPE)
+
+
 @api.doc(params={"iid": "An id associated with an existing image."})
 @api.route("/<int:iid>")
 class Image(Resource):
@@ -261,6 +368,14 @@ class Image(Resource):
             query_params.append("image_ext = %s")
             params.append(content["ext"])
         if "is_locked" in content:
+            # Locks set here hold an anonymous lease, so they are still released if the client is lost.
+            # Locking an image which already holds an unexpired lease keeps that lease, so its holder can
+            # still renew it. MySQL assigns from left to right, so the lease is set before is_locked.
+            held = "is_locked = 1 AND lease_expires >= NOW()"
+            query_params.append("lease_token = IF(%%s AND %s, lease_token, NULL)" % held)
+            query_params.append(
+                "lease_expires = IF(%%s, IF(%s, lease_expires, NOW() + INTERVAL %%s SECOND), NULL)" % held)
+            params.extend([content["is_locked"], content["is_locked"], ServerConfig.IMAGE_LEASE_SECONDS])
             query_params.append("is_locked = %s")
             params.append(content["is_locked"])
         if "is_labeled" in content:
@@ -277,10 +392,20 @@ class Image(Resource):
             }
             return response, 400
 
+        q_get_image = "SELECT project_fid, is_labeled FROM image WHERE image_id = %s FOR UPDATE"
         query = "UPDATE image SET {0} WHERE image_id = %s".format(", ".join(query_params))
         params.append(iid)
         try:
-            db.query(query, tuple(params))
+            # The image is locked while it is updated, so concurrent flips of is_labeled are counted once each
+            with db.transaction() as t:
+                images, _ = t.query(q_get_image, (iid,))
+                t.query(query, tuple(params))
+                if "is_labeled" in content:
+                    for row in images:
+                        project_stats.set_labeled(t, row["project_fid"], row["is_labeled"], content["is_labeled"])
+            if "is_labeled" in content:
+                for row in images:
+                    query_cache.invalidate_project(row["project_fid"])
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -315,12 +440,19 @@ class Image(Resource):
         Delete an image as referenced by its identifier.
         """
 
+        q_get_image = "SELECT image_id, project_fid, is_labeled, blob_hash FROM image WHERE image_id = %s FOR UPDATE"
         q_delete_annotations = "DELETE from instance_seg_meta WHERE image_id = %s"
         query = "DELETE from image WHERE image_id = %s"
 
         try:
-            db.query(q_delete_annotations, (iid,))
-            db.query(query, (iid,))
+            with db.transaction() as t:
+                images, _ = t.query(q_get_image, (iid,))
+                t.query(q_delete_annotations, (iid,))
+                t.query(query, (iid,))
+                project_stats.remove_images(t, images)
+            for row in images:
+                query_cache.invalidate_project(row["project_fid"])
+            image_store.release_images(images)
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -348,6 +480,100 @@ class Image(Resource):
         return response, code
 
 
+@api.doc(params={"iid": "An id associated with an existing image"})
+@api.route("/<int:iid>/lease")
+class ImageLease(Resource):
+    @api.response(200, "OK", api.models["image_lease"])
+    @api.response(404, "Image not found", api.models["generic_response"])
+    @api.response(409, "Image leased by another client", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.expect(api.models["lease_request"])
+    def put(self, iid):
+        """
+        Locks an image under a lease, or renews the lease given by token. Clients must renew their
+        leases before they expire, after which the image may be claimed by another client.
+        """
+        content = request.get_json(silent=True) or {}
+        try:
+            lease = image_leases.acquire(iid, content.get("token"))
+            if lease is None:
+                response = {
+                    "action": "failed",
+                    "error": {
+                        "code": 404,
+                        "message": "Image with id %s, does not exist." % iid
+                    }
+                }
+                code = 404
+            else:
+                return marshal(lease, api.models["image_lease"]), 200
+        except image_leases.LeaseConflict as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 409,
+                    "message": str(e)
+                }
+            }
+            code = 409
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        return marshal(response, api.models["generic_response"], skip_none=True), code
+
+    @api.response(200, "OK", api.models["generic_response"])
+    @api.response(404, "Image not found", api.models["generic_response"])
+    @api.response(409, "Image leased by another client", api.models["generic_response"])
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    @api.expect(api.models["lease_request"])
+    def delete(self, iid):
+        """
+        Releases the lease given by token, unlocking the image.
+        """
+        content = request.get_json(silent=True) or {}
+        try:
+            if image_leases.release(iid, content.get("token")):
+                response = {
+                    "action": "deleted",
+                    "id": iid
+                }
+                code = 200
+            else:
+                response = {
+                    "action": "failed",
+                    "error": {
+                        "code": 404,
+                        "message": "Image with id %s, does not exist." % iid
+                    }
+                }
+                code = 404
+        except image_leases.LeaseConflict as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 409,
+                    "message": str(e)
+                }
+            }
+            code = 409
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        return marshal(response, api.models["generic_response"], skip_none=True), code
+
+
 @api.doc(params={"iid": "An id associated with an existing image"})
 @api.route("/<int:iid>/annotation")
 class ImageAnnotationList(Resource):
@@ -358,8 +584,9 @@ class ImageAnnotationList(Resource):
         Gets all the annotations associated with an image.
         """
 
-        query = "SELECT annotation_id, annotation_name, mask_path, info_path, class_name FROM instance_seg_meta "
-        query += "WHERE image_id = %s"
+        query = "SELECT annotation_id, annotation_name, mask_path, info_path, class_name, "
+        query += ", ".join(annotation_store.INFO_COLUMNS)
+        query += " FROM instance_seg_meta WHERE image_id = %s"
 
         try:
             result = db.query(query, (iid,))[0]
@@ -383,10 +610,9 @@ class ImageAnnotationList(Resource):
             code = 500
         else:
             response = []
-            for row in result:
-                info = utils.load_info(row["info_path"])
-                row["shape"] = info["source_shape"]
-                row["bbox"] = info["bbox"]
+            for row in annotation_store.fill_legacy_info(result):
+                row["shape"] = annotation_store.get_shape(row)
+                row["bbox"] = annotation_store.get_bbox(row)
 
                 print("SERVER: outgoing bbox")
                 print("\t%s" % str(row["bbox"]))
@@ -402,6 +628,7 @@ class ImageAnnotationList(Resource):
 
     @api.response(200, "Partial Success", api.models["bulk_response"])
     @api.response(201, "Success", api.models["bulk_response"])
+    @api.response(415, "Unsupported mask encoding", api.models["bulk_response"])
     @api.marshal_with(api.models["bulk_response"], skip_none=True)
     @api.expect(bulk_annotations)
     def post(self, iid):
@@ -410,82 +637,79 @@ class ImageAnnotationList(Resource):
         """
 
         content = request.json
+        try:
+            encoding = utils.get_mask_encoding(request.headers)
+        except ValueError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 415,
+                    "message": str(e)
+                }
+            }
+            return {"results": [response]}, 415
 
-        q_get_image = "SELECT image_path FROM image "
+        q_get_image = "SELECT image_path, width, height FROM image "
         q_get_image += "WHERE image_id = %s"
-        query = "DELETE FROM instance_seg_meta WHERE image_id = %s"
 
         orig_shape = None
         try:
             image, _ = db.query(q_get_image, (iid,))
-            orig_shape = cv2.imread(image[0]["image_path"]).shape
-            db.query(query, (iid,))
+            if image[0]["width"] is not None:
+                orig_shape = (image[0]["height"], image[0]["width"], 3)
+            else:
+                orig_shape = cv2.imread(image[0]["image_path"]).shape
         except BaseException:
             pass
 
-        i = 0
         code = 201
         results = []
+        annotations = []
+        pending = []
         for row in content["annotations"]:
             try:
-                mask = utils.decode_mask(row['mask_data'], row['shape'])
+                mask = utils.decode_mask(row['mask_data'], row['shape'], encoding)
 
                 print("SERVER: incoming bbox")
                 print("\t%s" % str(row["bbox"]))
 
-                mask_path = os.path.join(
-                    ServerConfig.DATA_ROOT_DIR,
-                    "annotation",
-                    str(iid),
-                    "trimaps",
-                    "%s.png" % row["name"])
-                info_path = os.path.join(
-                    ServerConfig.DATA_ROOT_DIR,
-                    "annotation",
-                    str(iid),
-                    "xmls",
-                    "%s.xml" % row["name"])
-
-                query = "REPLACE INTO instance_seg_meta (annotation_name, image_id, mask_path, info_path, class_name)"
-                query += " VALUES (%s,%s,%s,%s,%s)"
-                _, aid = db.query(
-                    query, (row['name'], iid, mask_path, info_path, row["class_name"]))
-
                 resize_shape = None if np.all(np.array(orig_shape) == row["shape"]) else orig_shape
-                utils.save_mask(mask, mask_path, resize_shape=resize_shape)
-                utils.save_info(
-                    shape=row["shape"],
-                    bbox=row["bbox"],
-                    class_name=row["class_name"],
-                    filepath=info_path,
-                    resize_shape=resize_shape)
-                i += 1
-            except DatabaseError as e:
-                response = {
-                    "action": "failed",
-                    "error": {
-                        "code": 400,
-                        "message": e.msg
-                    }
-                }
-                results.append(response)
-                code = 200
+                annotations.append({
+                    "name": row["name"],
+                    "class_name": row["class_name"],
+                    "mask": mask,
+                    "info": annotation_store.get_info(row["shape"], row["bbox"], resize_shape=resize_shape),
+                    "resize_shape": resize_shape
+                })
             except BaseException as e:
                 response = {
                     "action": "failed",
                     "error": {
-                        "code": 500,
+                        "code": 400,
                         "message": str(e)
                     }
                 }
                 results.append(response)
                 code = 200
             else:
-                response = {
-                    "action": "created",
-                    "id": aid
-                }
-                results.append(response)
+                pending.append((len(results), row["name"]))
+                results.append(None)
+
+        try:
+            ids = annotation_store.save_annotations(iid, annotations)
+        except DatabaseError as e:
+            error = {"code": 400, "message": e.msg}
+        except BaseException as e:
+            error = {"code": 500, "message": str(e)}
+        else:
+            error = None
+
+        for i, name in pending:
+            if error is not None:
+                results[i] = {"action": "failed", "error": error}
+                code = 200
+            else:
+                results[i] = {"action": "created", "id": ids[name]}
 
         return {"results": results}, code
 
@@ -0,0 +1,250 @@
+import os
+
+from flask import request, send_file
+from flask_restplus import Namespace, Resource, fields, marshal
+from mysql.connector.errors import DatabaseError
+
+import server.core.shard_export as shard_export
+from server.core.common_dtos import common_store
+from server.core.jobs import JobQueueInstance, JOB_HANDLERS
+
+api = Namespace('jobs', description='Background job related operations')
+
+job_queue = JobQueueInstance()
+
+api.models.update(common_store.get_dtos())
+
+job = api.model('job', {
+    'id': fields.Integer(attribute='job_id', required=False, description='The job identifier'),
+    'type': fields.String(
+        attribute='job_type',
+        required=True,
+        description='The type of job',
+        enum=list(JOB_HANDLERS.keys()),
+        example="export_dataset"),
+    'project_id': fields.Integer(
+        attribute='project_fid',
+        required=False,
+        description='The identifier of the project the job operates on'),
+    'params': fields.Raw(required=False, description='Parameters specific to the type of job'),
+    'status': fields.String(
+        attribute='job_status',
+        required=False,
+        description='The state of the job',
+        enum=["queued", "running", "succeeded", "failed", "cancelled"]),
+    'progress': fields.Float(required=False, description='The fraction of the job which is complete'),
+    'has_result': fields.Boolean(required=False, description='Whether the job produced a downloadable result'),
+    'error': fields.String(attribute='error_message', required=False, description='Why the job failed'),
+    'created': fields.DateTime(required=False, description='The datetime when the job was submitted'),
+    'started': fields.DateTime(required=False, description='The datetime when the job started running'),
+    'finished': fields.DateTime(required=False, description='The datetime when the job finished')
+})
+
+
+def job_not_found(jid):
+    response = {
+        "action": "failed",
+        "error": {
+            "code": 404,
+            "message": "Job with id %s, does not exist." % jid
+        }
+    }
+    return marshal(response, api.models["generic_response"]), 404
+
+
+@api.route("")
+class JobList(Resource):
+    @api.response(202, "Accepted", api.models['generic_response'])
+    @api.response(400, "Invalid Job", api.models['generic_response'])
+    @api.response(500, "Unexpected Failure", api.models['generic_response'])
+    @api.expect(job)
+    @api.marshal_with(api.models['generic_response'], skip_none=True)
+    def post(self):
+        """
+        Submits a job to be run in the background. Poll the job for its status and download its
+        result once it has succeeded.
+        """
+        content = request.json
+        code = 202
+        try:
+            jid = job_queue.submit(content["type"], content.get("project_id", None), content.get("params", None))
+        except ValueError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": str(e)
+                }
+            }
+            code = 400
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            response = {
+                "action": "created",
+                "id": jid
+            }
+        return response, code
+
+
+@api.doc(params={"jid": "An id associated with a job."})
+@api.route("/<int:jid>")
+class Job(Resource):
+    @api.response(200, "OK", job)
+    @api.response(404, "Job not found", api.models['generic_response'])
+    def get(self, jid):
+        """
+        Gets the status of a job.
+        """
+        result = job_queue.get(jid)
+        if result is None:
+            return job_not_found(jid)
+        result["has_result"] = result["result_path"] is not None
+        return marshal(result, job, skip_none=True), 200
+
+    @api.response(200, "OK", api.models['generic_response'])
+    @api.response(404, "Job not found", api.models['generic_response'])
+    @api.response(500, "Unexpected Failure", api.models['generic_response'])
+    def delete(self, jid):
+        """
+        Cancels a queued or running job. Deleting a finished job removes it along with its result.
+        """
+        try:
+            result = job_queue.get(jid)
+            if result is None:
+                return job_not_found(jid)
+            if result["job_status"] in job_queue.FINISHED_STATUSES:
+                job_queue.delete(jid)
+                action = "deleted"
+            else:
+                job_queue.cancel(jid)
+                action = "updated"
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+            code = 500
+        else:
+            response = {
+                "action": action,
+                "id": jid
+            }
+            code = 200
+        return marshal(response, api.models['generic_response'], skip_none=True), code
+
+
+@api.doc(params={"jid": "An id associated with a job."})
+@api.route("/<int:jid>/result")
+class JobResult(Resource):
+    @api.response(200, "OK")
+    @api.response(404, "Job not found", api.models['generic_response'])
+    @api.response(409, "Job has no result", api.models['generic_response'])
+    def get(self, jid):
+        """
+        Downloads the result of a succeeded job.
+        """
+        result = job_queue.get(jid)
+        if result is None:
+            return job_not_found(jid)
+        if result["result_path"] is None or not os.path.isfile(result["result_path"]):
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 409,
+                    "message": "Job with id %s, has no result (status: %s)." % (jid, result["job_status"])
+                }
+            }
+            return marshal(response, api.models["generic_response"]), 409
+        return send_file(
+            result["result_path"],
+            as_attachment=True,
+            attachment_filename=os.path.basename(result["result_path"]))
+
+
+@api.doc(params={"jid": "An id associated with an export_shards job."})
+@api.route("/<int:jid>/shards")
+class JobShardList(Resource):
+    @api.response(200, "OK")
+    @api.response(404, "Job not found", api.models['generic_response'])
+    def get(self, jid):
+        """
+        Lists the shards of a sharded export, along with which of them are ready to download.
+        The list is empty until the export has been planned.
+        """
+        result = job_queue.get(jid)
+        if result is None:
+            return job_not_found(jid)
+        result_dir = job_queue.get_result_dir(jid)
+        shards = (shard_export.get_shard_status(result_dir) if result_dir else None) or []
+        return {
+            "status": result["job_status"],
+            "shards": [{"index": i, "name": name, "ready": ready} for i, (name, ready) in enumerate(shards)]
+        }, 200
+
+
+@api.doc(params={"jid": "An id associated with an export_shards job.", "shard": "The index of a shard."})
+@api.route("/<int:jid>/shards/<int:shard>")
+class JobShard(Resource):
+    @api.response(200, "OK")
+    @api.response(404, "Shard not found", api.models['generic_response'])
+    @api.response(409, "Shard not ready", api.models['generic_response'])
+    def get(self, jid, shard):
+        """
+        Downloads a single completed shard of a sharded export, which may be done while the job is still running.
+        """
+        result_dir = job_queue.get_result_dir(jid)
+        shards = shard_export.get_shard_status(result_dir) if result_dir else None
+        if shards is None or not 0 <= shard < len(shards):
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 404,
+                    "message": "Shard %s of job %s, does not exist." % (shard, jid)
+                }
+            }
+            return marshal(response, api.models["generic_response"]), 404
+
+        name, ready = shards[shard]
+        if not ready:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 409,
+                    "message": "Shard %s of job %s, is not ready." % (shard, jid)
+                }
+            }
+            return marshal(response, api.models["generic_response"]), 409
+        return send_file(
+            os.path.join(result_dir, name),
+            mimetype='application/x-tar',
+            as_attachment=True,
+            attachment_filename=name)
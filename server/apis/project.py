@@ -1,21 +1,31 @@
 import base64
 import os
+import tempfile
 from pathlib import Path
-from shutil import copyfile, rmtree, make_archive
 
-import cv2
-import numpy as np
-from flask import request, Response
+from flask import request, Response, stream_with_context
 from flask_restplus import Namespace, Resource, fields, marshal
 from mysql.connector.errors import DatabaseError
-
+from werkzeug.formparser import MultiPartParser
+from werkzeug.http import parse_options_header
+
+import server.core.coco_export as coco_export
+import server.core.dataset_export as dataset_export
+import server.core.image_leases as image_leases
+import server.core.image_listing as image_listing
+import server.core.image_store as image_store
+import server.core.project_stats as project_stats
 from server.core.common_dtos import common_store
+from server.core.export_cache import ExportCacheInstance
+from server.core.query_cache import QueryCacheInstance
 from server.server_config import DatabaseInstance
 from server.server_config import ServerConfig
 
 api = Namespace('projects', description='Project related operations')
 
 db = DatabaseInstance()
+export_cache = ExportCacheInstance()
+query_cache = QueryCacheInstance()
 
 api.models.update(common_store.get_dtos())
 
@@ -66,6 +76,23 @@ bulk_image_upload = api.model('bulk_image_upload', {
     'images': fields.List(fields.Nested(image_upload), required=True),
 })
 
+image_meta = api.model('image_meta', {
+    'id': fields.Integer(attribute='image_id', description='The image identifier'),
+    'name': fields.String(attribute='image_name', description='The image name'),
+    'ext': fields.String(attribute='image_ext', description="The file extension of the image"),
+    'is_locked': fields.Boolean(description="A flag indicating whether the image is locked"),
+    'is_labeled': fields.Boolean(description="A flag indicating whether the image is labeled")
+})
+
+image_page = api.model('image_page', {
+    'action': fields.String(required=True, example="read"),
+    'ids': fields.List(fields.Integer, description="The ids of the images in this page"),
+    'images': fields.List(
+        fields.Nested(image_meta, skip_none=True),
+        description="The selected fields of the images in this page, if any were selected"),
+    'next': fields.String(description="The cursor of the next page, absent on the last page")
+})
+
 
 label = api.model('label', {
     'name': fields.String(required=True, description='The label name'),
@@ -78,6 +105,21 @@ bulk_labels = api.model('bulk_labels', {
     'labels': fields.List(fields.Nested(label), required=True)
 })
 
+class_stats = api.model('class_stats', {
+    'name': fields.String(description='The class name'),
+    'images': fields.Integer(description="The number of images with an instance of the class"),
+    'instances': fields.Integer(description="The number of instances of the class")
+})
+
+project_stats_model = api.model('project_stats', {
+    'images': fields.Integer(description="The number of images in the project"),
+    'labeled': fields.Integer(description="The number of labeled images in the project"),
+    'unlabeled': fields.Integer(description="The number of unlabeled images in the project"),
+    'locked': fields.Integer(description="The number of images currently locked for annotation"),
+    'instances': fields.Integer(description="The number of annotations in the project"),
+    'classes': fields.List(fields.Nested(class_stats))
+})
+
 
 
 
@@ -89,8 +131,8 @@ class ProjectList(Resource):
         """
         Get a list of all available projects
         """
-        results = db.query(
-            "SELECT project_id, project_name, labeled_count, unlabeled_count, last_uploaded FROM project")[0]
+        query = "SELECT project_id, project_name, labeled_count, unlabeled_count, last_uploaded FROM project"
+        results = query_cache.get(("projects",), lambda: db.query(query)[0])
         return {"projects": results}, 200
 
     @api.response(200, "Partial Success", api.models['bulk_response'])
@@ -139,6 +181,7 @@ class ProjectList(Resource):
                 }
                 bulk_response.append(result)
 
+        query_cache.invalidate(("projects",))
         return {"results": bulk_response}, code
 
 
@@ -154,7 +197,7 @@ class Project(Resource):
         query = "SELECT project_id, project_name, labeled_count, unlabeled_count, last_uploaded "
         query += "from project "
         query += "WHERE project_id = %s"
-        results = db.query(query, (pid,))[0]
+        results = query_cache.get(("project", pid), lambda: db.query(query, (pid,))[0])
         return results, 200
 
     @api.response(200, "OK", api.models["generic_response"])
@@ -168,12 +211,19 @@ class Project(Resource):
         q_delete_annotation += " (SELECT image_id from image where project_fid = %s)"
         q_delete_images = "DELETE FROM image WHERE project_fid = %s"
 
+        q_get_images = "SELECT image_id, blob_hash FROM image WHERE project_fid = %s"
+
         query = "DELETE FROM project WHERE project_id = %s"
         code = 200
         try:
-            db.query(q_delete_annotation, (pid,))
-            db.query(q_delete_images, (pid,))
-            db.query(query, (pid,))
+            with db.transaction() as t:
+                images, _ = t.query(q_get_images, (pid,))
+                t.query(q_delete_annotation, (pid,))
+                t.query(q_delete_images, (pid,))
+                t.query(query, (pid,))
+            query_cache.invalidate_project(pid)
+            query_cache.invalidate(("labels", pid))
+            image_store.release_images(images)
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -200,42 +250,74 @@ class Project(Resource):
         return response, code
 
 
+@api.doc(params={"pid": "An id associated with a project."})
+@api.route("/<int:pid>/stats")
+class ProjectStats(Resource):
+    @api.response(200, "OK", project_stats_model)
+    @api.response(500, "Unexpected Failure", api.models["generic_response"])
+    def get(self, pid):
+        """
+        Counts the labeled, locked and annotated images of a project, with the totals of each class.
+        """
+        try:
+            stats = project_stats.get_stats(pid)
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+        except BaseException as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": str(e)
+                }
+            }
+        else:
+            return marshal(stats, project_stats_model), 200
+        return marshal(response, api.models['generic_response'], skip_none=True), 500
+
+
 @api.doc(params={"pid": "An id associated with a project."})
 @api.route("/<int:pid>/images")
 class ProjectImageList(Resource):
-    @api.response(200, "OK", api.models['generic_response'])
+    @api.response(200, "OK", image_page)
+    @api.response(400, "Invalid Parameters", api.models['generic_response'])
     @api.response(500, "Unexpected Failure", api.models['generic_response'])
-    @api.marshal_with(api.models['generic_response'], skip_none=True)
     @api.expect(image_filter)
+    @api.param('limit', description='The most images returned in one page', type='integer')
+    @api.param('after', description='The cursor of the page to return, as given by the previous page')
+    @api.param('fields', description='A comma separated list of image fields to return, e.g. id,name,is_locked')
     def get(self, pid):
         """
         Get the images associated with the a project as referenced by its identifier.
-        """
-        content = request.json
-
-        query = "SELECT image_id FROM fadb.image "
-        query += "WHERE project_fid = %s"
-
-        if "locked" in content:
-            query += " and is_locked = " + str(content["locked"])
-
-        if "labeled" in content:
-            query += " and is_labeled = " + str(content["labeled"])
 
-        valid_order_by = True
-        if content["order_by"]["key"] == "id":
-            query += " ORDER BY image_id"
-        elif content["order_by"]["key"] == "name":
-            query += " ORDER BY image_name"
-        else:
-            valid_order_by = False
-
-        if valid_order_by:
-            query += " asc" if content["order_by"]["ascending"] else " desc"
+        Images are returned a page at a time when a limit or cursor is given, otherwise all of them are
+        returned at once. Pages are ordered by the order key then by id, and each page holds the cursor
+        of the next.
+        """
+        content = request.get_json(silent=True) or {}
 
-        code = 200
         try:
-            results, _ = db.query(query, (pid,))
+            selected = image_listing.parse_fields(request.args.get('fields'))
+            limit = None
+            if request.args.get('limit') is not None or request.args.get('after') is not None:
+                limit = image_listing.get_page_size(request.args.get('limit'))
+            results, cursor = image_listing.list_project_images(
+                pid, content, selected, limit, request.args.get('after'))
+        except ValueError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 400,
+                    "message": str(e)
+                }
+            }
+            code = 400
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -257,9 +339,13 @@ class ProjectImageList(Resource):
         else:
             response = {
                 "action": "read",
-                "ids": [row['image_id'] for row in results]
+                "ids": [row['image_id'] for row in results],
+                "next": cursor
             }
-        return response, code
+            if selected is not None:
+                response["images"] = [image_listing.select_fields(row, selected) for row in results]
+            return marshal(response, image_page, skip_none=True), 200
+        return marshal(response, api.models['generic_response'], skip_none=True), code
 
     @api.response(200, "Partial Success", api.models['bulk_response'])
     @api.response(201, "Success", api.models['bulk_response'])
@@ -276,28 +362,20 @@ class ProjectImageList(Resource):
         success_count = 0
         bulk_response = []
         for row in content:
-            array = np.fromstring(
-                base64.b64decode(
-                    row["image_data"]),
-                np.uint8)
-            img = cv2.imdecode(array, cv2.IMREAD_COLOR)
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-            img_dir = os.path.join(
-                ServerConfig.DATA_ROOT_DIR,
-                "images",
-                str(pid))
-            Path(img_dir).mkdir(parents=True, exist_ok=True)
-            img_path = os.path.join(
-                img_dir,
-                row["name"] +
-                ServerConfig.DEFAULT_IMAGE_EXT)
-
-            query = "INSERT INTO image (project_fid, image_path, image_name, image_ext) "
-            query += "VALUES (%s, %s, %s, %s);"
+            query = "INSERT INTO image (project_fid, image_path, image_name, image_ext, width, height, depth, blob_hash) "
+            query += "VALUES (%s, %s, %s, %s, %s, %s, %s, %s);"
+            blob_hash = None
             try:
-                _, id = db.query(
-                    query, (pid, img_path, row["name"], ServerConfig.DEFAULT_IMAGE_EXT))
-                cv2.imwrite(img_path, img)
+                data, ext, shape, img = image_store.prepare_image(
+                    base64.b64decode(row["image_data"]), row["ext"])
+                blob_hash, img_path = image_store.store_image(data, ext)
+
+                with db.transaction() as t:
+                    _, id = t.query(
+                        query, (pid, img_path, row["name"], ext) + tuple(shape) + (blob_hash,))
+                    project_stats.add_images(t, pid, 1)
+                blob_hash = None
+                image_store.process_stored_image(id, img_path, ext, shape, img)
             except DatabaseError as e:
                 response = {
                     "action": "failed",
@@ -322,23 +400,12 @@ class ProjectImageList(Resource):
                     "id": id
                 }
                 success_count += 1
+            if blob_hash is not None:
+                image_store.release_blob(blob_hash)
             bulk_response.append(response)
 
-        # Increment unlabeled image count
         if success_count > 0:
-            query = "UPDATE project SET unlabeled_count = unlabeled_count + %s WHERE project_id = %s"
-            try:
-                db.query(query, (success_count, pid))
-            except DatabaseError as e:
-                response = {
-                    "action": "failed",
-                    "error": {
-                        "code": 500,
-                        "message": e.msg
-                    }
-                }
-                bulk_response.append(response)
-                code = 200
+            query_cache.invalidate_project(pid)
         return {"results": bulk_response}, code
 
     @api.response(200, "OK", api.models['generic_response'])
@@ -349,16 +416,20 @@ class ProjectImageList(Resource):
         Deletes all images associated with this project as referenced by its identifier.
         """
 
-        q_get_image_ids = "SELECT image_id FROM image WHERE project_fid = %s"
+        q_get_images = "SELECT image_id, project_fid, is_labeled, blob_hash FROM image WHERE project_fid = %s FOR UPDATE"
         q_delete_annotations = "DELETE from instance_seg_meta WHERE image_id IN ("
-        q_delete_annotations += q_get_image_ids
+        q_delete_annotations += "SELECT image_id FROM image WHERE project_fid = %s"
         q_delete_annotations += ")"
         query = "DELETE FROM image WHERE project_fid = %s"
 
         try:
-            results, _ = db.query(q_get_image_ids, (pid,))
-            db.query(q_delete_annotations, (pid,))
-            db.query(query, (pid,))
+            with db.transaction() as t:
+                results, _ = t.query(q_get_images, (pid,))
+                t.query(q_delete_annotations, (pid,))
+                t.query(query, (pid,))
+                project_stats.remove_images(t, results)
+            query_cache.invalidate_project(pid)
+            image_store.release_images(results)
         except DatabaseError as e:
             response = {
                 "action": "failed",
@@ -380,93 +451,258 @@ class ProjectImageList(Resource):
         else:
             response = {
                 "action": "deleted",
-                "ids": [x[0] for x in results]
+                "ids": [row["image_id"] for row in results]
             }
             code = 200
 
         return response, code
 
 
+@api.doc(params={"pid": "An id associated with a project."})
+@api.route("/<int:pid>/images/claim")
+class ProjectImageClaim(Resource):
+    @api.response(200, "OK", api.models['image_lease'])
+    @api.response(404, "No image available", api.models['generic_response'])
+    @api.response(500, "Unexpected Failure", api.models['generic_response'])
+    def post(self, pid):
+        """
+        Claims the next unlabeled image of a project which no other client holds, locking it under a lease.
+
+        Concurrent claims always receive different images. Images whose lease has expired are claimed
+        again once no unlocked images remain.
+        """
+        try:
+            lease = image_leases.claim_next(pid)
+        except DatabaseError as e:
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 500,
+                    "message": e.msg
+                }
+            }
+            code = 500
+        else:
+            if lease is not None:
+                return marshal(lease, api.models['image_lease']), 200
+            response = {
+                "action": "failed",
+                "error": {
+                    "code": 404,
+                    "message": "Every unlabeled image in project with id %s, is locked." % pid
+                }
+            }
+            code = 404
+        return marshal(response, api.models['generic_response'], skip_none=True), code
+
+
+@api.doc(params={"pid": "An id associated with a project."})
+@api.route("/<int:pid>/images/multipart")
+class ProjectImageUpload(Resource):
+    @api.response(200, "Partial Success", api.models['bulk_response'])
+    @api.response(201, "Success", api.models['bulk_response'])
+    @api.marshal_with(api.models['bulk_response'], skip_none=True)
+    def post(self, pid):
+        """
+        A streaming bulk operation for adding images to a project, sent as multipart/form-data with one file per image.
+
+        Each file is written to disk as it is received and the images are inserted in batches.
+        The results are returned in the same order as the files.
+        """
+        upload_dir = image_store.get_upload_dir()
+        Path(upload_dir).mkdir(parents=True, exist_ok=True)
+        tmp_files = []
+
+        def stream_factory(total_content_length, content_type, filename, content_length=None):
+            tmp_file = tempfile.NamedTemporaryFile(dir=upload_dir, suffix=".upload", delete=False)
+            tmp_files.append(tmp_file)
+            return tmp_file
+
+        code = 201
+        success_count = 0
+        bulk_response = []
+        batch_size = max(1, int(ServerConfig.UPLOAD_BATCH_SIZE))
+        batch = []
+
+        def store_batch():
+            nonlocal code, success_count
+            for response in self._store_batch(pid, batch):
+                if response["action"] == "created":
+                    success_count += 1
+                else:
+                    code = 200
+                bulk_response.append(response)
+            batch.clear()
+
+        try:
+            boundary = parse_options_header(request.content_type or "")[1].get("boundary")
+            if not boundary:
+                return {"results": []}, 400
+            parser = MultiPartParser(stream_factory)
+            # Parts are yielded as soon as they have been received, so each file is closed once it is written
+            # and the images are stored while the rest of the request is still being read
+            parts = parser.parse_parts(request.stream, boundary.encode("ascii"), request.content_length)
+            for part_type, (_, upload) in parts:
+                if part_type != "file":
+                    continue
+                upload.stream.close()
+                batch.append((upload.stream.name, upload.filename))
+                if len(batch) >= batch_size:
+                    store_batch()
+            if batch:
+                store_batch()
+        finally:
+            # Files which were stored have been moved into the blob store, anything left was never stored
+            for tmp_file in tmp_files:
+                tmp_file.close()
+                if os.path.isfile(tmp_file.name):
+                    os.remove(tmp_file.name)
+            if success_count > 0:
+                query_cache.invalidate_project(pid)
+        return {"results": bulk_response}, code
+
+    @staticmethod
+    def _store_batch(pid, uploads):
+        """
+        Inserts a batch of uploaded files with a single query, falling back to one query per file if it fails.
+        :param uploads: A list of (tmp_path, filename) tuples, one per received file
+        :return: A list of responses, one per upload
+        """
+        responses = [None] * len(uploads)
+        rows = {}
+        for i, (tmp_path, filename) in enumerate(uploads):
+            name, ext = os.path.splitext(os.path.basename(filename or ""))
+            try:
+                if not name:
+                    raise ValueError("Uploaded files must have a file name.")
+                ext, shape, img = image_store.prepare_image_file(tmp_path, ext)
+                blob_hash, img_path = image_store.store_image_file(tmp_path, ext)
+            except BaseException as e:
+                if os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+                responses[i] = {
+                    "action": "failed",
+                    "error": {
+                        "code": 400,
+                        "message": str(e)
+                    }
+                }
+            else:
+                rows[i] = (blob_hash, img_path, name, ext, shape, img)
+
+        query = "INSERT INTO image (project_fid, image_path, image_name, image_ext, width, height, depth, blob_hash) "
+        query += "VALUES "
+        params = {}
+        for i, (blob_hash, img_path, name, ext, shape, _) in rows.items():
+            params[i] = (pid, img_path, name, ext) + tuple(shape) + (blob_hash,)
+
+        # The ids of the inserted rows, or the error which prevented their insertion, keyed by upload index
+        ids = {}
+        try:
+            if params:
+                with db.transaction() as t:
+                    values = list(params.values())
+                    t.query(query + ",".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(values)), sum(values, ()))
+                    project_stats.add_images(t, pid, len(values))
+                    q_get_ids = "SELECT image_id, image_name, image_ext FROM image "
+                    q_get_ids += "WHERE project_fid = %s AND (image_name, image_ext) IN (%s)"
+                    q_get_ids = q_get_ids % ("%s", ",".join(["(%s, %s)"] * len(values)))
+                    results, _ = t.query(q_get_ids, (pid,) + sum((p[2:4] for p in values), ()))
+                # Image paths are shared between identical uploads, but names are unique within the project,
+                # so the batch could only be inserted if none of its names were repeated
+                by_name = {(row["image_name"], row["image_ext"]): row["image_id"] for row in results}
+                ids = {i: by_name.get(p[2:4]) for i, p in params.items()}
+        except DatabaseError:
+            ids = {}
+            for i, p in params.items():
+                try:
+                    with db.transaction() as t:
+                        _, ids[i] = t.query(query + "(%s, %s, %s, %s, %s, %s, %s, %s)", p)
+                        project_stats.add_images(t, pid, 1)
+                except DatabaseError as e:
+                    ids[i] = e
+
+        for i, (blob_hash, img_path, name, ext, shape, img) in rows.items():
+            id = ids.get(i)
+            if id is None or isinstance(id, DatabaseError):
+                # Only the reference taken for this upload is released, rows which were inserted keep theirs
+                image_store.release_blob(blob_hash)
+                responses[i] = {
+                    "action": "failed",
+                    "error": {
+                        "code": 500,
+                        "message": id.msg if id is not None else "Failed to insert image '%s'." % name
+                    }
+                }
+                continue
+
+            try:
+                image_store.process_stored_image(id, img_path, ext, shape, img)
+            except BaseException as e:
+                responses[i] = {
+                    "action": "failed",
+                    "error": {
+                        "code": 500,
+                        "message": str(e)
+                    }
+                }
+            else:
+                responses[i] = {
+                    "action": "created",
+                    "id": id
+                }
+        return responses
+
+
 @api.doc(params={"pid": "An id associated with a project."})
 @api.route("/<int:pid>/dataset")
 class ProjectDataset(Resource):
+    @api.param(
+        'format',
+        description='The format of the export, either the default trimaps/xmls zip or coco for a COCO json document',
+        enum=['zip', 'coco'])
+    @api.param(
+        'cached',
+        description='A flag to download the cached export, updating only what changed',
+        type='boolean')
+    @api.param(
+        'since',
+        description='An export id, limiting the export to the changes made after it',
+        type='integer')
     def get(self, pid):
-        q_labelled_images = "SELECT image_id FROM fadb.image "
-        q_labelled_images += "WHERE project_fid = %s"
-        q_labelled_images += " and is_labeled = " + str(True)
-
-        q_images = "SELECT image_id, image_path, image_name, image_ext FROM image "
-        q_images += "WHERE image_id IN ("
-        q_images += q_labelled_images
-        q_images += ")"
-
-        q_annotations = "SELECT image_id, annotation_id, annotation_name, mask_path, info_path FROM instance_seg_meta "
-        q_annotations += "WHERE image_id IN ("
-        q_annotations += q_labelled_images
-        q_annotations += ")"
-
-        root_path = os.path.join(ServerConfig.DATA_ROOT_DIR, "export", str(pid))
-        rmtree(root_path, ignore_errors=True)
-
-        jpgs_folder = os.path.join(
-            ServerConfig.DATA_ROOT_DIR,
-            "export",
-            str(pid),
-            "jpgs")
-        mask_folder = os.path.join(
-            ServerConfig.DATA_ROOT_DIR,
-            "export",
-            str(pid),
-            "trimaps")
-        info_folder = os.path.join(
-            ServerConfig.DATA_ROOT_DIR,
-            "export",
-            str(pid),
-            "xmls")
-
-        Path(jpgs_folder).mkdir(parents=True, exist_ok=True)
-        Path(mask_folder).mkdir(parents=True, exist_ok=True)
-        Path(info_folder).mkdir(parents=True, exist_ok=True)
+        """
+        Exports the labelled images of a project as a zip or COCO json document, which is streamed as it is built.
 
+        Cached and delta exports report the id of the export in the X-Export-Id header. A delta export
+        also holds delta.json, listing the members removed since the given export.
+        """
+        headers = {
+            'Content-Type': 'application/zip',
+            'Content-Disposition': 'attachment; filename=%s.zip;' % str(pid)
+        }
         try:
-            images, _ = db.query(q_images, (pid,))
-            annotations, _ = db.query(q_annotations, (pid,))
-
-            image_dict = {}
-            annotation_count = {}
-
-            for row in images:
-                image_dict[row["image_id"]] = row["image_name"]
-                annotation_count[row["image_name"]] = 0
-                new_path = os.path.join(
-                    jpgs_folder, row["image_name"] + row["image_ext"])
-                copyfile(row["image_path"], new_path)
-
-            for row in annotations:
-                image_name = image_dict[row["image_id"]]
-                annotation_count[image_name] += 1
-                count = annotation_count[image_name]
-
-                new_mask_path = os.path.join(
-                    mask_folder, "%s_%04d%s" %
-                    (image_name, count, ServerConfig.DEFAULT_MASK_EXT))
-                new_info_path = os.path.join(
-                    info_folder, "%s_%04d%s" %
-                    (image_name, count, ServerConfig.DEFAULT_INFO_EXT))
-
-                copyfile(row["mask_path"], new_mask_path)
-                copyfile(row["info_path"], new_info_path)
-
-            # Make Zip File
-            make_archive(root_path, 'zip', root_path)
-            zipname = root_path + ".zip"
-            with open(zipname, 'rb') as f:
-                data = f.readlines()
-            os.remove(zipname)
-            return Response(data, headers={
-                'Content-Type': 'application/zip',
-                'Content-Disposition': 'attachment; filename=%s.zip;' % str(pid)
-            })
+            if request.args.get('format', 'zip') == 'coco':
+                return Response(stream_with_context(coco_export.stream_coco(pid)), headers={
+                    'Content-Type': 'application/json',
+                    'Content-Disposition': 'attachment; filename=%s.json;' % str(pid)
+                })
+
+            if request.args.get('since') is not None:
+                since = int(request.args.get('since'))
+                export_id, data = export_cache.stream_delta(pid, since)
+                headers['X-Export-Id'] = str(export_id)
+                headers['Content-Disposition'] = 'attachment; filename=%d_%d-%d.zip;' % (pid, since, export_id)
+                return Response(stream_with_context(data), headers=headers)
+
+            if request.args.get('cached', 'false').lower() == 'true':
+                # The zip is opened while the cache is locked, so it matches the manifest however long it is read
+                manifest, data = export_cache.stream_zip(pid)
+                headers['X-Export-Id'] = str(manifest["export_id"])
+                headers['Content-Length'] = str(manifest["size"])
+                return Response(stream_with_context(data), headers=headers)
+
+            members = dataset_export.get_members(pid)
+            return Response(stream_with_context(dataset_export.stream_zip(members)), headers=headers)
 
         except DatabaseError as e:
             response = {
@@ -496,7 +732,7 @@ class ProjectLabelList(Resource):
         q_labels += "WHERE project_fid = %s"
 
         try:
-            images, _ = db.query(q_labels, (pid,))
+            images = query_cache.get(("labels", pid), lambda: db.query(q_labels, (pid,))[0])
             labels = []
             for row in images:
                 label = {
@@ -544,6 +780,7 @@ class ProjectLabelList(Resource):
 
         try:
             db.query(q_add_labels, q_params)
+            query_cache.invalidate(("labels", pid))
             response = {
                 "action": "created"
             }
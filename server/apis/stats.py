@@ -0,0 +1,29 @@
+from flask_restplus import Namespace, Resource
+
+from server.core.query_cache import QueryCacheInstance
+from server.server_config import DatabaseInstance
+
+api = Namespace('stats', description='Server metrics for monitoring')
+
+db = DatabaseInstance()
+
+
+@api.route("/database")
+class DatabaseStats(Resource):
+    @api.response(200, "OK")
+    def get(self):
+        """
+        Gets the state of the database connection pool. Counters and the cumulative wait time
+        histogram, keyed by the upper bound of each bucket in seconds, count up from server start.
+        """
+        return db.get_stats(), 200
+
+
+@api.route("/cache")
+class CacheStats(Resource):
+    @api.response(200, "OK")
+    def get(self):
+        """
+        Gets the hit, miss and invalidation counts of the project and label query cache since server start.
+        """
+        return QueryCacheInstance().get_stats(), 200
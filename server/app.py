@@ -14,5 +14,11 @@ if __name__ == "__main__":
     app.config['RESTPLUS_MASK_SWAGGER'] = False
 
     api.init_app(app)
+
+    # The debug reloader runs this script in a watcher process too, which shouldn't run jobs
+    if not ServerConfig.SERVER_DEBUG or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        from server.core.jobs import JobQueueInstance
+        JobQueueInstance().start(ServerConfig.JOB_WORKER_COUNT)
+
     host = '0.0.0.0' if ServerConfig.SERVER_PUBLIC else 'localhost'
     app.run(debug=ServerConfig.SERVER_DEBUG, host=host, port=ServerConfig.SERVER_PORT, threaded=True)
@@ -0,0 +1,187 @@
+import os
+import uuid
+from collections import OrderedDict
+
+import server.utils as utils
+from server.core.worker_pool import WorkerPoolInstance
+from server.server_config import DatabaseInstance
+from server.server_config import ServerConfig
+
+db = DatabaseInstance()
+
+INFO_COLUMNS = ("source_height", "source_width", "source_depth", "bbox_x", "bbox_y", "bbox_w", "bbox_h")
+
+
+def get_mask_path(iid, name):
+    """
+    Gets a new path for a mask of an image. Each saved mask gets its own file, so a save never
+    overwrites the masks of the annotations it replaces until it has been committed.
+    """
+    filename = "%s_%s%s" % (name, uuid.uuid4().hex[:12], utils.COMPACT_MASK_EXT)
+    return os.path.join(ServerConfig.DATA_ROOT_DIR, "annotation", str(iid), "masks", filename)
+
+
+def get_info(shape, bbox, resize_shape=None):
+    """
+    Gets the info columns of an annotation, scaling its bounding box when its mask is resized.
+    :param shape: The (height, width, depth) of the image the annotation was made on
+    :param bbox: The bounding box of the annotation as (x, y, width, height)
+    :return: A tuple of the values of INFO_COLUMNS
+    """
+    if resize_shape is not None:
+        scale = resize_shape[0] / shape[0]
+        shape = resize_shape
+        bbox = [int(v * scale) for v in bbox]
+    depth = shape[2] if len(shape) > 2 else 1
+    return (int(shape[0]), int(shape[1]), int(depth)) + tuple(int(v) for v in bbox)
+
+
+def get_shape(row):
+    return [row["source_height"], row["source_width"], row["source_depth"]]
+
+
+def get_bbox(row):
+    return [row["bbox_x"], row["bbox_y"], row["bbox_w"], row["bbox_h"]]
+
+
+def build_info(row):
+    """
+    Builds the Pascal VOC style xml of an annotation row, which is only needed by exports.
+    """
+    return utils.build_info(get_shape(row), get_bbox(row), row["class_name"])
+
+
+def fill_legacy_info(rows):
+    """
+    Reads the info of annotations saved by older servers, which kept it in an xml file, into their rows.
+    The info is copied to the database so each file is only read once. Each row is locked while it is
+    migrated, so concurrent reads of the same annotation wait for the first and then use its columns.
+    :param rows: Annotation rows holding annotation_id, info_path and INFO_COLUMNS
+    """
+    q_get = "SELECT info_path, " + ", ".join(INFO_COLUMNS)
+    q_get += " FROM instance_seg_meta WHERE annotation_id = %s FOR UPDATE"
+    q_update = "UPDATE instance_seg_meta SET info_path = NULL, "
+    q_update += ", ".join("%s = %%s" % c for c in INFO_COLUMNS)
+    q_update += " WHERE annotation_id = %s"
+    for row in rows:
+        if row["source_height"] is not None or row["info_path"] is None:
+            continue
+        info_path = row["info_path"]
+        with db.transaction() as t:
+            result, _ = t.query(q_get, (row["annotation_id"],))
+            if not result:
+                continue
+            current = result[0]
+            if current["source_height"] is None and current["info_path"] is not None:
+                try:
+                    info = utils.load_info(current["info_path"])
+                except OSError:
+                    # The file is gone without its info being copied, so there is nothing left to migrate
+                    continue
+                # Older servers kept the bbox as given by the client, as (x, y, width, height)
+                values = get_info(info["source_shape"], info["bbox"])
+                t.query(q_update, values + (row["annotation_id"],))
+                current.update(zip(INFO_COLUMNS, values), info_path=None)
+        row.update(current)
+        # The file is only removed once the columns are committed
+        if row["info_path"] is None:
+            try:
+                os.remove(info_path)
+            except OSError:
+                pass
+    return rows
+
+
+def save_annotations(iid, annotations, deleted=(), replace=True):
+    """
+    Saves the annotations of an image. The masks are written to new files concurrently, then the rows
+    are changed in a single transaction, so a failure leaves the previous annotations intact.
+    When several annotations share a name the last one is kept.
+    :param annotations: A list of dicts holding the name, class_name, mask, info, a tuple of the values
+    of INFO_COLUMNS, and optionally the resize_shape of the mask of each annotation
+    :param deleted: The names of annotations to delete
+    :param replace: Whether annotations replace every annotation of the image. Otherwise annotations
+    which already exist are updated in place, keeping their ids, and the rest are left untouched
+    :return: A dict mapping the names of the image's annotations to their ids
+    """
+    annotations = list(OrderedDict((a["name"], a) for a in annotations).values())
+    paths = [get_mask_path(iid, a["name"]) for a in annotations]
+
+    q_old = "SELECT mask_path, info_path FROM instance_seg_meta WHERE image_id = %s"
+    q_delete = "DELETE FROM instance_seg_meta WHERE image_id = %s"
+    q_insert = "INSERT INTO instance_seg_meta (annotation_name, image_id, mask_path, class_name, "
+    q_insert += ", ".join(INFO_COLUMNS) + ") VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+    q_insert += " ON DUPLICATE KEY UPDATE revision = revision + 1, "
+    q_insert += ", ".join("%s = VALUES(%s)" % (c, c) for c in ("mask_path", "class_name") + INFO_COLUMNS)
+    q_ids = "SELECT annotation_id, annotation_name FROM instance_seg_meta WHERE image_id = %s"
+
+    def write(item):
+        annotation, path = item
+        utils.save_mask(annotation["mask"], path, resize_shape=annotation.get("resize_shape"))
+
+    def by_name(query, names):
+        return query + " AND annotation_name IN (%s)" % ", ".join(["%s"] * len(names)), (iid,) + tuple(names)
+
+    try:
+        for _ in WorkerPoolInstance().imap(write, zip(annotations, paths)):
+            pass
+        with db.transaction() as t:
+            if replace:
+                old_rows, _ = t.query(q_old, (iid,))
+                t.query(q_delete, (iid,))
+            else:
+                names = [a["name"] for a in annotations] + list(deleted)
+                old_rows, _ = t.query(*by_name(q_old, names)) if names else ([], None)
+                if deleted:
+                    t.query(*by_name(q_delete, deleted))
+            if annotations:
+                t.executemany(q_insert, [
+                    (a["name"], iid, path, a["class_name"]) + tuple(a["info"]) for a, path in zip(annotations, paths)])
+            results, _ = t.query(q_ids, (iid,))
+    except BaseException:
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+
+    remove_unused_masks(iid, old_rows)
+    return {row["annotation_name"]: row["annotation_id"] for row in results}
+
+
+def remove_unused_masks(iid, old_rows):
+    """
+    Deletes the mask files of an image's previous annotations which are no longer referenced, along
+    with any info files left by older servers.
+    :param old_rows: The rows of the annotations replaced, each containing a mask_path and info_path
+    """
+    results, _ = db.query("SELECT mask_path FROM instance_seg_meta WHERE image_id = %s", (iid,))
+    in_use = set(row["mask_path"] for row in results)
+    unused = [row["mask_path"] for row in old_rows if row["mask_path"] not in in_use]
+    unused += [row["info_path"] for row in old_rows if row["info_path"] is not None]
+    for path in unused:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def compact_masks(image_ids, progress=None):
+    """
+    Converts the masks of images stored as full size images by older servers to the compact mask format.
+    :param progress: An optional callable taking the fraction of the images which are converted
+    """
+    q_masks = "SELECT annotation_id, annotation_name, mask_path FROM instance_seg_meta WHERE image_id = %s"
+    q_update = "UPDATE instance_seg_meta SET mask_path = %s, revision = revision + 1 WHERE annotation_id = %s"
+    for i, iid in enumerate(image_ids):
+        results, _ = db.query(q_masks, (iid,))
+        for row in results:
+            if os.path.splitext(row["mask_path"])[1].lower() == utils.COMPACT_MASK_EXT:
+                continue
+            mask_path = get_mask_path(iid, row["annotation_name"])
+            utils.save_mask(utils.load_mask(row["mask_path"]), mask_path)
+            db.query(q_update, (mask_path, row["annotation_id"]))
+            os.remove(row["mask_path"])
+        if progress is not None:
+            progress((i + 1) / len(image_ids))
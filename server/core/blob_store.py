@@ -0,0 +1,120 @@
+import hashlib
+import os
+from collections import Counter
+from pathlib import Path
+
+from server.server_config import DatabaseInstance
+from server.server_config import ServerConfig
+
+db = DatabaseInstance()
+
+
+class BlobStore:
+    """
+    A content addressed store for image files, so identical uploads share a single file on disk.
+
+    Each blob is named by the SHA-256 of its contents and has a row in the image_blob table counting the
+    image rows which reference it. A blob is deleted once its last reference is released. Files are only
+    written or deleted in the transaction which changes the count of their blob, while it holds the lock
+    on the blob's row, so a blob can't be deleted while another process or thread is re-adding it.
+    """
+
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        # Incoming files are written here first, so they can be moved into the store without copying
+        self.upload_dir = os.path.join(root_dir, "uploads")
+
+    def get_path(self, blob_hash, ext):
+        return os.path.join(self.root_dir, blob_hash[:2], blob_hash[2:4], blob_hash + ext)
+
+    def put_bytes(self, data, ext, count=1):
+        """
+        Adds count references to the blob holding data, writing it to disk if it is new.
+        :return: A tuple of (blob_hash, blob_path)
+        """
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.get_path(blob_hash, ext)
+        with db.transaction() as t:
+            self._add_references(t, blob_hash, path, ext, len(data), count)
+            if not os.path.isfile(path):
+                Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+                with open(path + ".tmp", 'wb') as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+        return blob_hash, path
+
+    def put_file(self, src_path, ext, count=1):
+        """
+        Adds count references to the blob holding the contents of src_path. The file is moved into the
+        store if the blob is new and deleted otherwise.
+        :return: A tuple of (blob_hash, blob_path)
+        """
+        sha = hashlib.sha256()
+        with open(src_path, 'rb') as f:
+            chunk = f.read(self.HASH_CHUNK_SIZE)
+            while chunk:
+                sha.update(chunk)
+                chunk = f.read(self.HASH_CHUNK_SIZE)
+        blob_hash = sha.hexdigest()
+        path = self.get_path(blob_hash, ext)
+
+        with db.transaction() as t:
+            self._add_references(t, blob_hash, path, ext, os.path.getsize(src_path), count)
+            if os.path.isfile(path):
+                os.remove(src_path)
+            else:
+                Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+                os.replace(src_path, path)
+        return blob_hash, path
+
+    def release(self, blob_hash, count=1):
+        """
+        Removes count references from a blob, deleting it once no references remain.
+        """
+        if blob_hash is None:
+            return
+
+        q_blob = "SELECT blob_path, ref_count FROM image_blob WHERE blob_hash = %s FOR UPDATE"
+        q_release = "UPDATE image_blob SET ref_count = ref_count - %s WHERE blob_hash = %s"
+        q_delete = "DELETE FROM image_blob WHERE blob_hash = %s"
+        with db.transaction() as t:
+            rows, _ = t.query(q_blob, (blob_hash,))
+            if not rows:
+                return
+            if rows[0]["ref_count"] > count:
+                t.query(q_release, (count, blob_hash))
+                return
+            t.query(q_delete, (blob_hash,))
+            # The file is deleted before the row lock is released, so a put waiting on it writes a new copy
+            try:
+                os.remove(rows[0]["blob_path"])
+            except OSError:
+                pass
+
+    def release_all(self, blob_hashes):
+        """
+        Releases one reference for every hash in blob_hashes, ignoring hashes of None.
+        """
+        for blob_hash, count in Counter(blob_hashes).items():
+            self.release(blob_hash, count)
+
+    @staticmethod
+    def _add_references(t, blob_hash, path, ext, size, count):
+        """
+        Adds references to a blob, leaving its row locked by t until the file has been stored.
+        """
+        query = "INSERT INTO image_blob (blob_hash, blob_path, blob_ext, blob_size, ref_count) "
+        query += "VALUES (%s, %s, %s, %s, %s) "
+        query += "ON DUPLICATE KEY UPDATE ref_count = ref_count + VALUES(ref_count)"
+        t.query(query, (blob_hash, path, ext, size, count))
+
+
+class BlobStoreInstance:
+    __instance = None
+
+    def __new__(cls):
+        if BlobStoreInstance.__instance is None:
+            BlobStoreInstance.__instance = BlobStore(os.path.join(ServerConfig.DATA_ROOT_DIR, ServerConfig.BLOB_DIR))
+        return BlobStoreInstance.__instance
@@ -0,0 +1,130 @@
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+import server.core.dataset_export as dataset_export
+import server.utils as utils
+from server.core.worker_pool import WorkerPoolInstance
+from server.server_config import DatabaseInstance
+
+db = DatabaseInstance()
+
+
+def mask_to_rle(mask):
+    """
+    Run length encodes a boolean mask in the uncompressed COCO format. Runs are counted down the
+    columns, alternating between background and foreground and starting with background.
+    :return: A tuple of (counts, area, bbox), where bbox is [x, y, width, height]
+    """
+    flat = mask.ravel(order='F')
+    if flat.size == 0:
+        return [], 0, [0, 0, 0, 0]
+
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+
+    area = int(np.count_nonzero(flat))
+    if area == 0:
+        return counts.tolist(), 0, [0, 0, 0, 0]
+    cols = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+    bbox = [int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)]
+    return counts.tolist(), area, bbox
+
+
+def encode_annotations(item):
+    """
+    Builds the COCO annotations of a single image from its stored masks.
+    :param item: A tuple of (image_row, annotation_rows, category_ids)
+    :return: A tuple of (width, height, annotations)
+    """
+    image, annotations, category_ids = item
+    width, height = image["width"], image["height"]
+    if not annotations:
+        width, height = dataset_export.get_image_size(image)
+    results = []
+    for row in annotations:
+        mask = utils.load_mask(row["mask_path"])
+        if mask is None:
+            raise IOError("Failed to read the mask of annotation %d." % row["annotation_id"])
+        height, width = mask.shape
+        counts, area, bbox = mask_to_rle(mask)
+        results.append(OrderedDict([
+            ("id", row["annotation_id"]),
+            ("image_id", row["image_id"]),
+            ("category_id", category_ids[row["class_name"]]),
+            ("segmentation", {"size": [height, width], "counts": counts}),
+            ("area", area),
+            ("bbox", bbox),
+            ("iscrowd", 0)
+        ]))
+    return width, height, results
+
+
+def get_categories(pid, annotations):
+    """
+    Numbers the classes of a project from 1 in the order they were added, followed by any classes which
+    are only named by annotations.
+    :return: An OrderedDict mapping class names to category ids
+    """
+    query = "SELECT label_name FROM instance_seg_labels WHERE project_fid = %s ORDER BY label_id"
+    results, _ = db.query(query, (pid,))
+    names = [row["label_name"] for row in results]
+    names += sorted(set(row["class_name"] for row in annotations) - set(names))
+    return OrderedDict((name, i + 1) for i, name in enumerate(names))
+
+
+def stream_coco(pid, progress=None):
+    """
+    Builds a generator of the labelled images of a project and their annotations as a COCO json
+    document. Masks are encoded in parallel a few images at a time, so only the annotations of those
+    images are held in memory. The project is read before this returns, so database errors are raised
+    here rather than while streaming.
+    :param progress: An optional callable taking the fraction of the export which is complete
+    """
+    images, annotations = dataset_export.get_labelled_rows(pid)
+    categories = get_categories(pid, annotations)
+
+    by_image = OrderedDict((row["image_id"], []) for row in images)
+    for row in annotations:
+        by_image[row["image_id"]].append(row)
+    items = [(image, by_image[image["image_id"]], categories) for image in images]
+
+    def generate():
+        yield '{"info": %s, "categories": ' % json.dumps({"description": "FastAnnotation project %d" % pid})
+        yield json.dumps([{"id": i, "name": name} for name, i in categories.items()])
+
+        yield ', "annotations": ['
+        sizes = []
+        first = True
+        for i, (width, height, results) in enumerate(WorkerPoolInstance().imap(encode_annotations, items)):
+            sizes.append((width, height))
+            for annotation in results:
+                yield ("" if first else ", ") + json.dumps(annotation)
+                first = False
+            if progress is not None:
+                progress((i + 1) / len(items))
+
+        yield '], "images": '
+        yield json.dumps([{
+            "id": image["image_id"],
+            "file_name": image["image_name"] + image["image_ext"],
+            "width": width,
+            "height": height
+        } for image, (width, height) in zip(images, sizes)])
+        yield '}'
+
+    return generate()
+
+
+def export_coco(pid, json_path, progress=None):
+    """
+    Writes the COCO json document of a project to a file.
+    """
+    with open(json_path, 'w') as f:
+        for chunk in stream_coco(pid, progress):
+            f.write(chunk)
+    return json_path
@@ -42,5 +42,20 @@ common_store.add_dto(Model('bulk_response', {
 }))
 
 
+common_store.add_dto(Model('image_lease', {
+    'id': fields.Integer(attribute='image_id', description="The identifier of the leased image"),
+    'name': fields.String(attribute='image_name', description="The name of the leased image"),
+    'token': fields.String(
+        attribute='lease_token',
+        description="The token identifying the holder of the lease, needed to renew or release it"),
+    'expires': fields.DateTime(attribute='lease_expires', description="When the lease expires unless renewed"),
+    'seconds': fields.Integer(attribute='lease_seconds', description="The length of the lease in seconds")
+}))
+
+common_store.add_dto(Model('lease_request', {
+    'token': fields.String(required=False, description="The token of the lease to renew or release")
+}))
+
+
 common_store.add_dto(Model('bulk_id_request', {'ids': fields.List(
     fields.Integer, required=True, description="The list of ids.")}))
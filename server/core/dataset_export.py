@@ -0,0 +1,207 @@
+import functools
+import io
+import os
+import time
+import zipfile
+from collections import Counter
+
+import server.core.annotation_store as annotation_store
+import server.utils as utils
+from server.server_config import DatabaseInstance
+from server.server_config import ServerConfig
+
+db = DatabaseInstance()
+
+# Members which are already compressed are stored as is rather than deflated again
+STORED_EXTS = (".png", ".jpg", ".jpeg")
+CHUNK_SIZE = 1024 * 1024
+# The number of bytes read when probing the dimensions of an image from its header
+PROBE_SIZE = 256 * 1024
+
+
+class _StreamBuffer:
+    """
+    A write only file object holding the bytes written to it until they are taken.
+    Zip files written to it are written without seeking, so they can be streamed as they are built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def get_labelled_rows(pid):
+    """
+    Gets the labelled images of a project along with their annotations.
+    :return: A tuple of (images, annotations)
+    """
+    q_labelled_images = "SELECT image_id FROM fadb.image "
+    q_labelled_images += "WHERE project_fid = %s"
+    q_labelled_images += " and is_labeled = 1"
+
+    q_images = "SELECT image_id, image_path, image_name, image_ext, revision, width, height, is_swapped FROM image "
+    q_images += "WHERE image_id IN ("
+    q_images += q_labelled_images
+    q_images += ") ORDER BY image_id"
+
+    q_annotations = "SELECT image_id, annotation_id, annotation_name, mask_path, info_path, class_name, revision, "
+    q_annotations += ", ".join(annotation_store.INFO_COLUMNS)
+    q_annotations += " FROM instance_seg_meta "
+    q_annotations += "WHERE image_id IN ("
+    q_annotations += q_labelled_images
+    q_annotations += ") ORDER BY annotation_id"
+
+    images, _ = db.query(q_images, (pid,))
+    annotations, _ = db.query(q_annotations, (pid,))
+    return images, annotation_store.fill_legacy_info(annotations)
+
+
+def get_members(pid):
+    """
+    Lays out the export of a project, with the images in jpgs/, the masks in trimaps/ and the
+    annotation info in xmls/. Annotations are numbered per image in the order they were created.
+    Masks and info are named after the image name, or after its file name when another image in the
+    project shares its name with a different extension.
+    :return: A list of (archive_name, source, version) tuples, where source is either the path of a
+    file or a callable building the content of the member, and version changes whenever the content
+    of the member may have changed
+    """
+    images, annotations = get_labelled_rows(pid)
+
+    members = []
+    image_dict = {}
+    annotation_count = {}
+    name_count = Counter(row["image_name"] for row in images)
+
+    for row in images:
+        stem = row["image_name"]
+        if name_count[stem] > 1:
+            stem += row["image_ext"]
+        image_dict[row["image_id"]] = stem
+        annotation_count[row["image_id"]] = 0
+        members.append((
+            "jpgs/" + row["image_name"] + row["image_ext"],
+            get_image_source(row),
+            "image:%d:%d" % (row["image_id"], row["revision"])))
+
+    for row in annotations:
+        image_name = image_dict[row["image_id"]]
+        annotation_count[row["image_id"]] += 1
+        count = annotation_count[row["image_id"]]
+
+        version = "annotation:%d:%d" % (row["annotation_id"], row["revision"])
+        members.append((
+            "trimaps/%s_%04d%s" % (image_name, count, ServerConfig.DEFAULT_MASK_EXT), row["mask_path"], version))
+        members.append((
+            "xmls/%s_%04d%s" % (image_name, count, ServerConfig.DEFAULT_INFO_EXT),
+            functools.partial(annotation_store.build_info, row),
+            version))
+    return members
+
+
+def get_image_source(row):
+    """
+    Gets the source of the exported copy of an image. Legacy images stored with their red and blue
+    channels swapped are re-encoded with the channels in order, until they have been transcoded.
+    """
+    if row["is_swapped"]:
+        return functools.partial(utils.render_image, row["image_path"], row["image_ext"], is_swapped=True)
+    return row["image_path"]
+
+
+def get_image_size(row):
+    """
+    Gets the (width, height) of an image row. Legacy rows which predate the width and height columns
+    are measured from the header of their file, or by decoding it if the format is not recognised.
+    """
+    if row["width"] is not None and row["height"] is not None:
+        return row["width"], row["height"]
+    with open(row["image_path"], 'rb') as f:
+        probe = utils.probe_image(f.read(PROBE_SIZE))
+    if probe is not None:
+        return probe[1], probe[2]
+    height, width = utils.read_image(row["image_path"]).shape[:2]
+    return width, height
+
+
+def get_compress_type(archive_name):
+    if os.path.splitext(archive_name)[1].lower() in STORED_EXTS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def write_member(zf, archive_name, source):
+    """
+    Copies a file into a zip a chunk at a time, yielding after each chunk is written.
+    Compact masks are written as the image they encode, and callable sources are written as the bytes
+    they return.
+    """
+    if callable(source):
+        zinfo = zipfile.ZipInfo(archive_name, time.localtime()[:6])
+        zinfo.compress_type = get_compress_type(archive_name)
+        yield from copy_member(zf, zinfo, io.BytesIO(source()))
+        return
+
+    zinfo = zipfile.ZipInfo.from_file(source, archive_name)
+    zinfo.compress_type = get_compress_type(archive_name)
+    if source.lower().endswith(utils.COMPACT_MASK_EXT):
+        yield from copy_member(zf, zinfo, io.BytesIO(utils.load_mask_bytes(source)))
+        return
+    with open(source, 'rb') as src:
+        yield from copy_member(zf, zinfo, src)
+
+
+def copy_member(zf, zinfo, src):
+    """
+    Copies the contents of a readable file object into a zip as the member zinfo, yielding after each
+    chunk is written.
+    """
+    with zf.open(zinfo, 'w') as dst:
+        chunk = src.read(CHUNK_SIZE)
+        while chunk:
+            dst.write(chunk)
+            yield
+            chunk = src.read(CHUNK_SIZE)
+
+
+def stream_zip(members):
+    """
+    Generates a zip of members as it is built, reading each member straight from its source file.
+    :param members: A list of (archive_name, source, version) tuples
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for archive_name, source, _ in members:
+            for _ in write_member(zf, archive_name, source):
+                data = buffer.take()
+                if data:
+                    yield data
+    yield buffer.take()
+
+
+def export_dataset(pid, zip_path, progress=None, members=None):
+    """
+    Writes the export of a project to a zip file.
+    :param progress: An optional callable taking the fraction of the export which is complete
+    :param members: The members to write, which default to the current members of the project
+    """
+    if members is None:
+        members = get_members(pid)
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for i, (archive_name, source, _) in enumerate(members):
+            for _ in write_member(zf, archive_name, source):
+                pass
+            if progress is not None:
+                progress((i + 1) / len(members))
+    return zip_path
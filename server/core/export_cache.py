@@ -0,0 +1,342 @@
+import io
+import json
+import os
+import shutil
+import time
+import zipfile
+from pathlib import Path
+
+import server.core.dataset_export as dataset_export
+from server.server_config import ServerConfig
+
+
+class ExportCache:
+    """
+    A cache of the latest dataset export of each project, updated in place as the project changes.
+
+    Each project has an export zip and a json manifest recording the version of every member, the id of
+    the export which last changed it and the size of the zip. Every update which finds changes gets the
+    next export id. Changed members are appended to the zip in place along with a new central directory,
+    which leaves out the entries they replace, so an update only writes the members which changed. The
+    space held by dropped entries is reclaimed by rebuilding the zip once it outweighs the live members.
+
+    As appends never change the bytes already written, every export is a prefix of the zip which holds
+    it, and is read through a view of the size recorded for it. A zip which has been linked elsewhere as
+    a snapshot is copied before it is appended to, and rebuilt zips replace the old one.
+
+    Updates of a project are serialized with a lock file, so the cache may be shared between processes.
+    """
+
+    LOCK_TIMEOUT = 3600
+    LOCK_POLL_INTERVAL = 0.5
+    # The most removed members recorded for delta exports, older removals are pruned beyond it
+    REMOVED_LIMIT = 10000
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def get_zip_path(self, pid):
+        return os.path.join(self.root_dir, str(pid), "dataset.zip")
+
+    def update(self, pid, progress=None):
+        """
+        Brings the cached export of a project up to date.
+        :param progress: An optional callable taking the fraction of the update which is complete
+        :return: The manifest of the export
+        """
+        members = dataset_export.get_members(pid)
+        Path(os.path.join(self.root_dir, str(pid))).mkdir(parents=True, exist_ok=True)
+        with self._lock(pid):
+            return self._update(pid, members, progress)
+
+    def open_zip(self, pid, progress=None):
+        """
+        Brings the cached export of a project up to date and opens its zip, which later updates won't change.
+        :return: A tuple of (manifest, file)
+        """
+        members = dataset_export.get_members(pid)
+        Path(os.path.join(self.root_dir, str(pid))).mkdir(parents=True, exist_ok=True)
+        with self._lock(pid):
+            manifest = self._update(pid, members, progress)
+            return manifest, _FilePrefix(self.get_zip_path(pid), manifest["size"])
+
+    def stream_zip(self, pid, progress=None):
+        """
+        Brings the cached export of a project up to date and generates its zip.
+        :return: A tuple of (manifest, generator)
+        """
+        manifest, zip_file = self.open_zip(pid, progress)
+
+        def generate():
+            with zip_file:
+                chunk = zip_file.read(dataset_export.CHUNK_SIZE)
+                while chunk:
+                    yield chunk
+                    chunk = zip_file.read(dataset_export.CHUNK_SIZE)
+
+        return manifest, generate()
+
+    def snapshot(self, pid, path, progress=None):
+        """
+        Brings the cached export of a project up to date and links its zip to path, so the file at path
+        stays the export of this update.
+        :return: The manifest of the export
+        """
+        members = dataset_export.get_members(pid)
+        Path(os.path.join(self.root_dir, str(pid))).mkdir(parents=True, exist_ok=True)
+        with self._lock(pid):
+            manifest = self._update(pid, members, progress)
+            # Drops anything left past the export by an interrupted update, as the snapshot is read whole
+            os.truncate(self.get_zip_path(pid), manifest["size"])
+            try:
+                os.link(self.get_zip_path(pid), path)
+            except OSError:
+                shutil.copyfile(self.get_zip_path(pid), path)
+        return manifest
+
+    def stream_delta(self, pid, since, progress=None):
+        """
+        Brings the cached export of a project up to date and generates a zip of the members changed by
+        later exports than since. The zip also holds delta.json, listing the export id and the members
+        removed since. If the cache was rebuilt from scratch at or after export since, or the removals
+        after it have been pruned, every member is included and delta.json is marked as complete, as the
+        removals before then are not known.
+        :return: A tuple of (export_id, generator)
+        """
+        manifest, zip_file = self.open_zip(pid, progress)
+        complete = since < manifest["base_export_id"]
+        names = [n for n, m in manifest["members"].items() if complete or m["export_id"] > since]
+        removed = [n for n, export_id in manifest["removed"].items() if export_id > since]
+        info = {"export_id": manifest["export_id"], "since": since, "complete": complete, "removed": removed}
+
+        def generate():
+            buffer = dataset_export._StreamBuffer()
+            with zip_file, zipfile.ZipFile(zip_file, 'r') as src, zipfile.ZipFile(buffer, 'w') as dst:
+                dst.writestr("delta.json", json.dumps(info))
+                for name in names:
+                    src_info = src.getinfo(name)
+                    zinfo = zipfile.ZipInfo(name, date_time=src_info.date_time)
+                    zinfo.file_size = src_info.file_size
+                    zinfo.compress_type = src_info.compress_type
+                    with src.open(src_info) as f:
+                        for _ in dataset_export.copy_member(dst, zinfo, f):
+                            data = buffer.take()
+                            if data:
+                                yield data
+            yield buffer.take()
+
+        return manifest["export_id"], generate()
+
+    def _update(self, pid, members, progress):
+        """
+        Updates the cached export of a project to hold members, while holding its lock.
+        """
+        manifest = self._load_manifest(pid)
+        fresh = manifest["base_export_id"] > manifest["export_id"]
+        current = manifest["members"]
+
+        latest = set(m[0] for m in members)
+        changed = [m for m in members if m[0] not in current or current[m[0]]["version"] != m[2]]
+        removed = [name for name in current if name not in latest]
+        if not fresh and not changed and not removed:
+            return manifest
+
+        export_id = manifest["export_id"] + 1
+        stale = removed + [m[0] for m in changed if m[0] in current]
+        live_bytes = sum(m["size"] for name, m in current.items() if name not in stale)
+        dead_bytes = manifest["dead_bytes"] + sum(current[name]["size"] for name in stale)
+
+        if fresh or dead_bytes > live_bytes:
+            sizes = self._rebuild(pid, members, export_id, progress)
+            dead_bytes = 0
+        else:
+            sizes, directory_bytes = self._append(pid, changed, stale, export_id, progress, manifest["size"])
+            dead_bytes += directory_bytes
+
+        for name in removed:
+            current.pop(name)
+            manifest["removed"][name] = export_id
+        for name, path, version in changed:
+            current[name] = {"version": version, "export_id": export_id, "size": sizes[name]}
+            manifest["removed"].pop(name, None)
+        if fresh:
+            manifest["base_export_id"] = export_id
+        self._prune_removed(manifest)
+        manifest["export_id"] = export_id
+        manifest["dead_bytes"] = dead_bytes
+        manifest["size"] = os.path.getsize(self.get_zip_path(pid))
+        self._save_manifest(pid, manifest)
+        return manifest
+
+    def _rebuild(self, pid, members, export_id, progress):
+        zip_path = self.get_zip_path(pid)
+        dataset_export.export_dataset(pid, zip_path + ".tmp", progress, members)
+        with zipfile.ZipFile(zip_path + ".tmp", 'a') as zf:
+            zf.comment = str(export_id).encode('utf-8')
+            sizes = {info.filename: self._get_entry_size(info) for info in zf.infolist()}
+        os.replace(zip_path + ".tmp", zip_path)
+        return sizes
+
+    def _append(self, pid, changed, stale, export_id, progress, size):
+        """
+        Appends changed members to the zip after its last export, which is size bytes long.
+        :return: A tuple of (sizes, directory_bytes), where directory_bytes is the size of the central
+        directory of the last export, which is left unused
+        """
+        zip_path = self.get_zip_path(pid)
+        if os.stat(zip_path).st_nlink > 1:
+            # The zip is also a snapshot, which must stay as it is
+            shutil.copyfile(zip_path, zip_path + ".tmp")
+            os.replace(zip_path + ".tmp", zip_path)
+
+        sizes = {}
+        with open(zip_path, 'r+b') as f:
+            # Drops anything written by an interrupted update
+            f.truncate(size)
+            with zipfile.ZipFile(f, 'a') as zf:
+                # Members are written after the central directory of the last export rather than over it,
+                # so the zip of the last export is left intact as the first size bytes of the file
+                directory_bytes = size - zf.start_dir
+                zf.start_dir = size
+                # Dropping an entry from the central directory removes it from the zip, leaving its data unused
+                for name in stale:
+                    zf.filelist.remove(zf.NameToInfo.pop(name))
+                for i, (name, path, _) in enumerate(changed):
+                    for _ in dataset_export.write_member(zf, name, path):
+                        pass
+                    sizes[name] = self._get_entry_size(zf.getinfo(name))
+                    if progress is not None:
+                        progress((i + 1) / len(changed))
+                zf.comment = str(export_id).encode('utf-8')
+        return sizes, directory_bytes
+
+    def _prune_removed(self, manifest):
+        """
+        Forgets the oldest removals once there are more than REMOVED_LIMIT, moving the base export id past
+        them so delta exports since before them are complete.
+        """
+        removed = manifest["removed"]
+        if len(removed) <= self.REMOVED_LIMIT:
+            return
+        pruned = sorted(removed.items(), key=lambda r: r[1])[:len(removed) - self.REMOVED_LIMIT]
+        cutoff = pruned[-1][1]
+        manifest["removed"] = {name: export_id for name, export_id in removed.items() if export_id > cutoff}
+        manifest["base_export_id"] = max(manifest["base_export_id"], cutoff)
+
+    @staticmethod
+    def _get_entry_size(info):
+        # The data of an entry along with its local header, name and extra field
+        return info.compress_size + 30 + len(info.filename.encode('utf-8')) + len(info.extra)
+
+    def _load_manifest(self, pid):
+        """
+        Loads the manifest of a project. If the manifest is missing or doesn't match the export zip,
+        such as when an update was interrupted, an empty manifest continuing from the last known export
+        id is returned instead.
+        """
+        try:
+            with open(self._get_manifest_path(pid), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {"export_id": 0}
+
+        try:
+            with _FilePrefix(self.get_zip_path(pid), manifest["size"]) as f, zipfile.ZipFile(f, 'r') as zf:
+                if zf.comment.decode('utf-8') == str(manifest["export_id"]) and "members" in manifest:
+                    return manifest
+        except (KeyError, OSError, zipfile.BadZipFile):
+            pass
+        return {
+            "export_id": manifest["export_id"],
+            "base_export_id": manifest["export_id"] + 1,
+            "members": {},
+            "removed": {},
+            "dead_bytes": 0,
+            "size": 0
+        }
+
+    def _save_manifest(self, pid, manifest):
+        path = self._get_manifest_path(pid)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + ".tmp", path)
+
+    def _get_manifest_path(self, pid):
+        return os.path.join(self.root_dir, str(pid), "manifest.json")
+
+    def _lock(self, pid):
+        return _LockFile(os.path.join(self.root_dir, str(pid), "update.lock"), self.LOCK_TIMEOUT, self.LOCK_POLL_INTERVAL)
+
+
+class _FilePrefix(io.RawIOBase):
+    """
+    A read only file object holding the first size bytes of a file, which stay the same while later
+    bytes are written.
+    """
+
+    def __init__(self, path, size):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._size = size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END:
+            offset, whence = self._size + offset, io.SEEK_SET
+        return self._file.seek(offset, whence)
+
+    def readinto(self, b):
+        data = self._file.read(max(0, min(len(b), self._size - self._file.tell())))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class _LockFile:
+    """
+    An exclusive lock held by creating a file. Locks older than timeout seconds are assumed to have
+    been left by a process which died, and are broken.
+    """
+
+    def __init__(self, path, timeout, poll_interval):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > self.timeout:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(self.poll_interval)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        os.remove(self.path)
+
+
+class ExportCacheInstance:
+    __instance = None
+
+    def __new__(cls):
+        if ExportCacheInstance.__instance is None:
+            ExportCacheInstance.__instance = ExportCache(
+                os.path.join(ServerConfig.DATA_ROOT_DIR, ServerConfig.EXPORT_CACHE_DIR))
+        return ExportCacheInstance.__instance
@@ -0,0 +1,88 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+
+import cv2
+
+from server.server_config import ServerConfig
+
+
+class DecodedImageCache:
+    """
+    An in-memory LRU cache of decoded images, bounded by the total size in bytes of the cached mats.
+
+    Mats returned by this cache are shared between requests and must not be modified.
+    """
+
+    # JPEGs can be decoded directly at a reduced resolution, which is far cheaper than a full decode
+    REDUCED_FLAGS = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8
+    }
+    REDUCIBLE_EXTS = (".jpg", ".jpeg")
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict()  # (image_id, revision, reduction) -> mat
+        self._size = 0
+
+    @classmethod
+    def get_reduction(cls, length, max_length):
+        """
+        Gets the largest supported reduction which keeps length at or above max_length.
+        """
+        for reduction in sorted(cls.REDUCED_FLAGS.keys(), reverse=True):
+            if length / reduction >= max_length:
+                return reduction
+        return 1
+
+    def get(self, image_id, revision, image_path, reduction=1, is_swapped=False):
+        """
+        Gets an image decoded at 1/reduction of its resolution. A cached decode at a finer resolution
+        is reused when available, and formats other than JPEG are always decoded at full resolution.
+        :return: A tuple of (mat, reduction), where reduction is the factor the returned mat is reduced by
+        """
+        _, ext = os.path.splitext(image_path)
+        if ext.lower() not in self.REDUCIBLE_EXTS:
+            reduction = 1
+
+        with self._lock:
+            for r in sorted(self.REDUCED_FLAGS.keys(), reverse=True):
+                key = (image_id, revision, r)
+                if r <= reduction and key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key], r
+
+        mat = cv2.imread(image_path, self.REDUCED_FLAGS[reduction])
+        if mat is None:
+            raise IOError("Failed to read image with id %d." % image_id)
+        if is_swapped:
+            mat = cv2.cvtColor(mat, cv2.COLOR_RGB2BGR)
+
+        if mat.nbytes <= self.max_bytes:
+            with self._lock:
+                key = (image_id, revision, reduction)
+                if key not in self._entries:
+                    self._entries[key] = mat
+                    self._size += mat.nbytes
+                while self._size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= evicted.nbytes
+        return mat, reduction
+
+    def invalidate(self, image_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == image_id]:
+                self._size -= self._entries.pop(key).nbytes
+
+
+class DecodedImageCacheInstance:
+    __instance = None
+
+    def __new__(cls):
+        if DecodedImageCacheInstance.__instance is None:
+            DecodedImageCacheInstance.__instance = DecodedImageCache(ServerConfig.DECODED_IMAGE_CACHE_MAX_BYTES)
+        return DecodedImageCacheInstance.__instance
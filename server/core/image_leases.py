@@ -0,0 +1,84 @@
+import uuid
+
+from server.server_config import DatabaseInstance
+from server.server_config import ServerConfig
+
+db = DatabaseInstance()
+
+
+class LeaseConflict(Exception):
+    pass
+
+
+def _grant(t, iid, token):
+    """
+    Locks an image under a lease held by token, expiring IMAGE_LEASE_SECONDS from now.
+    :param t: The Transaction holding a lock on the image row
+    :return: The lease
+    """
+    query = "UPDATE image SET is_locked = 1, lease_token = %s, "
+    query += "lease_expires = NOW() + INTERVAL %s SECOND WHERE image_id = %s"
+    t.query(query, (token, ServerConfig.IMAGE_LEASE_SECONDS, iid))
+    query = "SELECT image_id, image_name, lease_token, lease_expires FROM image WHERE image_id = %s"
+    rows, _ = t.query(query, (iid,))
+    lease = rows[0]
+    lease["lease_seconds"] = ServerConfig.IMAGE_LEASE_SECONDS
+    return lease
+
+
+def claim_next(pid):
+    """
+    Claims the unlabeled image of a project with the lowest id which isn't locked, or whose lease has
+    expired. Rows being claimed by other requests are skipped rather than waited on, so concurrent claims
+    never return the same image and never block each other.
+    :return: The lease on the claimed image, or None if every unlabeled image is locked
+    """
+    q_claim = "SELECT image_id FROM image WHERE project_fid = %s AND is_labeled = 0 AND {0} "
+    q_claim += "ORDER BY image_id LIMIT 1 FOR UPDATE SKIP LOCKED"
+    conditions = ("is_locked = 0", "is_locked = 1 AND (lease_expires IS NULL OR lease_expires < NOW())")
+    with db.transaction() as t:
+        # Unlocked images are preferred, expired leases are only reclaimed once there are none left
+        for condition in conditions:
+            rows, _ = t.query(q_claim.format(condition), (pid,))
+            if rows:
+                return _grant(t, rows[0]["image_id"], uuid.uuid4().hex)
+    return None
+
+
+def acquire(iid, token=None):
+    """
+    Locks an image under a new lease, or renews the lease held by token. A lease which has expired can
+    still be renewed by its holder until another client takes the image.
+    :return: The lease, or None if the image does not exist
+    :raises LeaseConflict: If another unexpired lease holds the image, or token no longer holds it
+    """
+    query = "SELECT is_locked, lease_token, lease_expires IS NULL OR lease_expires < NOW() AS expired "
+    query += "FROM image WHERE image_id = %s FOR UPDATE"
+    with db.transaction() as t:
+        rows, _ = t.query(query, (iid,))
+        if not rows:
+            return None
+        row = rows[0]
+        if token is not None and (not row["is_locked"] or row["lease_token"] != token):
+            raise LeaseConflict("The lease on the image with id %s has been lost." % iid)
+        if token is None and row["is_locked"] and not row["expired"]:
+            raise LeaseConflict("Image with id %s is leased by another client." % iid)
+        return _grant(t, iid, token or uuid.uuid4().hex)
+
+
+def release(iid, token):
+    """
+    Unlocks an image, if its lease is held by token.
+    :return: True if the image exists
+    :raises LeaseConflict: If the lease is held by another client
+    """
+    query = "SELECT is_locked, lease_token FROM image WHERE image_id = %s FOR UPDATE"
+    with db.transaction() as t:
+        rows, _ = t.query(query, (iid,))
+        if not rows:
+            return False
+        if rows[0]["is_locked"] and rows[0]["lease_token"] != token:
+            raise LeaseConflict("Image with id %s is leased by another client." % iid)
+        query = "UPDATE image SET is_locked = 0, lease_token = NULL, lease_expires = NULL WHERE image_id = %s"
+        t.query(query, (iid,))
+    return True
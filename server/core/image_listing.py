@@ -0,0 +1,161 @@
+import base64
+import json
+from collections import OrderedDict
+
+from server.server_config import DatabaseInstance
+from server.server_config import ServerConfig
+
+db = DatabaseInstance()
+
+# The image fields which may be selected by listings, mapped to their columns
+IMAGE_FIELDS = OrderedDict([
+    ("id", "image_id"),
+    ("name", "image_name"),
+    ("ext", "image_ext"),
+    ("is_locked", "is_locked"),
+    ("is_labeled", "is_labeled")
+])
+
+# Images only count as locked while their lease is unexpired, see image_leases
+LOCKED = "is_locked = 1 AND lease_expires IS NOT NULL AND lease_expires >= NOW()"
+UNLOCKED_STATES = ("is_locked = 0", "is_locked = 1 AND (lease_expires IS NULL OR lease_expires < NOW())")
+
+# Fields selected as an expression rather than their column
+FIELD_EXPRESSIONS = {
+    "is_locked": "(%s) AS is_locked" % LOCKED
+}
+
+# The keys images may be ordered by, mapped to their columns. Ties are broken by image_id.
+ORDER_KEYS = {
+    "id": "image_id",
+    "name": "image_name"
+}
+
+
+def parse_fields(value):
+    """
+    Parses a comma separated fields selector, such as "id,name,is_locked".
+    :return: A list of field names, or None if no fields were selected
+    :raises ValueError: If an unknown field is selected
+    """
+    if not value:
+        return None
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in IMAGE_FIELDS]
+    if unknown:
+        raise ValueError("Unknown image fields %s, expected any of %s." % (unknown, list(IMAGE_FIELDS)))
+    return fields
+
+
+def select_fields(row, fields):
+    """
+    Gets the selected fields of an image row, keyed by their columns so the row can be marshalled.
+    """
+    return {IMAGE_FIELDS[f]: row[IMAGE_FIELDS[f]] for f in fields}
+
+
+def encode_cursor(row, order_key):
+    """
+    Encodes the position of a row in a listing, which the next page starts after.
+    """
+    position = [row[ORDER_KEYS[order_key]], row["image_id"]]
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    :return: The (order value, image_id) encoded by encode_cursor
+    :raises ValueError: If the cursor is malformed
+    """
+    try:
+        value, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        return value, int(image_id)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("Invalid cursor '%s'." % cursor) from e
+
+
+def get_page_size(limit):
+    """
+    Clamps a requested page size to IMAGE_PAGE_MAX_SIZE, which is also used when none is given.
+    """
+    if limit is None:
+        return ServerConfig.IMAGE_PAGE_MAX_SIZE
+    return max(1, min(int(limit), ServerConfig.IMAGE_PAGE_MAX_SIZE))
+
+
+def build_project_images_query(pid, content, fields=None, limit=None, after=None):
+    """
+    Builds the query listing the images of a project, see list_project_images. Every value is bound as
+    a parameter, so the statement text only varies with the filters used and MySQL can reuse its plan.
+    Listings filtered by both flags or by neither are read in order from an index ending in the order
+    column, see migration 007, so pages are found without sorting the project. Unlocked images are those
+    with is_locked = 0 or an expired lease, which are read as two ordered pages and merged, so only the
+    rows of those pages are sorted.
+    :return: A tuple of (query, params, order_key)
+    """
+    order_by = content.get("order_by") or {}
+    order_key = order_by.get("key", "id")
+    if order_key not in ORDER_KEYS:
+        order_key = "id"
+    order_column = ORDER_KEYS[order_key]
+    ascending = order_by.get("ascending", True)
+
+    columns = ["image_id", order_column] + [IMAGE_FIELDS[f] for f in fields or ()]
+    columns = [FIELD_EXPRESSIONS.get(c, c) for c in OrderedDict.fromkeys(columns)]
+    query = "SELECT %s FROM image " % ", ".join(columns)
+    query += "WHERE project_fid = %s"
+    params = [pid]
+
+    if content.get("labeled") is not None:
+        query += " and is_labeled = %s"
+        params.append(bool(content["labeled"]))
+
+    if after is not None:
+        value, image_id = decode_cursor(after)
+        op = ">" if ascending else "<"
+        if order_column == "image_id":
+            query += " and image_id %s %%s" % op
+            params.append(image_id)
+        else:
+            query += " and (%s, image_id) %s (%%s, %%s)" % (order_column, op)
+            params.extend([value, image_id])
+
+    direction = " asc" if ascending else " desc"
+    order = " ORDER BY " + order_column + direction
+    if order_column != "image_id":
+        order += ", image_id" + direction
+    if limit is not None:
+        order += " LIMIT %s"
+        # One extra row is read to tell whether there is another page
+        params.append(limit + 1)
+
+    if content.get("locked") is None:
+        return query + order, tuple(params), order_key
+
+    if content["locked"]:
+        return query + " and " + LOCKED + order, tuple(params), order_key
+
+    branches = ["(%s and %s%s)" % (query, state, order) for state in UNLOCKED_STATES]
+    union_params = params * len(branches)
+    if limit is not None:
+        union_params.append(limit + 1)
+    return " UNION ALL ".join(branches) + order, tuple(union_params), order_key
+
+
+def list_project_images(pid, content, fields=None, limit=None, after=None):
+    """
+    Lists the images of a project a page at a time, ordered by (order key, image_id). Each page starts
+    after the position of the last row of the previous one, so no page requires an offset to be scanned.
+    :param content: The filter, holding optional locked and labeled flags and an order_by
+    :param fields: The fields to select, besides those needed for ordering
+    :param limit: The most images returned, or None to return them all
+    :param after: A cursor returned with a previous page
+    :return: A tuple of (rows, cursor), where cursor is None on the last page
+    """
+    query, params, order_key = build_project_images_query(pid, content, fields, limit, after)
+    rows, _ = db.query(query, params)
+    cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor(rows[-1], order_key)
+    return rows, cursor
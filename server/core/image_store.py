@@ -0,0 +1,121 @@
+import cv2
+
+import server.utils as utils
+from server.core.blob_store import BlobStoreInstance
+from server.core.image_cache import DecodedImageCache, DecodedImageCacheInstance
+from server.core.rendition_cache import RenditionCacheInstance
+from server.core.tile_pyramid import TilePyramidStoreInstance
+from server.core.jobs import JobQueueInstance
+from server.server_config import ServerConfig
+
+# The number of bytes read when probing the header of an uploaded file
+PROBE_SIZE = 256 * 1024
+
+
+def prepare_image(data, ext):
+    """
+    Prepares uploaded image bytes for storage according to IMAGE_INGEST_MODE. In verbatim mode the
+    bytes are kept as is and only their header is read, unless the format is not recognised.
+    :param data: The encoded image bytes
+    :param ext: The file extension supplied by the uploader
+    :return: A tuple of (data, ext, shape, mat), where shape is (width, height, depth) and mat is the
+    decoded BGR image or None if the image was not decoded
+    """
+    if ServerConfig.IMAGE_INGEST_MODE != "transcode":
+        probe = utils.probe_image(data)
+        if probe is not None:
+            ext, width, height, depth = probe
+            return data, ext, (width, height, depth), None
+
+    mat = utils.bytes2mat(data)
+    if mat is None:
+        raise ValueError("Unsupported image format '%s'." % ext)
+
+    if ServerConfig.IMAGE_INGEST_MODE == "transcode":
+        ext = ServerConfig.DEFAULT_IMAGE_EXT
+        data = utils.mat2bytes(mat, ext)
+    return data, ext.lower(), (mat.shape[1], mat.shape[0], mat.shape[2]), mat
+
+
+def prepare_image_file(path, ext):
+    """
+    Prepares an uploaded image file for storage in place, as prepare_image does for image bytes.
+    :return: A tuple of (ext, shape, mat)
+    """
+    if ServerConfig.IMAGE_INGEST_MODE != "transcode":
+        with open(path, 'rb') as f:
+            probe = utils.probe_image(f.read(PROBE_SIZE))
+        if probe is not None:
+            return probe[0], probe[1:], None
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    new_data, ext, shape, mat = prepare_image(data, ext)
+    if new_data is not data:
+        with open(path, 'wb') as f:
+            f.write(new_data)
+    return ext, shape, mat
+
+
+def get_upload_dir():
+    return BlobStoreInstance().upload_dir
+
+
+def store_image(data, ext):
+    """
+    Stores image bytes in the blob store, adding a reference to an existing copy if there is one.
+    :return: A tuple of (blob_hash, image_path)
+    """
+    return BlobStoreInstance().put_bytes(data, ext)
+
+
+def store_image_file(path, ext):
+    """
+    Moves an image file into the blob store, deleting it instead if an identical copy is already stored.
+    :return: A tuple of (blob_hash, image_path)
+    """
+    return BlobStoreInstance().put_file(path, ext)
+
+
+def release_blob(blob_hash):
+    """
+    Releases a blob which was stored for an image that was never inserted.
+    """
+    BlobStoreInstance().release(blob_hash)
+
+
+def release_images(rows):
+    """
+    Removes everything derived from deleted images and releases their blobs.
+    :param rows: The deleted image rows, each containing an image_id and blob_hash
+    """
+    for row in rows:
+        RenditionCacheInstance().invalidate(row["image_id"])
+        TilePyramidStoreInstance().invalidate(row["image_id"])
+        DecodedImageCacheInstance().invalidate(row["image_id"])
+    BlobStoreInstance().release_all([row["blob_hash"] for row in rows if row["blob_hash"] is not None])
+
+
+def process_stored_image(image_id, path, ext, shape, mat=None):
+    """
+    Runs the follow up work for a newly stored image. Renditions listed in RENDITION_EAGER_DIMS are
+    generated, decoding JPEGs at a reduced resolution where possible, and formats which can't be
+    served directly are queued for background transcoding.
+    """
+    if not utils.is_native_ext(ext):
+        if ServerConfig.IMAGE_BACKGROUND_TRANSCODE:
+            JobQueueInstance().submit("transcode_images", params={"image_ids": [image_id]})
+        return
+
+    rendition_cache = RenditionCacheInstance()
+    dims = rendition_cache.get_eager_dims()
+    if not dims:
+        return
+
+    if mat is None:
+        reduction = 1
+        if ext in DecodedImageCache.REDUCIBLE_EXTS:
+            reduction = DecodedImageCache.get_reduction(max(shape[:2]), max(dims))
+        mat = cv2.imread(path, DecodedImageCache.REDUCED_FLAGS[reduction])
+    if mat is not None:
+        rendition_cache.pregenerate(image_id, mat, ext)
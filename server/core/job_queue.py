@@ -0,0 +1,207 @@
+import json
+import os
+import socket
+import time
+import uuid
+from pathlib import Path
+from shutil import rmtree
+from threading import Event, Thread
+
+from server.server_config import DatabaseInstance
+
+db = DatabaseInstance()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    A claimed job, as seen by its handler.
+
+    Handlers report their progress through set_progress, which also raises JobCancelled once the job
+    has been cancelled, and write any result files into result_dir.
+    """
+
+    # The minimum number of seconds between progress updates written to the database
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, row, worker_id, result_dir):
+        self.job_id = row["job_id"]
+        self.job_type = row["job_type"]
+        self.project_id = row["project_fid"]
+        self.params = json.loads(row["job_params"]) if row["job_params"] else {}
+        self.worker_id = worker_id
+        self.result_dir = result_dir
+        self._last_update = 0
+
+    def set_progress(self, progress, force=False):
+        """
+        Records the fraction of the job which is complete, which also keeps the job from being
+        considered lost by other workers.
+        :raises JobCancelled: If the job was cancelled, or was claimed by another worker
+        """
+        now = time.time()
+        if not force and now - self._last_update < self.PROGRESS_INTERVAL:
+            return
+        self._last_update = now
+
+        q_update = "UPDATE job SET progress = %s, heartbeat = NOW() WHERE job_id = %s AND worker_id = %s"
+        q_check = "SELECT is_cancel_requested, worker_id FROM job WHERE job_id = %s"
+        db.query(q_update, (progress, self.job_id, self.worker_id))
+        result, _ = db.query(q_check, (self.job_id,))
+        if not result or result[0]["is_cancel_requested"] or result[0]["worker_id"] != self.worker_id:
+            raise JobCancelled()
+
+
+class JobQueue:
+    """
+    A persistent queue of background jobs, backed by the job table.
+
+    Any number of workers, in this process or others, may serve the same queue. A worker claims the
+    oldest queued job it has a handler for by marking it as running under a token unique to that
+    claim, so each job is only run once. Jobs whose worker stops reporting progress for stale_seconds
+    are queued again.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+
+    FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED, STATUS_CANCELLED)
+
+    def __init__(self, result_root, handlers, poll_interval, stale_seconds):
+        """
+        :param result_root: The directory under which each job is given a result directory
+        :param handlers: A dict mapping job types to callables taking a Job and returning a result path or None
+        """
+        self.result_root = result_root
+        self.handlers = handlers
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self._wake = Event()
+        self._stop = Event()
+        self._threads = []
+
+    def submit(self, job_type, project_id=None, params=None):
+        """
+        Adds a job to the end of the queue.
+        :return: The id of the new job
+        """
+        if job_type not in self.handlers:
+            raise ValueError("Unknown job type '%s'." % job_type)
+        query = "INSERT INTO job (job_type, project_fid, job_params) VALUES (%s, %s, %s)"
+        _, job_id = db.query(query, (job_type, project_id, json.dumps(params or {})))
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id):
+        query = "SELECT job_id, job_type, project_fid, job_status, progress, result_path, error_message, "
+        query += "created, started, finished FROM job WHERE job_id = %s"
+        result, _ = db.query(query, (job_id,))
+        return result[0] if result else None
+
+    def cancel(self, job_id):
+        """
+        Cancels a job. Queued jobs are cancelled immediately, while running jobs stop at their next
+        progress update.
+        :return: The job after cancellation was requested, or None if it doesn't exist
+        """
+        q_queued = "UPDATE job SET job_status = %s, finished = NOW() WHERE job_id = %s AND job_status = %s"
+        q_running = "UPDATE job SET is_cancel_requested = 1 WHERE job_id = %s AND job_status = %s"
+        db.query(q_queued, (self.STATUS_CANCELLED, job_id, self.STATUS_QUEUED))
+        db.query(q_running, (job_id, self.STATUS_RUNNING))
+        return self.get(job_id)
+
+    def delete(self, job_id):
+        """
+        Removes a finished job along with its results.
+        """
+        query = "DELETE FROM job WHERE job_id = %s AND job_status IN (%s, %s, %s)"
+        db.query(query, (job_id,) + self.FINISHED_STATUSES)
+        rmtree(os.path.join(self.result_root, str(job_id)), ignore_errors=True)
+
+    def get_result_dir(self, job_id, worker_id=None):
+        """
+        Gets the result directory of a claim of a job. Each claim writes into its own directory, so a
+        worker which lost its claim can't disturb the results of the worker which took it over.
+        :param worker_id: The claim token, which defaults to that of the job's latest claim
+        :return: The directory, or None if the job has never been claimed
+        """
+        if worker_id is None:
+            result, _ = db.query("SELECT worker_id FROM job WHERE job_id = %s", (job_id,))
+            if not result or result[0]["worker_id"] is None:
+                return None
+            worker_id = result[0]["worker_id"]
+        # Worker ids are host:pid:token, where the token alone is unique and safe to use as a file name
+        return os.path.join(self.result_root, str(job_id), worker_id.rsplit(":", 1)[-1])
+
+    def start(self, worker_count):
+        """
+        Starts worker_count worker threads in this process.
+        """
+        for _ in range(worker_count):
+            thread = Thread(target=self.run_worker, daemon=True, name="job-worker")
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run_worker(self):
+        """
+        Runs jobs until the queue is stopped, waiting up to poll_interval for new jobs whenever it is empty.
+        """
+        while not self._stop.is_set():
+            try:
+                ran = self.run_next()
+            except BaseException as e:
+                print("Job worker failed to claim a job: %s" % str(e))
+                ran = False
+            if not ran:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def run_next(self):
+        """
+        Claims and runs the oldest queued job.
+        :return: True if a job was run, False if there were none to run
+        """
+        if not self.handlers:
+            return False
+        worker_id = "%s:%d:%s" % (socket.gethostname()[:32], os.getpid(), uuid.uuid4().hex)
+        types = tuple(self.handlers.keys())
+
+        q_requeue = "UPDATE job SET job_status = %s, worker_id = NULL "
+        q_requeue += "WHERE job_status = %s AND heartbeat < NOW() - INTERVAL %s SECOND"
+        q_claim = "UPDATE job SET job_status = %s, worker_id = %s, started = NOW(), heartbeat = NOW() "
+        q_claim += "WHERE job_status = %s AND job_type IN (" + ",".join(["%s"] * len(types)) + ") "
+        q_claim += "ORDER BY job_id LIMIT 1"
+        q_get = "SELECT job_id, job_type, project_fid, job_params FROM job WHERE worker_id = %s"
+
+        db.query(q_requeue, (self.STATUS_QUEUED, self.STATUS_RUNNING, self.stale_seconds))
+        db.query(q_claim, (self.STATUS_RUNNING, worker_id, self.STATUS_QUEUED) + types)
+        result, _ = db.query(q_get, (worker_id,))
+        if not result:
+            return False
+
+        job = Job(result[0], worker_id, self.get_result_dir(result[0]["job_id"], worker_id))
+        Path(job.result_dir).mkdir(parents=True, exist_ok=True)
+
+        q_finish = "UPDATE job SET job_status = %s, progress = %s, result_path = %s, error_message = %s, "
+        q_finish += "finished = NOW() WHERE job_id = %s AND worker_id = %s"
+        try:
+            result_path = self.handlers[job.job_type](job)
+        except JobCancelled:
+            rmtree(job.result_dir, ignore_errors=True)
+            db.query(q_finish, (self.STATUS_CANCELLED, 0, None, None, job.job_id, worker_id))
+        except BaseException as e:
+            rmtree(job.result_dir, ignore_errors=True)
+            db.query(q_finish, (self.STATUS_FAILED, 0, None, str(e), job.job_id, worker_id))
+        else:
+            db.query(q_finish, (self.STATUS_SUCCEEDED, 1, result_path, None, job.job_id, worker_id))
+        return True
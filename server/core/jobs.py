@@ -0,0 +1,132 @@
+import os
+
+import server.core.annotation_store as annotation_store
+import server.core.coco_export as coco_export
+import server.core.dataset_export as dataset_export
+import server.core.shard_export as shard_export
+import server.utils as utils
+from server.core.export_cache import ExportCacheInstance
+from server.core.job_queue import JobQueue
+from server.core.rendition_cache import RenditionCacheInstance
+from server.core.transcoder import transcode_image
+from server.core.worker_pool import WorkerPoolInstance
+from server.server_config import DatabaseInstance
+from server.server_config import ServerConfig
+
+db = DatabaseInstance()
+
+
+def run_export_dataset(job):
+    """
+    Exports the labelled images of a project.
+    Params: format, either zip or coco for a COCO json document, incremental, whether to update and
+    return the cached export of the project rather than export from scratch, and since, an export id
+    which limits the zip to the changes made after it
+    """
+    if job.params.get("format", "zip") == "coco":
+        json_path = os.path.join(job.result_dir, "%d.json" % job.project_id)
+        return coco_export.export_coco(job.project_id, json_path, job.set_progress)
+
+    if "since" in job.params:
+        since = int(job.params["since"])
+        export_id, data = ExportCacheInstance().stream_delta(job.project_id, since, job.set_progress)
+        zip_path = os.path.join(job.result_dir, "%d_%d-%d.zip" % (job.project_id, since, export_id))
+        with open(zip_path, 'wb') as f:
+            for chunk in data:
+                f.write(chunk)
+        return zip_path
+
+    if job.params.get("incremental", False):
+        # The result is a snapshot of the cached export, which later updates copy rather than change
+        zip_path = os.path.join(job.result_dir, "%d.zip" % job.project_id)
+        ExportCacheInstance().snapshot(job.project_id, zip_path, job.set_progress)
+        return zip_path
+
+    zip_path = os.path.join(job.result_dir, "%d.zip" % job.project_id)
+    return dataset_export.export_dataset(job.project_id, zip_path, job.set_progress)
+
+
+def run_export_shards(job):
+    """
+    Exports the labelled images of a project as WebDataset style tar shards, which may be downloaded
+    as they are completed.
+    Params: max_bytes, the most member data in a shard which defaults to EXPORT_SHARD_MAX_BYTES
+    """
+    max_bytes = int(job.params.get("max_bytes") or ServerConfig.EXPORT_SHARD_MAX_BYTES)
+    return shard_export.export_shards(job.project_id, job.result_dir, max_bytes, job.set_progress)
+
+
+def run_render_thumbnails(job):
+    """
+    Renders the renditions of every image in a project.
+    Params: max_dims, a list of renditions to render which defaults to RENDITION_EAGER_DIMS
+    """
+    rendition_cache = RenditionCacheInstance()
+    max_dims = job.params.get("max_dims") or rendition_cache.get_eager_dims()
+
+    query = "SELECT image_id, image_path, image_ext, is_swapped FROM image WHERE project_fid = %s"
+    results, _ = db.query(query, (job.project_id,))
+    items = [(row, int(d)) for row in results if utils.is_native_ext(row["image_ext"]) for d in max_dims]
+
+    def render(item):
+        row, max_dim = item
+        rendition_cache.get_or_render(
+            row["image_id"], row["image_path"], max_dim, row["image_ext"], bool(row["is_swapped"]))
+
+    for i, _ in enumerate(WorkerPoolInstance().imap(render, items)):
+        job.set_progress((i + 1) / len(items))
+    return None
+
+
+def run_transcode_images(job):
+    """
+    Re-encodes stored images.
+    Params: image_ids, the images to re-encode which defaults to every image in the project which isn't
+    stored as ext, and ext, the format to re-encode to which defaults to DEFAULT_IMAGE_EXT
+    """
+    ext = job.params.get("ext") or ServerConfig.DEFAULT_IMAGE_EXT
+    image_ids = job.params.get("image_ids")
+    if image_ids is None:
+        query = "SELECT image_id FROM image WHERE project_fid = %s AND (image_ext != %s OR is_swapped = 1)"
+        results, _ = db.query(query, (job.project_id, ext))
+        image_ids = [row["image_id"] for row in results]
+
+    for i, image_id in enumerate(image_ids):
+        transcode_image(image_id, ext)
+        job.set_progress((i + 1) / len(image_ids))
+    return None
+
+
+def run_compact_masks(job):
+    """
+    Converts the masks of images annotated by older servers to the compact mask format.
+    Params: image_ids, the images to convert which defaults to every image in the project
+    """
+    image_ids = job.params.get("image_ids")
+    if image_ids is None:
+        results, _ = db.query("SELECT image_id FROM image WHERE project_fid = %s", (job.project_id,))
+        image_ids = [row["image_id"] for row in results]
+    annotation_store.compact_masks(image_ids, job.set_progress)
+    return None
+
+
+JOB_HANDLERS = {
+    "compact_masks": run_compact_masks,
+    "export_dataset": run_export_dataset,
+    "export_shards": run_export_shards,
+    "render_thumbnails": run_render_thumbnails,
+    "transcode_images": run_transcode_images
+}
+
+
+class JobQueueInstance:
+    __instance = None
+
+    def __new__(cls):
+        if JobQueueInstance.__instance is None:
+            JobQueueInstance.__instance = JobQueue(
+                os.path.join(ServerConfig.DATA_ROOT_DIR, ServerConfig.JOB_DIR),
+                JOB_HANDLERS,
+                ServerConfig.JOB_POLL_INTERVAL,
+                ServerConfig.JOB_STALE_SECONDS)
+        return JobQueueInstance.__instance
@@ -0,0 +1,83 @@
+from collections import Counter
+
+from server.server_config import DatabaseInstance
+
+db = DatabaseInstance()
+
+
+def add_images(t, pid, count):
+    """
+    Counts newly inserted images, which are always unlabeled, against their project.
+    :param t: The Transaction which inserted the images
+    """
+    if count > 0:
+        query = "UPDATE project SET unlabeled_count = unlabeled_count + %s WHERE project_id = %s"
+        t.query(query, (count, pid))
+
+
+def remove_images(t, rows):
+    """
+    Removes deleted images from the counts of their projects.
+    :param t: The Transaction which deleted the images
+    :param rows: The deleted image rows, each containing a project_fid and is_labeled
+    """
+    labeled = Counter()
+    unlabeled = Counter()
+    for row in rows:
+        if row["is_labeled"]:
+            labeled[row["project_fid"]] += 1
+        else:
+            unlabeled[row["project_fid"]] += 1
+
+    query = "UPDATE project SET labeled_count = labeled_count - %s, unlabeled_count = unlabeled_count - %s "
+    query += "WHERE project_id = %s"
+    for pid in set(labeled) | set(unlabeled):
+        t.query(query, (labeled[pid], unlabeled[pid], pid))
+
+
+def set_labeled(t, pid, was_labeled, is_labeled):
+    """
+    Moves an image between the labeled and unlabeled counts of its project when its state flips.
+    :param t: The Transaction which updated the image, holding a lock on its row
+    """
+    if bool(was_labeled) == bool(is_labeled):
+        return
+    step = 1 if is_labeled else -1
+    query = "UPDATE project SET labeled_count = labeled_count + %s, unlabeled_count = unlabeled_count - %s "
+    query += "WHERE project_id = %s"
+    t.query(query, (step, step, pid))
+
+
+def get_stats(pid):
+    """
+    Counts the images and annotations of a project with a single grouped query. The rollup row holds the
+    totals of the project, while each other row holds the images containing a class and its instances.
+    :return: A dict of the image counts, instance count and per class totals of the project
+    """
+    query = "SELECT m.class_name, GROUPING(m.class_name) AS is_total, "
+    query += "COUNT(DISTINCT i.image_id) AS images, "
+    query += "COUNT(DISTINCT CASE WHEN i.is_labeled = 1 THEN i.image_id END) AS labeled, "
+    # Images whose lease has expired are no longer locked, see image_leases
+    query += "COUNT(DISTINCT CASE WHEN i.is_locked = 1 AND i.lease_expires >= NOW() THEN i.image_id END) AS locked, "
+    query += "COUNT(m.annotation_id) AS instances "
+    query += "FROM image i LEFT JOIN instance_seg_meta m ON m.image_id = i.image_id "
+    query += "WHERE i.project_fid = %s "
+    query += "GROUP BY m.class_name WITH ROLLUP"
+    results, _ = db.query(query, (pid,))
+
+    stats = {"images": 0, "labeled": 0, "unlabeled": 0, "locked": 0, "instances": 0, "classes": []}
+    for row in results:
+        if row["is_total"]:
+            stats.update(
+                images=row["images"],
+                labeled=row["labeled"],
+                unlabeled=row["images"] - row["labeled"],
+                locked=row["locked"],
+                instances=row["instances"])
+        elif row["class_name"] is not None:
+            stats["classes"].append({
+                "name": row["class_name"],
+                "images": row["images"],
+                "instances": row["instances"]
+            })
+    return stats
@@ -0,0 +1,84 @@
+import time
+from threading import Lock
+
+from server.server_config import ServerConfig
+
+
+class QueryCache:
+    """
+    An in-memory cache of small, frequently read query results, such as the project list and the labels
+    of a project. Entries expire after ttl seconds, and are dropped sooner by the endpoints which change
+    them. The cache is per process, so the ttl bounds how stale another process's writes may appear.
+
+    Results returned by this cache are shared between requests and must not be modified.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries = {}  # key -> (expiry, value)
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def get(self, key, load):
+        """
+        Gets a cached result, calling load to fetch it when it is missing or expired.
+        :param key: A tuple whose first item names the kind of result, e.g. ("labels", pid)
+        :param load: A function taking no arguments which fetches the result
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._hits += 1
+                return entry[1]
+            self._misses += 1
+            generation = self._generation
+
+        value = load()
+        with self._lock:
+            # A write which happened while loading may not be reflected in value
+            if generation == self._generation:
+                self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, *keys):
+        """
+        Drops cached results. A key of a single name, e.g. ("labels",), drops every result of that kind.
+        """
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            for key in keys:
+                if len(key) == 1:
+                    for k in [k for k in self._entries if k[0] == key[0]]:
+                        del self._entries[k]
+                else:
+                    self._entries.pop(key, None)
+
+    def invalidate_project(self, pid):
+        """
+        Drops the results which show the details or image counts of a project.
+        """
+        self.invalidate(("projects",), ("project", pid))
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "ttl": self.ttl
+            }
+
+
+class QueryCacheInstance:
+    __instance = None
+
+    def __new__(cls):
+        if QueryCacheInstance.__instance is None:
+            QueryCacheInstance.__instance = QueryCache(ServerConfig.QUERY_CACHE_TTL)
+        return QueryCacheInstance.__instance
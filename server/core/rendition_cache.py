@@ -0,0 +1,156 @@
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock, get_ident
+
+import server.utils as utils
+from server.server_config import ServerConfig
+
+
+class RenditionCache:
+    """
+    A disk backed LRU cache of downscaled image renditions keyed by (image_id, max_dim, ext).
+
+    Renditions are stored as <root_dir>/<image_id>/<max_dim><ext>. The total size of all renditions is
+    kept below max_bytes by evicting the least recently used files.
+    """
+
+    def __init__(self, root_dir, max_bytes):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._entries = OrderedDict()  # path -> size in bytes
+        self._size = 0
+        self._loaded = False
+
+    def get(self, image_id, max_dim, ext):
+        """
+        Gets the bytes of a cached rendition.
+        :return: The rendition bytes, or None if the rendition is not cached
+        """
+        path = self._get_path(image_id, max_dim, ext)
+        with self._lock:
+            self._load()
+            if path not in self._entries:
+                return None
+            self._entries.move_to_end(path)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Keep the mtime current so eviction order survives a restart
+            os.utime(path)
+        except OSError:
+            self._forget(path)
+            return None
+        return data
+
+    def put(self, image_id, max_dim, ext, data):
+        path = self._get_path(image_id, max_dim, ext)
+        if len(data) > self.max_bytes:
+            return
+
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (path, get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._load()
+            self._size -= self._entries.pop(path, 0)
+            self._entries[path] = len(data)
+            self._size += len(data)
+            self._evict()
+
+    def get_or_render(self, image_id, image_path, max_dim, ext, is_swapped=False):
+        """
+        Gets a rendition from the cache, rendering it from the original image on a miss.
+        """
+        data = self.get(image_id, max_dim, ext)
+        if data is None:
+            data = utils.render_image(image_path, ext, max_dim, is_swapped)
+            self.put(image_id, max_dim, ext, data)
+        return data
+
+    def pregenerate(self, image_id, mat, ext):
+        """
+        Renders the renditions listed in RENDITION_EAGER_DIMS from an already decoded BGR image.
+        """
+        for max_dim in self.get_eager_dims():
+            try:
+                self.put(image_id, max_dim, ext, utils.render_mat(mat, ext, max_dim))
+            except BaseException as e:
+                print("Failed to generate rendition %d for image %d: %s" % (max_dim, image_id, str(e)))
+
+    def invalidate(self, image_id):
+        """
+        Removes all renditions of an image.
+        """
+        folder = os.path.join(self.root_dir, str(image_id))
+        with self._lock:
+            self._load()
+            for path in [p for p in self._entries if os.path.dirname(p) == folder]:
+                self._size -= self._entries.pop(path)
+        shutil.rmtree(folder, ignore_errors=True)
+
+    @staticmethod
+    def get_eager_dims():
+        dims = []
+        for dim in str(ServerConfig.RENDITION_EAGER_DIMS).split(","):
+            try:
+                dims.append(int(dim))
+            except ValueError:
+                continue
+        return dims
+
+    def _get_path(self, image_id, max_dim, ext):
+        return os.path.join(self.root_dir, str(image_id), "%d%s" % (max_dim, ext.lower()))
+
+    def _forget(self, path):
+        with self._lock:
+            self._size -= self._entries.pop(path, 0)
+
+    def _load(self):
+        """
+        Indexes renditions left on disk by a previous run, oldest first. Must be called with the lock held.
+        """
+        if self._loaded:
+            return
+        self._loaded = True
+
+        found = []
+        for root, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if filename.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                found.append((stat.st_mtime, path, stat.st_size))
+
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class RenditionCacheInstance:
+    __instance = None
+
+    def __new__(cls):
+        if RenditionCacheInstance.__instance is None:
+            RenditionCacheInstance.__instance = RenditionCache(
+                os.path.join(ServerConfig.DATA_ROOT_DIR, ServerConfig.RENDITION_CACHE_DIR),
+                ServerConfig.RENDITION_CACHE_MAX_BYTES)
+        return RenditionCacheInstance.__instance
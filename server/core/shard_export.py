@@ -0,0 +1,122 @@
+import io
+import json
+import os
+import tarfile
+import time
+
+import server.core.annotation_store as annotation_store
+import server.core.dataset_export as dataset_export
+import server.utils as utils
+from server.core.worker_pool import WorkerPoolInstance
+
+SHARD_NAME = "shard-%06d.tar"
+INDEX_NAME = "shards.json"
+
+
+def plan_shards(pid, max_bytes):
+    """
+    Groups the labelled images of a project into shards of at most max_bytes of member data, keeping
+    each image together with its annotations. Images larger than max_bytes get a shard of their own.
+    :return: A list of shards, each a list of (image_row, annotation_rows) samples
+    """
+    images, annotations = dataset_export.get_labelled_rows(pid)
+    by_image = {row["image_id"]: [] for row in images}
+    for row in annotations:
+        by_image[row["image_id"]].append(row)
+
+    shards = [[]]
+    size = 0
+    for image in images:
+        sample = (image, by_image[image["image_id"]])
+        sample_size = os.path.getsize(image["image_path"])
+        sample_size += sum(os.path.getsize(row["mask_path"]) for row in sample[1])
+        if shards[-1] and size + sample_size > max_bytes:
+            shards.append([])
+            size = 0
+        shards[-1].append(sample)
+        size += sample_size
+    return shards if shards[-1] else []
+
+
+def get_sample_key(image):
+    return "%08d" % image["image_id"]
+
+
+def add_bytes(tar, name, data):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+def write_shard(path, samples):
+    """
+    Writes a shard in the WebDataset layout, where the members of each sample share the key of its
+    image. A sample holds the image bytes as <key><ext>, as the zip export does, each mask as <key>.mask_<n>.png and
+    a sidecar <key>.json describing the image and its annotations.
+    """
+    with tarfile.open(path + ".tmp", 'w') as tar:
+        for image, annotations in samples:
+            key = get_sample_key(image)
+            source = dataset_export.get_image_source(image)
+            if callable(source):
+                add_bytes(tar, key + image["image_ext"].lower(), source())
+            else:
+                tar.add(source, arcname=key + image["image_ext"].lower())
+
+            width, height = dataset_export.get_image_size(image)
+            sidecar = {
+                "image_id": image["image_id"],
+                "name": image["image_name"],
+                "width": width,
+                "height": height,
+                "annotations": []
+            }
+            for i, row in enumerate(annotations):
+                mask_name = "mask_%04d.png" % (i + 1)
+                add_bytes(tar, "%s.%s" % (key, mask_name), utils.load_mask_bytes(row["mask_path"]))
+                sidecar["annotations"].append({
+                    "name": row["annotation_name"],
+                    "class_name": row["class_name"],
+                    "bbox": annotation_store.get_bbox(row),
+                    "mask": mask_name
+                })
+
+            add_bytes(tar, key + ".json", json.dumps(sidecar).encode('utf-8'))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def export_shards(pid, out_dir, max_bytes, progress=None):
+    """
+    Writes the labelled images of a project to out_dir as tar shards, building several shards at a
+    time. The shards are listed in shards.json before any are written, and each shard only appears
+    under its final name once it is complete, so finished shards may be read while the rest are built.
+    :return: The path of shards.json
+    """
+    shards = plan_shards(pid, max_bytes)
+    names = [SHARD_NAME % i for i in range(len(shards))]
+    index_path = os.path.join(out_dir, INDEX_NAME)
+    with open(index_path, 'w') as f:
+        json.dump({"shards": names, "samples": [len(s) for s in shards]}, f)
+
+    def build(i):
+        return write_shard(os.path.join(out_dir, names[i]), shards[i])
+
+    for done, _ in enumerate(WorkerPoolInstance().imap(build, range(len(shards)))):
+        if progress is not None:
+            progress((done + 1) / len(shards))
+    return index_path
+
+
+def get_shard_status(out_dir):
+    """
+    Lists the shards of an export along with whether each one is complete.
+    :return: A list of (shard_name, is_complete) tuples, or None if the export hasn't been planned yet
+    """
+    try:
+        with open(os.path.join(out_dir, INDEX_NAME), 'r') as f:
+            names = json.load(f)["shards"]
+    except (OSError, ValueError):
+        return None
+    return [(name, os.path.isfile(os.path.join(out_dir, name))) for name in names]
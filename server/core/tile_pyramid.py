@@ -0,0 +1,169 @@
+import json
+import math
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+import cv2
+
+import server.utils as utils
+from server.core.worker_pool import WorkerPoolInstance
+from server.server_config import ServerConfig
+
+
+class TilePyramidStore:
+    """
+    A store of tile pyramids used to serve very large images a region at a time.
+
+    Level 0 of a pyramid holds the image at full resolution and every following level halves the
+    resolution of the previous one, until the whole image fits within a single tile. Tile (x, y) of a
+    level covers the columns [x * tile_size, (x + 1) * tile_size) and likewise the rows for y.
+
+    The encoded tiles of all levels are stored back to back in a single container file per image,
+    alongside a json index holding the offset and length of every tile. Pyramids are built the first
+    time they are requested and rebuilt whenever the revision of the image changes.
+    """
+
+    INDEX_CACHE_SIZE = 64
+
+    def __init__(self, root_dir, tile_size, ext):
+        self.root_dir = root_dir
+        self.tile_size = tile_size
+        self.ext = ext
+        self._lock = Lock()
+        self._build_locks = {}
+        self._indexes = OrderedDict()  # image_id -> index
+
+    def get_info(self, image_id, image_path, revision, is_swapped=False):
+        """
+        Gets the layout of the pyramid of an image, building the pyramid if required.
+        :return: A dict containing the tile_size, ext and the dimensions of each level
+        """
+        index = self._get_index(image_id, image_path, revision, is_swapped)
+        levels = []
+        for level in index["levels"]:
+            levels.append({k: level[k] for k in ("width", "height", "cols", "rows")})
+        return {"tile_size": index["tile_size"], "ext": index["ext"], "levels": levels}
+
+    def get_tile(self, image_id, image_path, revision, level, x, y, is_swapped=False):
+        """
+        Gets the encoded bytes of a single tile, building the pyramid if required.
+        :return: The tile bytes, or None if the tile is outside of the pyramid
+        """
+        index = self._get_index(image_id, image_path, revision, is_swapped)
+        if not 0 <= level < len(index["levels"]):
+            return None
+        level_info = index["levels"][level]
+        if not (0 <= x < level_info["cols"] and 0 <= y < level_info["rows"]):
+            return None
+
+        offset, length = level_info["tiles"][y * level_info["cols"] + x]
+        with open(self._get_data_path(image_id, index["revision"]), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def invalidate(self, image_id):
+        """
+        Removes the pyramid of an image.
+        """
+        with self._lock:
+            self._indexes.pop(image_id, None)
+        shutil.rmtree(self._get_folder(image_id), ignore_errors=True)
+
+    def _get_index(self, image_id, image_path, revision, is_swapped):
+        with self._lock:
+            index = self._indexes.get(image_id, None)
+            if self._is_current(index, revision):
+                self._indexes.move_to_end(image_id)
+                return index
+            build_lock = self._build_locks.setdefault(image_id, Lock())
+
+        with build_lock:
+            index = self._load_index(image_id)
+            if not self._is_current(index, revision):
+                index = self._build(image_id, image_path, revision, is_swapped)
+
+        with self._lock:
+            self._build_locks.pop(image_id, None)
+            self._indexes[image_id] = index
+            while len(self._indexes) > self.INDEX_CACHE_SIZE:
+                self._indexes.popitem(last=False)
+        return index
+
+    def _is_current(self, index, revision):
+        return index is not None and \
+            index["revision"] == revision and \
+            index["tile_size"] == self.tile_size and \
+            index["ext"] == self.ext
+
+    def _load_index(self, image_id):
+        try:
+            with open(self._get_index_path(image_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _build(self, image_id, image_path, revision, is_swapped):
+        mat = utils.read_image(image_path, is_swapped)
+
+        folder = self._get_folder(image_id)
+        shutil.rmtree(folder, ignore_errors=True)
+        Path(folder).mkdir(parents=True, exist_ok=True)
+
+        ts = self.tile_size
+        worker_pool = WorkerPoolInstance()
+        levels = []
+        offset = 0
+        data_path = self._get_data_path(image_id, revision)
+        with open(data_path, 'wb') as f:
+            while True:
+                height, width = mat.shape[:2]
+                cols = math.ceil(width / ts)
+                rows = math.ceil(height / ts)
+                coords = [(x, y) for y in range(rows) for x in range(cols)]
+
+                def encode(coord, level_mat=mat):
+                    x, y = coord
+                    return utils.mat2bytes(level_mat[y * ts:(y + 1) * ts, x * ts:(x + 1) * ts], self.ext)
+
+                tiles = []
+                for data in worker_pool.imap(encode, coords):
+                    f.write(data)
+                    tiles.append((offset, len(data)))
+                    offset += len(data)
+
+                levels.append({"width": width, "height": height, "cols": cols, "rows": rows, "tiles": tiles})
+                if cols == 1 and rows == 1:
+                    break
+                mat = cv2.resize(
+                    mat, (max(1, width // 2), max(1, height // 2)), interpolation=cv2.INTER_AREA)
+
+        index = {"revision": revision, "tile_size": ts, "ext": self.ext, "levels": levels}
+        index_path = self._get_index_path(image_id)
+        with open(index_path + ".tmp", 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+        return index
+
+    def _get_folder(self, image_id):
+        return os.path.join(self.root_dir, str(image_id))
+
+    def _get_index_path(self, image_id):
+        return os.path.join(self._get_folder(image_id), "index.json")
+
+    def _get_data_path(self, image_id, revision):
+        return os.path.join(self._get_folder(image_id), "tiles_%d.bin" % revision)
+
+
+class TilePyramidStoreInstance:
+    __instance = None
+
+    def __new__(cls):
+        if TilePyramidStoreInstance.__instance is None:
+            TilePyramidStoreInstance.__instance = TilePyramidStore(
+                os.path.join(ServerConfig.DATA_ROOT_DIR, ServerConfig.TILE_DIR),
+                ServerConfig.TILE_SIZE,
+                ServerConfig.TILE_EXT)
+        return TilePyramidStoreInstance.__instance
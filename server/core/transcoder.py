@@ -0,0 +1,54 @@
+import os
+
+import server.utils as utils
+from server.core.blob_store import BlobStoreInstance
+from server.core.image_cache import DecodedImageCacheInstance
+from server.core.rendition_cache import RenditionCacheInstance
+from server.core.tile_pyramid import TilePyramidStoreInstance
+from server.server_config import DatabaseInstance
+from server.server_config import ServerConfig
+
+db = DatabaseInstance()
+
+
+def transcode_image(image_id, ext=None):
+    """
+    Re-encodes a stored image to ext, which defaults to DEFAULT_IMAGE_EXT. Images stored with swapped
+    channels are rewritten in the correct channel order.
+    """
+    if ext is None:
+        ext = ServerConfig.DEFAULT_IMAGE_EXT
+
+    query = "SELECT image_path, image_ext, is_swapped, blob_hash FROM image WHERE image_id = %s"
+    result, _ = db.query(query, (image_id,))
+    if not result:
+        return
+    row = result[0]
+
+    mat = utils.read_image(row["image_path"], row["is_swapped"])
+    data = utils.mat2bytes(mat, ext)
+    if row["blob_hash"] is not None:
+        # Blobs may be shared, so the image takes a reference to a new blob rather than replacing its file
+        blob_hash, new_path = BlobStoreInstance().put_bytes(data, ext)
+    else:
+        blob_hash = None
+        new_path = os.path.splitext(row["image_path"])[0] + ext
+        tmp_path = new_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, new_path)
+
+    query = "UPDATE image SET image_path = %s, image_ext = %s, is_swapped = 0, revision = revision + 1, "
+    query += "width = %s, height = %s, depth = %s, blob_hash = %s "
+    query += "WHERE image_id = %s"
+    db.query(query, (new_path, ext, mat.shape[1], mat.shape[0], mat.shape[2], blob_hash, image_id))
+
+    if row["blob_hash"] is not None:
+        BlobStoreInstance().release(row["blob_hash"])
+    elif new_path != row["image_path"]:
+        os.remove(row["image_path"])
+
+    RenditionCacheInstance().invalidate(image_id)
+    TilePyramidStoreInstance().invalidate(image_id)
+    DecodedImageCacheInstance().invalidate(image_id)
+
@@ -0,0 +1,50 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from server.server_config import ServerConfig
+
+
+class WorkerPool:
+    """
+    A server wide pool of worker threads for decoding, resizing and encoding images.
+
+    OpenCV releases the GIL for most of this work, so threads are enough to use every core. Each call
+    to imap may only have a limited number of items queued or running at once, which stops one large
+    request from starving the requests of other annotators.
+    """
+
+    def __init__(self, max_workers, request_limit):
+        self.request_limit = request_limit
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image_worker")
+
+    def imap(self, fn, items, limit=None):
+        """
+        Applies fn to every item concurrently, yielding the results in the same order as items.
+        :param fn: A function taking a single item
+        :param items: An iterable of items
+        :param limit: The maximum number of items processed concurrently, defaults to the pool request limit
+        :return: A generator of results
+        """
+        limit = max(1, limit or self.request_limit)
+        pending = deque()
+        try:
+            for item in items:
+                if len(pending) >= limit:
+                    yield pending.popleft().result()
+                pending.append(self._executor.submit(fn, item))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class WorkerPoolInstance:
+    __instance = None
+
+    def __new__(cls):
+        if WorkerPoolInstance.__instance is None:
+            WorkerPoolInstance.__instance = WorkerPool(
+                ServerConfig.IMAGE_WORKER_COUNT,
+                ServerConfig.IMAGE_WORKER_REQUEST_LIMIT)
+        return WorkerPoolInstance.__instance
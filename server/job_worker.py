@@ -0,0 +1,32 @@
+"""
+Runs background job workers in separate processes, alongside or instead of the workers started by the server.
+
+Usage: python -m server.job_worker [process_count]
+"""
+import multiprocessing
+import os
+import pathlib
+import sys
+
+from server.server_config import ServerConfig
+
+CONFIG_PATH = os.path.join(pathlib.Path(__file__).parent.absolute(), 'config.ini')
+
+
+def run():
+    # Each process loads its own config and opens its own database connections
+    ServerConfig.load_config(CONFIG_PATH)
+
+    from server.core.jobs import JobQueueInstance
+    JobQueueInstance().run_worker()
+
+
+if __name__ == "__main__":
+    ServerConfig.load_config(CONFIG_PATH)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ServerConfig.JOB_WORKER_COUNT
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run, name="job-worker-%d" % i) for i in range(count)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
@@ -0,0 +1,61 @@
+"""
+Checks the plans MySQL chooses for project image listings, failing if any listing which should be read
+in order from an index sorts the images of the project instead. Run it against a database holding a
+realistically sized project after changing the listing query or the indexes of the image table.
+
+Usage: python -m server.perf_image_listing project_id
+"""
+import itertools
+import os
+import pathlib
+import sys
+
+from server.server_config import ServerConfig
+
+CONFIG_PATH = os.path.join(pathlib.Path(__file__).parent.absolute(), 'config.ini')
+
+PAGE_SIZE = 100
+
+
+def get_filters():
+    """
+    Yields every combination of the filters and orders which the listing indexes serve.
+    """
+    states = [{}] + [{"labeled": labeled, "locked": locked}
+                     for labeled, locked in itertools.product((False, True), repeat=2)]
+    for state, key, ascending in itertools.product(states, ("id", "name"), (True, False)):
+        content = dict(state)
+        content["order_by"] = {"key": key, "ascending": ascending}
+        yield content
+
+
+def explain(db, image_listing, pid, content, after):
+    query, params, _ = image_listing.build_project_images_query(pid, content, ["name"], PAGE_SIZE, after)
+    rows, _ = db.query("EXPLAIN " + query, params)
+    return rows[0]
+
+
+if __name__ == "__main__":
+    ServerConfig.load_config(CONFIG_PATH)
+
+    from server.server_config import DatabaseInstance
+    import server.core.image_listing as image_listing
+
+    pid = int(sys.argv[1])
+    db = DatabaseInstance()
+
+    failures = 0
+    print("filter\t\t\t\t\t\tcursor\tkey\t\t\textra")
+    for content in get_filters():
+        cursor = image_listing.encode_cursor({"image_id": 1, "image_name": ""}, content["order_by"]["key"])
+        for after in (None, cursor):
+            plan = explain(db, image_listing, pid, content, after)
+            extra = plan.get("Extra") or ""
+            ok = plan.get("key") is not None and "Using filesort" not in extra
+            failures += not ok
+            print("%-48s\t%s\t%-24s\t%s%s" % (
+                content, after is not None, plan.get("key"), extra, "" if ok else "\t<- FAILED"))
+
+    if failures:
+        print("%d listings are not read in index order." % failures)
+        sys.exit(1)
@@ -0,0 +1,77 @@
+"""
+Compares the size and speed of the mask encodings used between the client and the server.
+
+Usage: python -m server.perf_mask_codec [mask_count] [image_size]
+"""
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import server.utils as utils
+
+
+def make_masks(count, size, seed=0):
+    """
+    Generates masks resembling hand drawn annotations, each a filled blob covering a varying fraction
+    of the image with a few holes cut out of it.
+    """
+    rng = np.random.RandomState(seed)
+    masks = []
+    for _ in range(count):
+        mat = np.zeros((size, size), dtype=np.uint8)
+        radius = int(size * rng.uniform(0.02, 0.3))
+        cx, cy = rng.randint(radius, size - radius, size=2)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, size=24))
+        radii = radius * rng.uniform(0.6, 1.0, size=24)
+        points = np.stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)], axis=1)
+        cv2.fillPoly(mat, [points.astype(np.int32)], 255)
+        for _ in range(rng.randint(0, 4)):
+            hole = rng.randint(cx - radius // 2, cx + radius // 2 + 1, size=2)
+            cv2.circle(mat, tuple(int(v) for v in hole), max(1, radius // 8), 0, -1)
+        masks.append(mat.astype(bool))
+    return masks
+
+
+def encode_png(mask):
+    return utils.mat2bytes(utils.mask2mat(mask), ".png")
+
+
+def decode_png(data, shape):
+    return utils.mat2mask(utils.bytes2mat(data))
+
+
+CODECS = [
+    ("raw (json)", lambda m: utils.encode_mask(m, utils.MASK_ENCODING_RAW),
+     lambda d, s: utils.decode_mask(d, s, utils.MASK_ENCODING_RAW)),
+    ("packed-v1 (json)", lambda m: utils.encode_mask(m, utils.MASK_ENCODING_PACKED),
+     lambda d, s: utils.decode_mask(d, s, utils.MASK_ENCODING_PACKED)),
+    ("png (zip)", encode_png, decode_png),
+    ("packed-v1 (zip)", utils.pack_mask, lambda d, s: utils.unpack_mask(d)),
+]
+
+
+def run(masks, encode, decode):
+    t0 = time.time()
+    encoded = [encode(m) for m in masks]
+    t1 = time.time()
+    for data, mask in zip(encoded, masks):
+        if not np.array_equal(decode(data, mask.shape), mask):
+            raise AssertionError("Mask did not survive a round trip.")
+    t2 = time.time()
+    return sum(len(d) for d in encoded), t1 - t0, t2 - t1
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 2500
+
+    print("Generating %d masks of %dx%d" % (count, size, size))
+    masks = make_masks(count, size)
+
+    print("codec\t\t\tbytes/mask\tencode ms\tdecode ms")
+    for name, encode, decode in CODECS:
+        total, encode_time, decode_time = run(masks, encode, decode)
+        print("%-16s\t%d\t\t%.1f\t\t%.1f" % (
+            name, total // count, encode_time * 1000 / count, decode_time * 1000 / count))
@@ -0,0 +1,55 @@
+"""
+Measures the throughput of rendering thumbnails through the WorkerPool as the number of workers grows.
+
+Usage: python -m server.perf_worker_pool [image_count] [image_size]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+import server.utils as utils
+from server.core.worker_pool import WorkerPool
+
+
+def make_images(folder, count, size):
+    paths = []
+    for i in range(count):
+        mat = np.random.randint(255, size=(size, size, 3), dtype=np.uint8)
+        mat = cv2.GaussianBlur(mat, (31, 31), 0)
+        path = os.path.join(folder, "%04d.png" % i)
+        cv2.imwrite(path, mat)
+        paths.append(path)
+    return paths
+
+
+def run(paths, workers, max_dim=150):
+    pool = WorkerPool(workers, workers)
+    t0 = time.time()
+    for _ in pool.imap(lambda p: utils.render_image(p, ".png", max_dim), paths):
+        pass
+    return time.time() - t0
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    # Let the pool provide the parallelism rather than OpenCV's internal threads
+    cv2.setNumThreads(1)
+
+    with tempfile.TemporaryDirectory() as folder:
+        print("Generating %d images of %dx%d" % (count, size, size))
+        paths = make_images(folder, count, size)
+
+        workers = 1
+        baseline = None
+        print("workers\tseconds\timages/s\tspeedup")
+        while workers <= (os.cpu_count() or 1):
+            elapsed = run(paths, workers)
+            baseline = baseline or elapsed
+            print("%d\t%.3f\t%.1f\t\t%.2fx" % (workers, elapsed, count / elapsed, baseline / elapsed))
+            workers *= 2
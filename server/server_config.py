@@ -17,7 +17,12 @@ class ServerConfig:
     DATABASE_PASSWORD = ""
     DATABASE_NAME = ""
     DATABASE_TIMEZONE = '+00:00'
-    DATABASE_POOL_SIZE = 3
+    # The most connections open at once, which should allow for every request thread and job worker
+    DATABASE_POOL_SIZE = 16
+    # Connections idle for longer than this many seconds are checked before being reused
+    DATABASE_VALIDATE_AFTER = 30.0
+    # Projects and labels are cached for this many seconds, or until changed through this server
+    QUERY_CACHE_TTL = 30.0
 
     # Set in config.ini
     DATA_ROOT_DIR = ""
@@ -26,6 +31,50 @@ class ServerConfig:
     DEFAULT_MASK_EXT = ".png"
     DEFAULT_INFO_EXT = ".xml"
 
+    # "verbatim" stores uploaded images as is, "transcode" re-encodes them to DEFAULT_IMAGE_EXT
+    IMAGE_INGEST_MODE = "verbatim"
+    # Formats which can be served directly, verbatim uploads in other formats are transcoded in the background
+    NATIVE_IMAGE_EXTS = ".jpg,.jpeg,.png"
+    IMAGE_BACKGROUND_TRANSCODE = True
+    # Content addressed image files, stored under DATA_ROOT_DIR
+    BLOB_DIR = "blobs"
+    # The number of images inserted per query by streaming uploads
+    UPLOAD_BATCH_SIZE = 100
+    # The most images listed in a single page
+    IMAGE_PAGE_MAX_SIZE = 1000
+    # Locked images are unlocked once their lease runs this many seconds without being renewed
+    IMAGE_LEASE_SECONDS = 300
+
+    # Downscaled image renditions, stored under DATA_ROOT_DIR
+    RENDITION_CACHE_DIR = "renditions"
+    RENDITION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+    # A comma separated list of max dimensions generated on upload
+    RENDITION_EAGER_DIMS = "150"
+
+    # Threads used to render images, and the number any single request may use at once
+    IMAGE_WORKER_COUNT = os.cpu_count() or 4
+    IMAGE_WORKER_REQUEST_LIMIT = 4
+
+    # Tile pyramids for deep zoom, stored under DATA_ROOT_DIR
+    TILE_DIR = "tiles"
+    TILE_SIZE = 256
+    TILE_EXT = ".jpg"
+
+    # Decoded images kept in memory for region of interest crops
+    DECODED_IMAGE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+    # The cached export of each project, updated incrementally and stored under DATA_ROOT_DIR
+    EXPORT_CACHE_DIR = "exports"
+    # The most member data written to a single shard of a sharded export
+    EXPORT_SHARD_MAX_BYTES = 256 * 1024 * 1024
+
+    # Background jobs, with their results stored under DATA_ROOT_DIR
+    JOB_DIR = "jobs"
+    JOB_WORKER_COUNT = 2
+    JOB_POLL_INTERVAL = 1.0
+    # Running jobs which haven't reported progress for this long are assumed lost and queued again
+    JOB_STALE_SECONDS = 600
+
     @classmethod
     def load_config(cls, path):
         def get_best_type(section, key):
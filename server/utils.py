@@ -1,5 +1,8 @@
 import base64
+import json
 import os
+import struct
+import zlib
 import xml.etree.ElementTree as ET
 from xml.dom import minidom
 from pathlib import Path
@@ -8,18 +11,62 @@ import cv2
 import numpy as np
 from server.server_config import ServerConfig
 
-
-def encode_mask(mask):
-    encoded_mask = base64.b64encode(mask.tobytes(order='C'))
+FRAME_STREAM_MIMETYPE = "application/x-fastannotation-frames"
+FRAME_PREFIX = struct.Struct(">II")
+
+# Stored masks hold only their bounding box, bit packed, see pack_mask
+COMPACT_MASK_EXT = ".mask"
+COMPACT_MASK_MAGIC = b"FAMK"
+COMPACT_MASK_VERSION = 1
+COMPACT_MASK_HEADER = struct.Struct(">4sBIIIIII")
+
+# Masks sent over the wire are either one byte per pixel (raw) or in the compact mask format (packed).
+# Clients declare the encoding of the masks they send and want back in the X-Mask-Encoding header.
+MASK_ENCODING_HEADER = "X-Mask-Encoding"
+MASK_ENCODING_RAW = "raw"
+MASK_ENCODING_PACKED = "packed-v1"
+MASK_ENCODINGS = (MASK_ENCODING_RAW, MASK_ENCODING_PACKED)
+
+
+def get_mask_encoding(headers):
+    """
+    Gets the mask encoding declared by a request, which defaults to MASK_ENCODING_RAW for older clients.
+    :raises ValueError: If the encoding isn't supported
+    """
+    encoding = headers.get(MASK_ENCODING_HEADER, MASK_ENCODING_RAW).strip().lower()
+    if encoding not in MASK_ENCODINGS:
+        raise ValueError("Unsupported mask encoding '%s', expected one of %s." % (encoding, ", ".join(MASK_ENCODINGS)))
+    return encoding
+
+
+def encode_mask(mask, encoding=MASK_ENCODING_RAW):
+    if encoding == MASK_ENCODING_PACKED:
+        mask_bytes = pack_mask(mask)
+    else:
+        mask_bytes = mask.tobytes(order='C')
+    encoded_mask = base64.b64encode(mask_bytes)
     return encoded_mask.decode('utf-8')
 
 
-def decode_mask(b64_str, shape):
+def decode_mask(b64_str, shape, encoding=MASK_ENCODING_RAW):
     mask_bytes = base64.b64decode(b64_str.encode("utf-8"))
+    if encoding == MASK_ENCODING_PACKED:
+        mask = unpack_mask(mask_bytes)
+        if mask.shape != tuple(shape[:2]):
+            raise ValueError("Mask of shape %s does not match the image shape %s." % (mask.shape, tuple(shape[:2])))
+        return mask
     flat = np.fromstring(mask_bytes, bool)
     return np.reshape(flat, newshape=shape[:2], order='C')
 
 
+def encode_frame_header(header, data_length):
+    """
+    Encodes the prefix of a binary stream frame, which is followed by data_length bytes of data.
+    """
+    header_bytes = json.dumps(header).encode('utf-8')
+    return FRAME_PREFIX.pack(len(header_bytes), data_length) + header_bytes
+
+
 def downscale_mat(mat, max_dim):
     new_dim = np.array(mat.shape[:2])
     long_dim = np.max(new_dim)
@@ -33,6 +80,77 @@ def downscale_mat(mat, max_dim):
     return cv2.resize(mat, tuple(reversed(new_dim)))
 
 
+def read_image(path, is_swapped=False):
+    """
+    Reads a stored image as a BGR mat.
+    :param is_swapped: Whether the file was written with its red and blue channels swapped
+    """
+    mat = cv2.imread(path)
+    if mat is None:
+        raise IOError("Failed to read image '%s'." % path)
+    if is_swapped:
+        mat = cv2.cvtColor(mat, cv2.COLOR_RGB2BGR)
+    return mat
+
+
+def render_mat(mat, ext, max_dim=None):
+    """
+    Encodes a BGR mat into the bytes served to clients, optionally downscaled.
+    """
+    if max_dim is not None:
+        mat = downscale_mat(mat, max_dim)
+    return mat2bytes(mat, ext)
+
+
+def render_image(path, ext, max_dim=None, is_swapped=False):
+    return render_mat(read_image(path, is_swapped), ext, max_dim)
+
+
+def is_native_ext(ext):
+    """
+    Checks whether images with this extension can be served without transcoding.
+    """
+    return ext.lower() in [e.strip().lower() for e in ServerConfig.NATIVE_IMAGE_EXTS.split(",")]
+
+
+def probe_image(data):
+    """
+    Reads the format and dimensions of an encoded image from its header, without decoding it.
+    :return: A tuple of (ext, width, height, depth), or None if the format is not recognised
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        depth = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(data[25], 3)
+        return ".png", width, height, depth
+
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            if marker == 0xD8 or 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                i += 2
+                continue
+            # Start of frame markers, excluding DHT, JPG and DAC
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return ".jpg", width, height, data[i + 9]
+            i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+        return None
+
+    if data[:2] == b"BM" and len(data) >= 30:
+        width, height = struct.unpack("<ii", data[18:26])
+        bits = struct.unpack("<H", data[28:30])[0]
+        return ".bmp", width, abs(height), max(1, bits // 8)
+
+    return None
+
+
 def mask2mat(mask):
     mat = mask.astype(np.uint8) * 255
     return cv2.cvtColor(mat, cv2.COLOR_GRAY2RGB)
@@ -42,9 +160,9 @@ def mat2mask(mat):
     return np.sum(mat.astype(bool), axis=2, dtype=bool)
 
 
-def bytes2mat(bytes):
-    nparr = np.fromstring(bytes, np.uint8)
-    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+def bytes2mat(bytes, flags=cv2.IMREAD_COLOR):
+    nparr = np.frombuffer(bytes, np.uint8)
+    return cv2.imdecode(nparr, flags)
 
 
 def mat2bytes(mat, ext):
@@ -52,29 +170,114 @@ def mat2bytes(mat, ext):
     return buf[1].tostring()
 
 
+def pack_mask(mask):
+    """
+    Encodes a boolean mask in the compact mask format, which holds only the bounding box of the
+    foreground, bit packed and deflated, behind a header giving the full shape and the box.
+    """
+    height, width = mask.shape[:2]
+    cols = np.flatnonzero(mask.any(axis=0))
+    rows = np.flatnonzero(mask.any(axis=1))
+    if cols.size == 0:
+        x = y = w = h = 0
+        bits = b""
+    else:
+        x, y = int(cols[0]), int(rows[0])
+        w, h = int(cols[-1]) - x + 1, int(rows[-1]) - y + 1
+        bits = np.packbits(mask[y:y + h, x:x + w]).tobytes()
+    header = COMPACT_MASK_HEADER.pack(COMPACT_MASK_MAGIC, COMPACT_MASK_VERSION, height, width, x, y, w, h)
+    return header + zlib.compress(bits, 1)
+
+
+def read_mask_header(data):
+    """
+    Reads the header of a compact mask.
+    :return: A tuple of (shape, bbox), where shape is (height, width) and bbox is (x, y, w, h)
+    """
+    magic, version, height, width, x, y, w, h = COMPACT_MASK_HEADER.unpack_from(data)
+    if magic != COMPACT_MASK_MAGIC or version != COMPACT_MASK_VERSION:
+        raise ValueError("Unsupported mask format.")
+    return (height, width), (x, y, w, h)
+
+
+def unpack_mask(data, cropped=False):
+    """
+    Decodes a compact mask.
+    :param cropped: Whether to return only the bounding box of the mask
+    :return: The full boolean mask, or a tuple of (mask, bbox) when cropped
+    """
+    shape, (x, y, w, h) = read_mask_header(data)
+    bits = np.frombuffer(zlib.decompress(data[COMPACT_MASK_HEADER.size:]), np.uint8)
+    crop = np.unpackbits(bits, count=w * h).reshape((h, w)).astype(bool)
+    if cropped:
+        return crop, (x, y, w, h)
+    mask = np.zeros(shape, dtype=bool)
+    mask[y:y + h, x:x + w] = crop
+    return mask
+
+
 def save_mask(mask, filepath, resize_shape=None):
+    """
+    Saves a mask in the compact mask format, resized to resize_shape if given.
+    """
     folder = os.path.dirname(filepath)
     Path(folder).mkdir(parents=True, exist_ok=True)
-    mask = mask.astype(np.uint8) * 255
-    if resize_shape is not None:
-        cv2.resize(mask, resize_shape[1::-1])
-    cv2.imwrite(filepath, mask)
-
-
-def save_info(shape, bbox, class_name, filepath, resize_shape=None):
-    create_info_file(filepath)
-
     if resize_shape is not None:
-        scale = resize_shape[0] / shape[0]
-        shape = resize_shape
-        bbox = np.array(bbox) * scale
-        bbox = bbox.astype(int)
-
-    root = ET.parse(filepath).getroot()
+        mask = cv2.resize(mask.astype(np.uint8), resize_shape[1::-1], interpolation=cv2.INTER_NEAREST)
+    with open(filepath, 'wb') as f:
+        f.write(pack_mask(mask.astype(bool)))
+
+
+def load_mask(filepath):
+    """
+    Loads a stored mask as a full size boolean mask. Masks stored as images by older servers are
+    treated as set wherever any channel is non zero.
+    """
+    if os.path.splitext(filepath)[1].lower() == COMPACT_MASK_EXT:
+        with open(filepath, 'rb') as f:
+            return unpack_mask(f.read())
+    mat = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
+    if mat is None:
+        raise IOError("Failed to read mask '%s'." % filepath)
+    return mat.astype(bool) if mat.ndim == 2 else mat.any(axis=2)
+
+
+def load_mask_packed(filepath):
+    """
+    Loads a stored mask in the compact mask format, reading compact masks as they are stored.
+    """
+    if os.path.splitext(filepath)[1].lower() == COMPACT_MASK_EXT:
+        with open(filepath, 'rb') as f:
+            return f.read()
+    return pack_mask(load_mask(filepath))
+
+
+def load_mask_bytes(filepath, ext=None):
+    """
+    Loads a stored mask encoded as an image, with the foreground set to 255.
+    Masks already stored as images are returned unchanged.
+    :param ext: The image format to encode as, which defaults to DEFAULT_MASK_EXT
+    """
+    if os.path.splitext(filepath)[1].lower() != COMPACT_MASK_EXT:
+        with open(filepath, 'rb') as f:
+            return f.read()
+    if ext is None:
+        ext = ServerConfig.DEFAULT_MASK_EXT
+    return mat2bytes(load_mask(filepath).astype(np.uint8) * 255, ext)
+
+
+def build_info(shape, bbox, class_name):
+    """
+    Builds the Pascal VOC style xml describing an annotation.
+    :param shape: The (height, width, depth) of the image
+    :param bbox: The bounding box of the annotation as (x, y, width, height)
+    :return: The xml document as bytes
+    """
+    root = ET.parse(ServerConfig.XML_TEMPLATE_PATH).getroot()
 
     obj = root.find('size')
-    obj.find('width').text = str(shape[0])
-    obj.find('height').text = str(shape[1])
+    obj.find('width').text = str(shape[1])
+    obj.find('height').text = str(shape[0])
     obj.find('depth').text = str(shape[2])
 
     obj = root.find('object')
@@ -82,14 +285,12 @@ def save_info(shape, bbox, class_name, filepath, resize_shape=None):
 
     obj.find("bndbox/xmin").text = str(bbox[0])
     obj.find("bndbox/ymin").text = str(bbox[1])
-    obj.find("bndbox/xmax").text = str(bbox[2])
-    obj.find("bndbox/ymax").text = str(bbox[3])
-
+    obj.find("bndbox/xmax").text = str(bbox[0] + bbox[2])
+    obj.find("bndbox/ymax").text = str(bbox[1] + bbox[3])
 
     xmlstr = minidom.parseString(ET.tostring(root)).toprettyxml(indent="   ")
     xmlstr = os.linesep.join([s for s in xmlstr.splitlines() if s.strip()])
-    with open(filepath, 'w') as f:
-        f.write(xmlstr)
+    return xmlstr.encode('utf-8')
 
 
 def load_info(filepath):
@@ -125,12 +326,3 @@ def resize_info(info, shape):
     info["source_shape"] = shape
     info["bbox"] = tuple(new_bbox.astype(int))
     return info
-
-
-def create_info_file(filepath):
-    folder = os.path.dirname(filepath)
-    Path(folder).mkdir(parents=True, exist_ok=True)
-    with open(ServerConfig.XML_TEMPLATE_PATH) as f_in:
-        with open(filepath, "w") as f_out:
-            for line in f_in:
-                f_out.write(line)
\ No newline at end of file